@@ -5,16 +5,21 @@ import io
 import json
 import logging
 import typing
+import urllib.parse
+import uuid
 
 import celery
+from flask import current_app
 from flask import url_for
 from invenio_db import db
 from sqlalchemy import true
+from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import Conflict
 from werkzeug.http import parse_options_header
 
 from invenio_deposit.api import Deposit
 from invenio_deposit.api import has_status
+from invenio_files_rest.models import BucketTag
 from invenio_files_rest.models import ObjectVersion
 from invenio_files_rest.models import ObjectVersionTag
 from invenio_pidstore.resolver import Resolver
@@ -26,13 +31,21 @@ from invenio_sword.metadata import SWORDMetadata
 from invenio_sword.typing import BytesReader
 from sword3common.constants import DepositState
 from sword3common.constants import Rel
+from .locking import break_bucket_lock
 from .metadata import Metadata
+from .outbox import call_on_commit
+from .outbox import delay_on_commit
 from .packaging import Packaging
+from .progress import get_progress
+from .routing import get_task_options
 from .schemas import ByReferenceFileDefinition
 from .utils import TagManager
 
 logger = logging.getLogger(__name__)
 
+#: The key of the tag holding the last generation given to a deposit, see :func:`new_generation`
+GENERATION_TAG = "invenio_sword.generation"
+
 
 class SWORDFileObject(FileObject):
     def __init__(self, *args, pid, **kwargs):
@@ -77,6 +90,13 @@ class SWORDDeposit(Deposit):
 
     files_iter_cls = SWORDFilesIterator
 
+    @property
+    def generation(self) -> str:
+        """Tags the objects created through this instance, so that they can replace those from earlier deposits"""
+        if not hasattr(self, "_generation"):
+            self._generation = new_generation(self.bucket_id)
+        return self._generation
+
     def get_status_as_jsonld(self):
         editable = self["_deposit"].get("status") == "draft"
 
@@ -135,6 +155,15 @@ class SWORDDeposit(Deposit):
             if ObjectTagKey.MetadataFormat in tags:
                 rel.add(Rel.FormattedMetadata)
                 link["metadataFormat"] = tags[ObjectTagKey.MetadataFormat]
+            progress_task_ids = str(tags.get(ObjectTagKey.ProgressTaskIDs, "")).split()
+            if progress_task_ids and tags.get(ObjectTagKey.FileState) in (
+                FileState.Downloading,
+                FileState.Unpacking,
+            ):
+                # e.g. {"bytesTransferred": ..., "totalBytes": ...}, so that clients can judge how long is left
+                progress = get_progress(file.obj, progress_task_ids)
+                if progress:
+                    link["progress"] = progress
 
             link["rel"] = sorted(rel)
 
@@ -201,6 +230,9 @@ class SWORDDeposit(Deposit):
     ):
         from . import tasks
 
+        if replace:
+            self.supersede_earlier_deposits()
+
         if stream:
             packaging = Packaging.for_record_and_name(self, packaging_name)
 
@@ -218,16 +250,40 @@ class SWORDDeposit(Deposit):
                 {
                     ObjectTagKey.Packaging: packaging_name,
                     ObjectTagKey.OriginalDeposit: "true",
+                    ObjectTagKey.Generation: self.generation,
                 }
             )
             db.session.refresh(object_version)
-            task = self.unpack_object(object_version)
-            if replace:
-                task |= tasks.delete_old_objects.s(bucket_id=self.bucket_id)
-            task.delay()
+
+            # Small deposits can often be unpacked here and now, without the latency of queuing a task
+            if (
+                object_version.file.size
+                <= current_app.config["SWORD_SHORTCUT_UNPACK_MAX_SIZE"]
+            ):
+                keys = packaging.shortcut_unpack(object_version)
+            else:
+                keys = NotImplemented
+
+            if keys is not NotImplemented:
+                TagManager(object_version)[ObjectTagKey.FileState] = FileState.Ingested
+                for signature in packaging.deferred_tasks:
+                    delay_on_commit(signature)
+                if replace:
+                    tasks.delete_old_objects(
+                        bucket_id=self.bucket_id, generation=self.generation
+                    )
+            else:
+                task = self.unpack_object(object_version)
+                if replace:
+                    task |= tasks.delete_old_objects.si(
+                        bucket_id=self.bucket_id, generation=self.generation
+                    )
+                delay_on_commit(task)
         elif replace:
             # We can do this synchronously, because it'll be quick
-            tasks.delete_old_objects(bucket_id=self.bucket_id)
+            tasks.delete_old_objects(
+                bucket_id=self.bucket_id, generation=self.generation
+            )
 
     # @has_status(status="draft")
     def set_metadata(
@@ -318,8 +374,16 @@ class SWORDDeposit(Deposit):
 
             tags = TagManager(object_version)
             tags[ObjectTagKey.MetadataFormat] = metadata_class.metadata_format
+            tags[ObjectTagKey.Generation] = self.generation
             if derived_from:
                 tags[ObjectTagKey.DerivedFrom] = derived_from
+                # Metadata extracted from a package belongs to the same deposit as the package
+                derived_from_object = ObjectVersion.get(self.bucket, derived_from)
+                generation = derived_from_object and TagManager(
+                    derived_from_object
+                ).get(ObjectTagKey.Generation)
+                if generation:
+                    tags[ObjectTagKey.Generation] = generation
 
             return metadata
 
@@ -332,7 +396,14 @@ class SWORDDeposit(Deposit):
     ):
         from . import tasks
 
+        if replace:
+            self.supersede_earlier_deposits()
+
         task_group = []
+        # Files to dereference from each origin (scheme and host), so those from the same origin can be batched
+        by_origin: typing.Dict[
+            typing.Tuple[typing.Optional[str], str], typing.List[ObjectVersion]
+        ] = {}
 
         for by_reference_file in by_reference_files:
             content_disposition, content_disposition_options = parse_options_header(
@@ -353,6 +424,7 @@ class SWORDDeposit(Deposit):
                         "true" if by_reference_file.dereference else "false"
                     ),
                     ObjectTagKey.ByReferenceNotDeleted: "true",
+                    ObjectTagKey.Generation: self.generation,
                 }
             )
             if by_reference_file.url:
@@ -372,21 +444,78 @@ class SWORDDeposit(Deposit):
             if dereference_policy(object_version, by_reference_file):
                 # Need to refresh so that self.dereference_object can see the tags
                 db.session.refresh(object_version)
-                task_group.append(self.dereference_object(object_version))
+                origin: typing.Tuple[typing.Optional[str], str]
+                if by_reference_file.url:
+                    url = urllib.parse.urlsplit(by_reference_file.url)
+                    origin = (url.scheme, url.netloc)
+                else:
+                    # Segmented uploads are already local, so each is an origin of its own
+                    origin = (None, str(by_reference_file.temporary_id))
+                by_origin.setdefault(origin, []).append(object_version)
+
+        for batch in batch_by_origin(
+            list(by_origin.values()),
+            batch_size=current_app.config["SWORD_DEREFERENCE_BATCH_SIZE"],
+            concurrency=current_app.config["SWORD_DEREFERENCE_HOST_CONCURRENCY"],
+        ):
+            if len(batch) == 1:
+                task_group.append(self.dereference_object(batch[0]))
+            else:
+                task_group.append(self.dereference_objects(batch))
 
         if task_group:
             # Don't need to group if there's only one task, which avoids a chord
             task = celery.group(task_group) if len(task_group) > 1 else task_group[0]
             if replace:
-                task |= tasks.delete_old_objects.s(bucket_id=self.bucket_id)
-            task.delay()
+                task |= tasks.delete_old_objects.si(
+                    bucket_id=self.bucket_id, generation=self.generation
+                )
+            delay_on_commit(task)
         elif replace:
-            tasks.delete_old_objects(bucket_id=self.bucket_id)
+            tasks.delete_old_objects(
+                bucket_id=self.bucket_id, generation=self.generation
+            )
 
     def dereference_object(self, object_version: ObjectVersion):
         """Queues a task to dereference an object"""
         from . import tasks
 
+        self.prepare_dereference(object_version)
+
+        if self.dereference_streams(object_version):
+            return self.track_tasks(
+                [object_version],
+                tasks.dereference_and_unpack_object.s(
+                    str(self.id), str(object_version.version_id)
+                ),
+            )
+
+        dereference_signature = tasks.dereference_object.s(
+            str(self.id), str(object_version.version_id)
+        )
+        unpack_signature = tasks.unpack_object.si(
+            str(self.id), str(object_version.version_id)
+        )
+        self.track_tasks([object_version], dereference_signature, unpack_signature)
+        return dereference_signature | unpack_signature
+
+    def dereference_objects(self, object_versions: typing.Sequence[ObjectVersion]):
+        """Queues a task to dereference several objects in turn, as planned by :func:`batch_by_origin`"""
+        from . import tasks
+
+        for object_version in object_versions:
+            self.prepare_dereference(object_version)
+
+        return self.track_tasks(
+            object_versions,
+            tasks.dereference_objects.s(
+                str(self.id),
+                [str(object_version.version_id) for object_version in object_versions],
+            ),
+        )
+
+    def prepare_dereference(self, object_version: ObjectVersion):
+        """Checks that an object can be dereferenced, and marks it as pending"""
         tags = TagManager(object_version)
         assert tags[ObjectTagKey.Packaging]
         assert tags.get(ObjectTagKey.ByReferenceURL) or tags.get(
@@ -396,13 +525,17 @@ class SWORDDeposit(Deposit):
 
         tags[ObjectTagKey.FileState] = FileState.Pending
 
-        task_signature = tasks.dereference_object.s(
-            str(self.id), str(object_version.version_id)
+    def dereference_streams(self, object_version: ObjectVersion) -> bool:
+        """Whether an object will be unpacked as it's downloaded, instead of by a separate task"""
+        tags = TagManager(object_version)
+        packaging = Packaging.for_record_and_name(
+            self, str(tags[ObjectTagKey.Packaging])
         )
-        task_signature |= tasks.unpack_object.si(
-            str(self.id), str(object_version.version_id)
+        return (
+            current_app.config["SWORD_STREAMING_DEREFERENCE"]
+            and packaging.streamable
+            and ObjectTagKey.ByReferenceURL in tags
         )
-        return task_signature
 
     def unpack_object(self, object_version: ObjectVersion):
         """Queues a task to unpack an object"""
@@ -414,7 +547,156 @@ class SWORDDeposit(Deposit):
 
         tags[ObjectTagKey.FileState] = FileState.Unpacking
 
-        return tasks.unpack_object.s(str(self.id), str(object_version.version_id))
+        return self.track_tasks(
+            [object_version],
+            tasks.unpack_object.s(str(self.id), str(object_version.version_id)),
+        )
+
+    def track_tasks(
+        self,
+        object_versions: typing.Sequence[ObjectVersion],
+        *signatures: celery.Signature,
+        add: bool = False,
+        reports_progress: bool = True,
+    ) -> celery.Signature:
+        """Gives each signature a task ID, recorded on the objects it will process, and returns the first signature
+
+        The IDs are used by :meth:`supersede_earlier_deposits` to revoke the tasks. Each signature is also given the
+        options from ``SWORD_TASK_ROUTER``, e.g. the queue to send it to.
+
+        :param add: keep the task IDs already recorded on the objects, e.g. when a running task queues more tasks,
+            instead of replacing them
+        :param reports_progress: whether the tasks report their progress. Only the IDs of those that do are looked up
+            to show progress on the deposit's status.
+        """
+        task_ids = []
+        for signature in signatures:
+            task_id = str(uuid.uuid4())
+            signature.set(
+                task_id=task_id,
+                **get_task_options(signature.task, self, object_versions),
+            )
+            task_ids.append(task_id)
+        tag_keys = [ObjectTagKey.TaskIDs]
+        if reports_progress:
+            tag_keys.append(ObjectTagKey.ProgressTaskIDs)
+        for object_version in object_versions:
+            tags = TagManager(object_version)
+            for tag_key in tag_keys:
+                existing_task_ids: typing.List[str] = (
+                    str(tags.get(tag_key, "")).split() if add else []
+                )
+                tags[tag_key] = " ".join(existing_task_ids + task_ids)
+        return signatures[0]
+
+    def supersede_earlier_deposits(self):
+        """Stops the processing of objects from earlier deposits, as this one is replacing them
+
+        Their tasks are revoked once this deposit is committed. Tasks that have already started notice that their
+        objects are tagged as superseded, and stop when they next check. The bucket lock is released if one of them
+        holds it, as a chunked unpack's lock is only released by its final task, which won't run once its chunks are
+        revoked.
+        """
+        in_flight = ObjectVersion.query.join(
+            ObjectVersionTag, ObjectVersionTag.version_id == ObjectVersion.version_id,
+        ).filter(
+            ObjectVersion.bucket_id == self.bucket_id,
+            ObjectVersion.is_head == true(),
+            ObjectVersionTag.key == ObjectTagKey.TaskIDs.value,
+        )
+
+        task_ids = []
+        for object_version in in_flight:
+            tags = TagManager(object_version)
+            if tags.get(ObjectTagKey.Generation, "") >= self.generation:
+                continue
+            if tags.get(ObjectTagKey.FileState) in (
+                FileState.Ingested,
+                FileState.Error,
+            ):
+                continue
+            task_ids.extend(tags[ObjectTagKey.TaskIDs].split())
+            del tags[ObjectTagKey.TaskIDs]
+            if ObjectTagKey.ProgressTaskIDs in tags:
+                del tags[ObjectTagKey.ProgressTaskIDs]
+            tags[ObjectTagKey.SupersededBy] = self.generation
+
+        if task_ids:
+            logger.info("Revoking %d superseded tasks", len(task_ids))
+            break_bucket_lock(self.bucket_id, task_ids)
+            call_on_commit(
+                functools.partial(celery.current_app.control.revoke, task_ids)
+            )
+
+
+def new_generation(bucket_id) -> str:
+    """Returns a new generation ID for a deposit's :attr:`SWORDDeposit.generation`
+
+    Generations come from a counter kept in a :class:`BucketTag` on the deposit's bucket, so that each sorts after
+    those created before it, whichever server's clock. The counter is only incremented if it's unchanged since it was
+    read, so concurrent requests get different generations; the second waits for the first to commit where the
+    database supports row locks. Generations are ``g`` followed by the counter zero-padded to twelve digits, so that
+    they compare as strings.
+    """
+    while True:
+        counter = BucketTag.query.filter_by(
+            bucket_id=bucket_id, key=GENERATION_TAG
+        ).first()
+        if counter is None:
+            generation = _format_generation(1)
+            try:
+                with db.session.begin_nested():
+                    db.session.add(
+                        BucketTag(
+                            bucket_id=bucket_id, key=GENERATION_TAG, value=generation
+                        )
+                    )
+            except IntegrityError:
+                # Created by another request in the meantime
+                continue
+            return generation
+
+        generation = _format_generation(int(counter.value[1:]) + 1)
+        updated = BucketTag.query.filter_by(
+            bucket_id=bucket_id, key=GENERATION_TAG, value=counter.value
+        ).update({BucketTag.value: generation}, synchronize_session=False)
+        db.session.expire(counter)
+        if updated:
+            return generation
+
+
+def _format_generation(number: int) -> str:
+    return "g{:012d}".format(number)
+
+
+def batch_by_origin(
+    by_origin: typing.Sequence[typing.Sequence[ObjectVersion]],
+    *,
+    batch_size: int,
+    concurrency: int,
+) -> typing.List[typing.Sequence[ObjectVersion]]:
+    """Plans batches of objects to be dereferenced by a task each, given lists of objects from the same origin
+
+    The objects from an origin with at least ``batch_size`` of them are split between as many batches as needed to
+    keep them to ``batch_size``, but no more than ``concurrency``, so as not to overwhelm the origin. Objects from
+    smaller origins are put together in batches of ``batch_size``.
+    """
+    batches: typing.List[typing.Sequence[ObjectVersion]] = []
+    leftovers: typing.List[ObjectVersion] = []
+    for object_versions in by_origin:
+        if len(object_versions) >= batch_size:
+            batch_count = min(concurrency, -(-len(object_versions) // batch_size))
+            origin_batch_size = -(-len(object_versions) // batch_count)
+            batches.extend(
+                object_versions[i : i + origin_batch_size]
+                for i in range(0, len(object_versions), origin_batch_size)
+            )
+        else:
+            leftovers.extend(object_versions)
+    batches.extend(
+        leftovers[i : i + batch_size] for i in range(0, len(leftovers), batch_size)
+    )
+    return batches
 
 
 class SegmentedUploadRecord(Record):
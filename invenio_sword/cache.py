@@ -0,0 +1,186 @@
+"""A cache of by-reference downloads, so that a file referenced by many deposits is only downloaded once
+
+Each cached download is an object version in a bucket of its own, keyed on a hash of its URL and sharing its
+:class:`FileInstance` with the deposits that referenced it. The validators of the original response are kept as tags,
+and are used to revalidate the entry before it's used again.
+"""
+import datetime
+import hashlib
+import logging
+from typing import Optional
+
+import urllib3
+from flask import current_app
+from invenio_db import db
+from invenio_files_rest.models import Bucket
+from invenio_files_rest.models import BucketTag
+from invenio_files_rest.models import FileInstance
+from invenio_files_rest.models import ObjectVersion
+from invenio_files_rest.models import ObjectVersionTag
+from sqlalchemy import true
+
+from .download import MAX_REDIRECTS
+from .download import get_pool_manager
+from .enum import ObjectTagKey
+from .utils import TagManager
+
+__all__ = ["add_to_cache", "evict", "get_cached_file"]
+
+logger = logging.getLogger(__name__)
+
+#: Marks the bucket holding the cache
+CACHE_BUCKET_TAG = "invenio_sword.dereferenceCache"
+
+
+def is_enabled() -> bool:
+    return current_app.config["SWORD_DEREFERENCE_CACHE_MAX_SIZE"] is not None
+
+
+def get_cache_bucket(create: bool = False) -> Optional[Bucket]:
+    bucket_tag = (
+        BucketTag.query.filter_by(key=CACHE_BUCKET_TAG, value="true")
+        .order_by(BucketTag.bucket_id)
+        .first()
+    )
+    if bucket_tag:
+        return bucket_tag.bucket
+    elif create:
+        bucket = Bucket.create()
+        BucketTag.create(bucket, CACHE_BUCKET_TAG, "true")
+        return bucket
+    return None
+
+
+def cache_key(url: str) -> str:
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def now() -> str:
+    # A fixed-width format, so that tag values sort in time order
+    return datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def get_cached_file(url: str, size: int = None) -> Optional[FileInstance]:
+    """Returns the cached download of ``url``, if there is one and the server says it's still current
+
+    If ``size`` is given, the cached file must also be that size.
+    """
+    if not is_enabled():
+        return None
+    bucket = get_cache_bucket()
+    entry = bucket and ObjectVersion.get(bucket, cache_key(url))
+    if not entry or not entry.file:
+        return None
+
+    tags = TagManager(entry)
+    if tags.get(ObjectTagKey.ByReferenceURL) != url:
+        return None
+    if size is not None and entry.file.size != size:
+        logger.info("Cached download of %s is the wrong size", url)
+        return None
+    if not revalidate(
+        url,
+        etag=str(tags.get(ObjectTagKey.ByReferenceETag, "")) or None,
+        last_modified=str(tags.get(ObjectTagKey.ByReferenceLastModified, "")) or None,
+    ):
+        logger.info("Cached download of %s is stale", url)
+        return None
+
+    tags[ObjectTagKey.DereferenceCacheLastUsed] = now()
+    return entry.file
+
+
+def revalidate(url: str, etag: str = None, last_modified: str = None) -> bool:
+    """Makes a conditional request for ``url``, returning whether the server says it's unchanged"""
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    if not headers:
+        return False
+
+    try:
+        response = get_pool_manager().request(
+            "GET",
+            url,
+            headers=headers,
+            timeout=current_app.config["SWORD_DOWNLOAD_TIMEOUT"],
+            retries=urllib3.Retry(
+                total=MAX_REDIRECTS, connect=0, read=0, status=0, redirect=MAX_REDIRECTS
+            ),
+            preload_content=False,
+        )
+    except Exception:
+        # The download proper will retry, and report the error if it persists
+        logger.warning("Failed to revalidate cached download of %s", url, exc_info=True)
+        return False
+    if response.status != 304:
+        response.close()
+    response.release_conn()
+    return response.status == 304
+
+
+def add_to_cache(
+    url: str, file_instance: FileInstance, etag: str = None, last_modified: str = None
+) -> None:
+    """Caches a completed download of ``url``, evicting older entries to make room
+
+    Downloads without an ``ETag`` or ``Last-Modified`` aren't cached, as they can't be revalidated.
+    """
+    if not is_enabled() or not (etag or last_modified):
+        return
+    bucket = get_cache_bucket(create=True)
+    key = cache_key(url)
+    existing = ObjectVersion.get(bucket, key)
+    if existing:
+        remove_entry(existing)
+
+    entry = ObjectVersion.create(bucket, key, _file_id=file_instance.id)
+    tags = TagManager(entry)
+    tags[ObjectTagKey.ByReferenceURL] = url
+    tags[ObjectTagKey.DereferenceCacheLastUsed] = now()
+    if etag:
+        tags[ObjectTagKey.ByReferenceETag] = etag
+    if last_modified:
+        tags[ObjectTagKey.ByReferenceLastModified] = last_modified
+
+    evict(bucket)
+
+
+def evict(bucket: Bucket) -> None:
+    """Removes the least recently used entries until the cache is within ``SWORD_DEREFERENCE_CACHE_MAX_SIZE`` bytes
+
+    Files are only deleted from storage once no deposit refers to them.
+    """
+    max_size = current_app.config["SWORD_DEREFERENCE_CACHE_MAX_SIZE"]
+    entries = (
+        db.session.query(ObjectVersion, FileInstance.size)
+        .join(FileInstance, ObjectVersion.file_id == FileInstance.id)
+        .outerjoin(
+            ObjectVersionTag,
+            db.and_(
+                ObjectVersionTag.version_id == ObjectVersion.version_id,
+                ObjectVersionTag.key == ObjectTagKey.DereferenceCacheLastUsed.value,
+            ),
+        )
+        .filter(ObjectVersion.bucket_id == bucket.id, ObjectVersion.is_head == true())
+        .order_by(ObjectVersionTag.value.desc())
+    )
+
+    total_size = 0
+    for entry, size in entries.all():
+        total_size += size
+        if total_size <= max_size:
+            continue
+        logger.info("Evicting %s from the dereference cache", entry.key)
+        remove_entry(entry)
+
+
+def remove_entry(entry: ObjectVersion) -> None:
+    file_instance = entry.file
+    ObjectVersionTag.delete(entry)
+    entry.remove()
+    if not ObjectVersion.query.filter_by(file_id=file_instance.id).count():
+        file_instance.delete()
+        file_instance.storage().delete()
@@ -1,4 +1,8 @@
+from typing import Any
+from typing import Callable
 from typing import Dict
+from typing import Optional
+from typing import Union
 
 import pkg_resources
 from invenio_deposit.config import DEPOSIT_REST_ENDPOINTS
@@ -11,6 +15,77 @@ from .typing import SwordEndpointDefinition
 SWORD_MAX_UPLOAD_SIZE = 1024 ** 3  # 1 GiB
 SWORD_MAX_BY_REFERENCE_SIZE = 10 * 1024 ** 3  # 10 GiB
 
+# Socket timeout for by-reference downloads, in seconds
+SWORD_DOWNLOAD_TIMEOUT = 60
+# Times to retry a by-reference download after a transient error, resuming where it left off
+SWORD_DOWNLOAD_RETRIES = 5
+# Seconds to wait before the first retry, doubling for each retry after, up to the maximum
+SWORD_DOWNLOAD_BACKOFF = 1
+SWORD_DOWNLOAD_MAX_BACKOFF = 60
+# Commit download progress every this many bytes, so that a retried task can resume
+SWORD_DOWNLOAD_CHECKPOINT_INTERVAL = 64 * 1024 ** 2  # 64 MiB
+
+# By-reference downloads from a single host are shared between at most this many tasks per deposit, and each worker
+# process keeps at most this many connections open to the host
+SWORD_DEREFERENCE_HOST_CONCURRENCY = 4
+# Dereference up to this many by-reference files from different origins in a single task, instead of a task each
+SWORD_DEREFERENCE_BATCH_SIZE = 1
+# Maximum bytes per second downloaded from a single host by each worker process, or None for no limit
+SWORD_DEREFERENCE_HOST_BANDWIDTH: Optional[int] = None
+
+# Cache by-reference downloads, so that files referenced from several deposits are only downloaded once. Set to the
+# maximum total size of cached files in bytes, or None to disable the cache.
+SWORD_DEREFERENCE_CACHE_MAX_SIZE: Optional[int] = None
+
+# Download and unpack by-reference files in a single task and a single pass, where their packaging allows
+SWORD_STREAMING_DEREFERENCE = True
+
+# Deposits up to this size are unpacked during the request where their packaging supports it, instead of in a task
+SWORD_SHORTCUT_UNPACK_MAX_SIZE = 10 * 1024 ** 2  # 10 MiB
+
+# The number of unpacked files to write to the database with each multi-row INSERT
+SWORD_BULK_INSERT_BATCH_SIZE = 1000
+# The number of files to delete in each transaction when a deposit replaces an earlier one
+SWORD_DELETE_BATCH_SIZE = 1000
+
+# Tasks report how many bytes they've downloaded and archive members they've unpacked at most this often, in seconds.
+# Progress is kept in the Celery result backend, and shown for each file in a deposit's status.
+SWORD_PROGRESS_INTERVAL = 0.5
+
+# The longest a client may wait, in seconds, for a deposit's status to change, when it sends Prefer: wait=<seconds>
+# with If-None-Match. Waiting clients are woken through Celery's broker when the deposit's files change.
+SWORD_STATUS_MAX_WAIT = 60
+
+# Unpacking tasks and the tasks that delete replaced files take a lock on the deposit's bucket, so that they don't
+# contend for the same rows. A task that finds the bucket locked is retried after this many seconds.
+SWORD_BUCKET_LOCK_RETRY_DELAY = 5
+# Locks held for longer than this many seconds are assumed to have been left by a task whose worker died, and can be
+# taken over. This should be longer than it takes to unpack your largest deposits.
+SWORD_BUCKET_LOCK_TIMEOUT = 6 * 60 * 60
+
+# Unpacking tasks commit their progress after this many SimpleZip members, and resume from there if they're re-run
+SWORD_UNPACK_CHECKPOINT_INTERVAL = 1000
+
+# Split SimpleZip archives with more members than this into chunks, each unpacked by its own task. None disables this.
+SWORD_UNPACK_CHUNK_SIZE: Optional[int] = None
+
+# Reuse the stored contents of SimpleZip members that are unchanged since the previous deposit, judged by CRC-32 and size
+SWORD_INCREMENTAL_UNPACK = False
+# Also decompress such members and compare their MD5 checksums, guarding against CRC-32 collisions
+SWORD_INCREMENTAL_UNPACK_VERIFY_CHECKSUM = False
+
+# Read archives straight from storage when the backend supports seeking, instead of copying them to a temporary file
+SWORD_UNPACK_FROM_STORAGE = True
+# The number of threads used to decompress and store archive members. 1 unpacks archives serially.
+SWORD_UNPACK_WORKERS = 1
+# The number of threads used to store and hash BagIt payload files. None uses one per CPU.
+SWORD_FIXITY_WORKERS = None
+# Options for queuing deferred BagIt fixity checks, e.g. {"queue": "fixity", "priority": 0}
+SWORD_FIXITY_TASK_OPTIONS: Dict[str, Any] = {}
+# Called with an invenio_sword.routing.TaskRoute for each dereference or unpack task queued by a deposit, returning
+# options such as {"queue": "bulk"}. May be an import path. None sends every task to the default queue.
+SWORD_TASK_ROUTER: Optional[Union[str, Callable[..., Optional[Dict[str, Any]]]]] = None
+
 _PID = 'pid(depid,record_class="invenio_sword.api:SWORDDeposit")'
 
 SWORD_ENDPOINTS: Dict[str, SwordEndpointDefinition] = {
@@ -47,6 +122,8 @@ SWORD_ENDPOINTS: Dict[str, SwordEndpointDefinition] = {
         "dereference_policy": (
             lambda object_version, by_reference_file: by_reference_file.dereference
         ),
+        # BagIt
+        "bagit_deferred_fixity": False,
     }
     for name, options in DEPOSIT_REST_ENDPOINTS.items()
 }
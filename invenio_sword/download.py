@@ -0,0 +1,466 @@
+"""Fetching by-reference files over HTTP, with retries and resumption"""
+import http.client
+import logging
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import uuid
+from typing import Dict
+from typing import Optional
+
+import urllib3
+from flask import current_app
+from invenio_db import db
+from invenio_files_rest.models import FileInstance
+from invenio_files_rest.models import ObjectVersion
+from invenio_files_rest.storage.base import check_sizelimit
+from sword3common.exceptions import ByReferenceFileSizeExceeded
+
+from .enum import ObjectTagKey
+from .progress import ProgressReporter
+from .streams import DEFAULT_CHUNK_SIZE
+from .streams import HashingReader
+from .streams import LimitedReader
+from .streams import ProgressReader
+from .utils import TagManager
+from .utils import check_superseded
+
+__all__ = [
+    "Download",
+    "DownloadRestarted",
+    "ResourceChanged",
+    "Throttle",
+    "discard_partial_download",
+    "download_to_object_version",
+    "get_pool_manager",
+    "get_size_limit",
+    "track_download",
+]
+
+logger = logging.getLogger(__name__)
+
+#: HTTP status codes worth retrying a request for
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+CONTENT_RANGE_RE = re.compile(r"^bytes (?P<start>\d+)-\d+/(?P<length>\d+|\*)$")
+
+#: Redirects to follow before giving up on a URL
+MAX_REDIRECTS = 10
+
+#: Tags recording the progress of a download, which are removed once it completes
+DOWNLOAD_STATE_TAGS = (
+    ObjectTagKey.ByReferencePartialFileID,
+    ObjectTagKey.ByReferenceBytesDownloaded,
+    ObjectTagKey.ByReferenceETag,
+    ObjectTagKey.ByReferenceLastModified,
+)
+
+
+class ResourceChanged(Exception):
+    """The remote resource changed part-way through a download, so the download can't be resumed"""
+
+
+class DownloadRestarted(ResourceChanged):
+    """The server sent the whole resource when asked to resume, so reading carries on from its start"""
+
+
+def is_transient(exc: BaseException) -> bool:
+    if isinstance(exc, urllib.error.HTTPError):
+        return exc.code in RETRYABLE_STATUS_CODES
+    # Includes timeouts, refused and dropped connections
+    return isinstance(
+        exc, (OSError, http.client.HTTPException, urllib3.exceptions.HTTPError)
+    )
+
+
+def get_size_limit(object_version: ObjectVersion) -> int:
+    """The most bytes that may be downloaded for a by-reference file
+
+    This is ``SWORD_MAX_BY_REFERENCE_SIZE``, or the ``contentLength`` declared by the client if that is smaller.
+    """
+    size_limit = current_app.config["SWORD_MAX_BY_REFERENCE_SIZE"]
+    content_length = TagManager(object_version).get(
+        ObjectTagKey.ByReferenceContentLength
+    )
+    if content_length is not None:
+        size_limit = min(size_limit, int(str(content_length)))
+    return size_limit
+
+
+_pool_manager: Optional[urllib3.PoolManager] = None
+_throttles: Dict[str, "Throttle"] = {}
+_lock = threading.Lock()
+
+
+def get_pool_manager() -> urllib3.PoolManager:
+    """Returns the connection pools shared by all downloads in this process
+
+    Connections are kept alive between downloads from the same host. At most ``SWORD_DEREFERENCE_HOST_CONCURRENCY``
+    connections are opened to each host, with any further downloads waiting for one to become free.
+    """
+    global _pool_manager
+    with _lock:
+        if _pool_manager is None:
+            _pool_manager = urllib3.PoolManager(
+                maxsize=current_app.config["SWORD_DEREFERENCE_HOST_CONCURRENCY"],
+                block=True,
+            )
+        return _pool_manager
+
+
+def get_throttle(url: str) -> Optional["Throttle"]:
+    """Returns the throttle shared by all downloads from the host of ``url`` in this process, if one is configured"""
+    rate = current_app.config["SWORD_DEREFERENCE_HOST_BANDWIDTH"]
+    if not rate:
+        return None
+    host = urllib.parse.urlsplit(url).netloc
+    with _lock:
+        if host not in _throttles:
+            _throttles[host] = Throttle(rate)
+        return _throttles[host]
+
+
+class Throttle:
+    """Limits the rate at which bytes are read, using a token bucket that holds up to one second's worth"""
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self._available = float(rate)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int) -> None:
+        """Accounts for ``amount`` bytes having been read, sleeping until they are within the limit"""
+        with self._lock:
+            now = time.monotonic()
+            self._available = min(
+                self.rate, self._available + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._available -= amount
+            delay = -self._available / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Download:
+    """A readable HTTP response that resumes with ``Range`` requests after transient failures
+
+    Requests are retried up to ``SWORD_DOWNLOAD_RETRIES`` times, waiting ``SWORD_DOWNLOAD_BACKOFF`` seconds before the
+    first retry and twice as long before each one after, up to ``SWORD_DOWNLOAD_MAX_BACKOFF``. Resumed requests carry
+    an ``If-Range`` header with the ``ETag`` or ``Last-Modified`` of the first response, so that a resource that has
+    since changed is sent in full instead of being spliced together. If that happens part-way through, :meth:`read`
+    raises :class:`DownloadRestarted` before returning any of it, and later reads carry on from the start.
+
+    A download can start from ``offset``, e.g. to continue one from an earlier task. If the server sends the whole
+    resource instead, :attr:`offset` is reset to zero.
+
+    Connections come from :func:`get_pool_manager`, and reads are limited by the host's :func:`get_throttle`.
+
+    If ``max_size`` is given, :class:`ByReferenceFileSizeExceeded` is raised as soon as the resource is known to be
+    larger: from its ``Content-Length`` before any of it is read, or once more than ``max_size`` bytes have been read.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        offset: int = 0,
+        etag: str = None,
+        last_modified: str = None,
+        max_size: int = None,
+    ):
+        self.url = url
+        self.max_size = max_size
+        self.offset = offset
+        #: The position in the resource of the next byte to be read
+        self.position = offset
+        self.etag = etag
+        self.last_modified = last_modified
+        #: The length of the whole resource, if known
+        self.length: Optional[int] = None
+
+        self.timeout = current_app.config["SWORD_DOWNLOAD_TIMEOUT"]
+        self.retries = current_app.config["SWORD_DOWNLOAD_RETRIES"]
+        self.backoff = current_app.config["SWORD_DOWNLOAD_BACKOFF"]
+        self.max_backoff = current_app.config["SWORD_DOWNLOAD_MAX_BACKOFF"]
+        self._pool_manager = get_pool_manager()
+        self._throttle = get_throttle(url)
+
+        self._response = self._with_retries(self._request)
+        self.offset = self.position
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        self._release(self._response)
+
+    @staticmethod
+    def _release(response: urllib3.HTTPResponse) -> None:
+        # A connection part-way through a response can't be reused, so it's closed before going back to the pool
+        if not response.isclosed():
+            response.close()
+        response.release_conn()
+
+    def read(self, amount: int = -1) -> bytes:
+        return self._with_retries(self._read, amount, resume=True)
+
+    def _read(self, amount: int) -> bytes:
+        data = self._response.read(
+            amount if amount is not None and amount >= 0 else None
+        )
+        if not data and self.length is not None and self.position < self.length:
+            raise http.client.IncompleteRead(b"", self.length - self.position)
+        self.position += len(data)
+        self._check_size(self.position)
+        if self._throttle:
+            self._throttle.consume(len(data))
+        return data
+
+    def _resume(self) -> None:
+        self._release(self._response)
+        position = self.position
+        self._response = self._request()
+        if self.position != position:
+            self.offset = 0
+            raise DownloadRestarted(
+                "{} was sent in full when resuming".format(self.url)
+            )
+
+    def _request(self):
+        headers = {}
+        if self.position:
+            headers["Range"] = "bytes={}-".format(self.position)
+            # Weak ETags can't be used with If-Range
+            if self.etag and not self.etag.startswith("W/"):
+                headers["If-Range"] = self.etag
+            elif self.last_modified:
+                headers["If-Range"] = self.last_modified
+
+        response = self._pool_manager.request(
+            "GET",
+            self.url,
+            headers=headers,
+            timeout=self.timeout,
+            # Only redirects are retried here; anything else is left to _with_retries()
+            retries=urllib3.Retry(
+                total=MAX_REDIRECTS, connect=0, read=0, status=0, redirect=MAX_REDIRECTS
+            ),
+            preload_content=False,
+            decode_content=False,
+        )
+        if response.status >= 400:
+            self._release(response)
+            raise urllib.error.HTTPError(
+                self.url, response.status, response.reason, response.headers, None
+            )
+
+        content_range = CONTENT_RANGE_RE.match(
+            response.headers.get("Content-Range", "")
+        )
+        if response.status == 206 and content_range:
+            if int(content_range.group("start")) != self.position:
+                self._release(response)
+                raise ResourceChanged(
+                    "{} returned an unexpected range".format(self.url)
+                )
+            if content_range.group("length") != "*":
+                self.length = int(content_range.group("length"))
+        else:
+            # We've been sent the whole resource
+            self.position = 0
+            content_length = response.headers.get("Content-Length")
+            self.length = int(content_length) if content_length else None
+
+        if self.length is not None:
+            try:
+                self._check_size(self.length)
+            except ByReferenceFileSizeExceeded:
+                self._release(response)
+                raise
+
+        etag = response.headers.get("ETag")
+        if self.position and self.etag and etag and etag != self.etag:
+            self._release(response)
+            raise ResourceChanged("{} changed while being downloaded".format(self.url))
+        self.etag = etag or self.etag
+        self.last_modified = response.headers.get("Last-Modified") or (
+            self.last_modified
+        )
+        return response
+
+    def _check_size(self, size: int) -> None:
+        if self.max_size is not None and size > self.max_size:
+            raise ByReferenceFileSizeExceeded(
+                "{} is larger than the limit of {} bytes".format(
+                    self.url, self.max_size
+                )
+            )
+
+    def _with_retries(self, func, *args, resume=False):
+        attempt = 0
+        while True:
+            try:
+                if attempt and resume:
+                    self._resume()
+                return func(*args)
+            except Exception as e:
+                if not is_transient(e) or attempt >= self.retries:
+                    raise
+                delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+                logger.warning(
+                    "Error downloading %s at byte %d; retrying in %ss",
+                    self.url,
+                    self.position,
+                    delay,
+                    exc_info=True,
+                )
+                time.sleep(delay)
+                attempt += 1
+
+
+def download_to_object_version(
+    object_version: ObjectVersion, url: str, progress: ProgressReporter = None
+) -> Download:
+    """Downloads ``url`` as the contents of ``object_version``, returning the finished :class:`Download`
+
+    Progress is committed every ``SWORD_DOWNLOAD_CHECKPOINT_INTERVAL`` bytes, so that if the task is run again, it
+    carries on from there instead of starting again. At each checkpoint, :class:`Superseded` is raised if a later
+    deposit has replaced ``object_version``. The file is only attached to ``object_version`` once complete, and is
+    discarded if the download fails.
+
+    If ``progress`` is given, the bytes downloaded so far are reported to it as ``bytesTransferred``.
+    """
+    tags = TagManager(object_version)
+    bucket = object_version.bucket
+    size_limit = bucket.size_limit
+
+    def create_file(download: Download) -> FileInstance:
+        file_instance = FileInstance.create()
+        file_instance.init_contents(
+            default_location=bucket.location.uri,
+            default_storage_class=bucket.default_storage_class,
+        )
+        tags[ObjectTagKey.ByReferencePartialFileID] = str(file_instance.id)
+        for tag_key, value in [
+            (ObjectTagKey.ByReferenceETag, download.etag),
+            (ObjectTagKey.ByReferenceLastModified, download.last_modified),
+        ]:
+            if value:
+                tags[tag_key] = value
+        return file_instance
+
+    file_instance = None
+    if ObjectTagKey.ByReferencePartialFileID in tags:
+        file_instance = FileInstance.query.get(
+            uuid.UUID(str(tags[ObjectTagKey.ByReferencePartialFileID]))
+        )
+
+    try:
+        with Download(
+            url,
+            offset=int(str(tags.get(ObjectTagKey.ByReferenceBytesDownloaded, 0)))
+            if file_instance
+            else 0,
+            etag=str(tags.get(ObjectTagKey.ByReferenceETag, "")) or None,
+            last_modified=str(tags.get(ObjectTagKey.ByReferenceLastModified, ""))
+            or None,
+            max_size=get_size_limit(object_version),
+        ) as download:
+            if file_instance and download.offset == 0:
+                logger.info("Could not resume download of %s; starting again", url)
+                _delete_file(file_instance)
+                file_instance = None
+            elif file_instance:
+                logger.info("Resuming download of %s at byte %d", url, download.offset)
+
+            if file_instance is None:
+                file_instance = create_file(download)
+
+            reader = track_download(download, progress)
+            hashing_reader = None
+            if download.offset == 0:
+                # Hash the whole file as it's written, as update_checksum() would, instead of reading it back. Resumed
+                # downloads don't see the start of the file, so are left to update_checksum().
+                algorithm, _ = file_instance.storage()._init_hash()
+                hashing_reader = HashingReader(reader, [algorithm])
+            interval = current_app.config["SWORD_DOWNLOAD_CHECKPOINT_INTERVAL"]
+            while True:
+                try:
+                    bytes_written, _ = file_instance.update_contents(
+                        LimitedReader(hashing_reader or reader, interval),
+                        seek=download.position,
+                    )
+                except DownloadRestarted:
+                    # What we have may not match what's being sent now, so it's written again from the start
+                    logger.info("Restarting download of %s", url)
+                    _delete_file(file_instance)
+                    file_instance = create_file(download)
+                    algorithm, _ = file_instance.storage()._init_hash()
+                    hashing_reader = HashingReader(reader, [algorithm])
+                    continue
+                check_sizelimit(size_limit, download.position, None)
+                tags[ObjectTagKey.ByReferenceBytesDownloaded] = str(download.position)
+                db.session.commit()
+                if bytes_written < interval:
+                    break
+                check_superseded(object_version)
+    except Exception:
+        # The task gives up on any error, so there's no point keeping what we have. A worker that dies leaves it for
+        # the redelivered task to resume.
+        discard_partial_download(object_version)
+        raise
+
+    file_instance.size = download.position
+    file_instance.readable = True
+    file_instance.writable = False
+    if hashing_reader:
+        file_instance.checksum = "{}:{}".format(
+            algorithm, hashing_reader.digests[algorithm]
+        )
+    else:
+        file_instance.update_checksum()
+    object_version.set_file(file_instance)
+    for tag_key in DOWNLOAD_STATE_TAGS:
+        if tag_key in tags:
+            del tags[tag_key]
+    return download
+
+
+def discard_partial_download(object_version: ObjectVersion) -> None:
+    """Deletes any partly-downloaded file for ``object_version``, along with the tags recording its progress"""
+    tags = TagManager(object_version)
+    if ObjectTagKey.ByReferencePartialFileID in tags:
+        _delete_file(
+            FileInstance.query.get(
+                uuid.UUID(str(tags[ObjectTagKey.ByReferencePartialFileID]))
+            )
+        )
+    for tag_key in DOWNLOAD_STATE_TAGS:
+        if tag_key in tags:
+            del tags[tag_key]
+
+
+def _delete_file(file_instance: Optional[FileInstance]) -> None:
+    if file_instance is not None:
+        file_instance.storage().delete()
+        # Only flushed objects can be deleted, and the file may have only just been created
+        db.session.flush()
+        db.session.delete(file_instance)
+
+
+def track_download(download: Download, progress: Optional[ProgressReporter]):
+    """Wraps ``download`` to report the bytes read from it to ``progress``, if given"""
+    if progress is None:
+        return download
+
+    def report(_):
+        progress.update(bytesTransferred=download.position, totalBytes=download.length)
+
+    report(None)
+    return ProgressReader(download, report, DEFAULT_CHUNK_SIZE)
@@ -8,11 +8,31 @@ class ObjectTagKey(enum.Enum):
     Packaging = "invenio_sword.packaging"
     MetadataFormat = "invenio_sword.metadataFormat"
     FileState = "invenio_sword.fileState"
+    # Identifies the deposit request an object version was created by, so that objects from earlier deposits can be
+    # replaced. These sort in the order they were created.
+    Generation = "invenio_sword.generation"
+    # The CRC-32 of the archive member an object version was unpacked from, as eight hex digits
+    ArchiveMemberCRC32 = "invenio_sword.archiveMemberCRC32"
+    # The IDs of the Celery tasks queued to process an object version, separated by spaces, so they can be revoked
+    TaskIDs = "invenio_sword.taskIDs"
+    # Those of the tasks above that report their progress, which are looked up to show it
+    ProgressTaskIDs = "invenio_sword.progressTaskIDs"
+    # The generation of the deposit that replaced an object version while it was still being processed
+    SupersededBy = "invenio_sword.supersededBy"
+    # The number of archive members unpacked and committed so far, for resuming an interrupted unpack
+    UnpackCheckpoint = "invenio_sword.unpackCheckpoint"
     ByReferenceURL = "invenio_sword.byReferenceURL"
     ByReferenceTemporaryID = "invenio_sword.byReferenceTemporaryID"
     ByReferenceDereference = "invenio_sword.byReferenceDereference"
     ByReferenceTTL = "invenio_sword.byReferenceTTL"
     ByReferenceContentLength = "invenio_sword.byReferenceContentLength"
+    # The state of an interrupted download, so that it can be resumed
+    ByReferencePartialFileID = "invenio_sword.byReferencePartialFileID"
+    ByReferenceBytesDownloaded = "invenio_sword.byReferenceBytesDownloaded"
+    ByReferenceETag = "invenio_sword.byReferenceETag"
+    ByReferenceLastModified = "invenio_sword.byReferenceLastModified"
+    # When an entry in the dereference cache was last used, for evicting the least recently used
+    DereferenceCacheLastUsed = "invenio_sword.dereferenceCacheLastUsed"
     # Used to mark an object version as extent, even though it's not got a file.
     ByReferenceNotDeleted = "invenio_sword.byReferenceNotDeleted"
 
@@ -0,0 +1,162 @@
+"""Serializes the tasks that modify a deposit's bucket, while letting different deposits be processed in parallel
+
+The lock is a :class:`BucketTag` naming the task that holds it and when it expires. Creating the tag succeeds for only
+one task at a time, as the bucket ID and key are its primary key. A task that can't take the lock is retried after
+``SWORD_BUCKET_LOCK_RETRY_DELAY`` seconds, instead of contending with the holder for the same rows. Locks left behind
+by tasks whose workers died are taken over once they expire, after ``SWORD_BUCKET_LOCK_TIMEOUT`` seconds.
+
+A task can hand its lock over to the tasks it queues, e.g. :func:`invenio_sword.tasks.unpack_object` to the chunks of
+a large archive, which act as the same owner. The last of them releases it.
+"""
+import contextlib
+import datetime
+import logging
+import time
+import uuid
+from typing import Collection
+from typing import Iterator
+from typing import Optional
+
+import celery
+from flask import current_app
+from invenio_db import db
+from invenio_files_rest.models import BucketTag
+from sqlalchemy.exc import IntegrityError
+
+__all__ = [
+    "BucketLock",
+    "acquire_bucket_lock",
+    "break_bucket_lock",
+    "bucket_lock",
+    "release_bucket_lock",
+]
+
+logger = logging.getLogger(__name__)
+
+#: The key of the tag holding the lock on a bucket
+LOCK_TAG = "invenio_sword.taskLock"
+
+
+def _expiry(timestamp: datetime.datetime) -> str:
+    # A fixed-width format, so that expiry times can be compared as strings
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def acquire_bucket_lock(bucket_id, owner: str) -> bool:
+    """Tries to lock a bucket for ``owner``, returning whether it succeeded
+
+    An owner that already holds the lock re-acquires it, e.g. when a task is redelivered after its worker died. This
+    commits the session.
+    """
+    now = datetime.datetime.utcnow()
+    value = "{} {}".format(
+        owner,
+        _expiry(
+            now
+            + datetime.timedelta(
+                seconds=current_app.config["SWORD_BUCKET_LOCK_TIMEOUT"]
+            )
+        ),
+    )
+    try:
+        with db.session.begin_nested():
+            db.session.add(BucketTag(bucket_id=bucket_id, key=LOCK_TAG, value=value))
+    except IntegrityError:
+        lock = BucketTag.query.filter_by(bucket_id=bucket_id, key=LOCK_TAG).first()
+        if lock is None:
+            # Released in the meantime, so try again later rather than racing for it
+            return False
+        holder, expiry = lock.value.split(" ")
+        if holder != owner and expiry > _expiry(now):
+            return False
+        # Only take it over if nobody else has done so first
+        taken = BucketTag.query.filter_by(
+            bucket_id=bucket_id, key=LOCK_TAG, value=lock.value
+        ).update({BucketTag.value: value}, synchronize_session=False)
+        if not taken:
+            return False
+        if holder != owner:
+            logger.warning(
+                "Took over expired lock on bucket %s from %s", bucket_id, holder
+            )
+    db.session.commit()
+    return True
+
+
+def release_bucket_lock(bucket_id, owner: str) -> None:
+    """Releases ``owner``'s lock on a bucket, if it still holds it, and commits the session"""
+    BucketTag.query.filter(
+        BucketTag.bucket_id == bucket_id,
+        BucketTag.key == LOCK_TAG,
+        BucketTag.value.like("{} %".format(owner)),
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def break_bucket_lock(bucket_id, owners: Collection[str]) -> None:
+    """Releases the lock on a bucket if any of ``owners`` holds it, without committing
+
+    This is for when those tasks have been revoked, and so won't release it themselves.
+    """
+    lock = BucketTag.query.filter_by(bucket_id=bucket_id, key=LOCK_TAG).first()
+    if lock is not None and lock.value.split(" ")[0] in owners:
+        logger.info("Releasing lock on bucket %s held by revoked tasks", bucket_id)
+        db.session.delete(lock)
+
+
+class BucketLock:
+    """A lock held by :func:`bucket_lock`"""
+
+    def __init__(self, owner: Optional[str]):
+        #: The owner of the lock, or ``None`` where the task isn't serialized
+        self.owner = owner
+        self.handed_over = False
+
+    def hand_over(self) -> Optional[str]:
+        """Keeps the lock once the ``with`` block exits, and returns its owner
+
+        The tasks queued to carry on the work should take the lock as the same owner, and the last of them should
+        release it with :func:`release_bucket_lock`.
+        """
+        self.handed_over = True
+        return self.owner
+
+
+@contextlib.contextmanager
+def bucket_lock(task: celery.Task, bucket_id) -> Iterator[BucketLock]:
+    """Holds the lock on a bucket while ``task`` modifies it
+
+    If another task holds the lock, ``task`` is retried later, so it should be declared with ``max_retries=None``.
+    Where the task has been called directly from within another task, e.g. by
+    :func:`invenio_sword.tasks.dereference_objects`, it can't be retried on its own, so this waits for the lock
+    instead. Calls made outside of any task, such as the quick deletions made during a request, are not serialized.
+
+    The lock is released when the ``with`` block exits, unless it has been handed over with :meth:`BucketLock.hand_over`.
+    """
+    if task.request.called_directly:
+        if task.app.current_worker_task is None:
+            yield BucketLock(None)
+            return
+        owner = str(uuid.uuid4())
+        while not acquire_bucket_lock(bucket_id, owner):
+            time.sleep(current_app.config["SWORD_BUCKET_LOCK_RETRY_DELAY"])
+    else:
+        owner = task.request.id
+        if not acquire_bucket_lock(bucket_id, owner):
+            logger.info(
+                "Bucket %s is locked by another task; retrying %s", bucket_id, owner
+            )
+            raise task.retry(
+                countdown=current_app.config["SWORD_BUCKET_LOCK_RETRY_DELAY"]
+            )
+
+    lock = BucketLock(owner)
+    try:
+        yield lock
+    finally:
+        if not lock.handed_over:
+            try:
+                release_bucket_lock(bucket_id, owner)
+            except Exception:
+                # It'll be taken over once it expires
+                logger.exception("Failed to release lock on bucket %s", bucket_id)
@@ -0,0 +1,140 @@
+"""Wakes status requests that are waiting for a deposit to change, e.g. for its files to be ingested
+
+Once a change to a deposit's files has been committed, a message routed by the deposit's bucket ID is published to a
+topic exchange on Celery's broker. Each waiting request consumes from a queue of its own, bound to the bucket it's
+waiting on, so it's woken as soon as something changes instead of polling the database. Messages aren't kept, so a
+request must subscribe before it reads the state it's waiting to change.
+"""
+import contextlib
+import functools
+import logging
+import socket
+import time
+import uuid
+from typing import ContextManager
+from typing import Iterator
+from typing import Optional
+
+import celery
+import kombu
+from invenio_db import db
+
+from .outbox import call_on_commit
+
+__all__ = ["notify", "notify_on_commit", "subscribe"]
+
+logger = logging.getLogger(__name__)
+
+#: The exchange that change notifications are published to
+EXCHANGE = kombu.Exchange("invenio_sword.changes", type="topic", durable=False)
+
+
+def get_connection() -> kombu.Connection:
+    return celery.current_app.connection_for_write()
+
+
+def get_producer() -> ContextManager[kombu.Producer]:
+    """Acquires a producer from Celery's pool, whose connections are kept open between notifications"""
+    return celery.current_app.producer_or_acquire()
+
+
+def notify(bucket_id) -> None:
+    """Wakes any requests waiting on changes to ``bucket_id``"""
+    try:
+        with get_producer() as producer:
+            # Only try once, rather than holding up the caller while the broker is down. This does nothing if the
+            # pooled connection is already open.
+            producer.connection.connect()
+            producer.publish(
+                {"bucket": str(bucket_id)},
+                exchange=EXCHANGE,
+                routing_key=str(bucket_id),
+                declare=[EXCHANGE],
+                serializer="json",
+            )
+    except Exception:
+        logger.warning(
+            "Failed to notify changes to bucket %s", bucket_id, exc_info=True
+        )
+
+
+def notify_on_commit(bucket_id) -> None:
+    """Calls :func:`notify` once the current transaction commits, once for each bucket"""
+    call_on_commit(
+        functools.partial(notify, bucket_id),
+        session=db.session(),
+        key=("invenio_sword.notify", str(bucket_id)),
+    )
+
+
+class Subscription:
+    """Receives the notifications for a bucket, from when it's created until it's closed"""
+
+    def __init__(self, connection: kombu.Connection, bucket_id):
+        self.connection = connection
+        self.notified = False
+        self.channel = connection.channel()
+        queue = kombu.Queue(
+            "invenio_sword.changes.{}".format(uuid.uuid4()),
+            exchange=EXCHANGE,
+            routing_key=str(bucket_id),
+            durable=False,
+            exclusive=True,
+            auto_delete=True,
+        )
+        self.consumer = kombu.Consumer(
+            self.channel,
+            queues=[queue],
+            callbacks=[self._on_message],
+            accept=["json"],
+            no_ack=True,
+        )
+        self.consumer.consume()
+
+    def _on_message(self, body, message) -> None:
+        self.notified = True
+
+    def wait(self, timeout: float) -> bool:
+        """Waits up to ``timeout`` seconds for a notification, returning whether there was one
+
+        Each call waits for a notification after those already received.
+        """
+        self.notified = False
+        deadline = time.monotonic() + timeout
+        while not self.notified:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                self.connection.drain_events(timeout=remaining)
+            except socket.timeout:
+                break
+        return self.notified
+
+    def close(self) -> None:
+        try:
+            self.consumer.cancel()
+            self.channel.close()
+        finally:
+            self.connection.release()
+
+
+@contextlib.contextmanager
+def subscribe(bucket_id) -> Iterator[Optional[Subscription]]:
+    """Yields a :class:`Subscription` to changes to ``bucket_id``, or ``None`` if the broker can't be reached"""
+    connection = get_connection()
+    try:
+        connection.connect()
+        subscription = Subscription(connection, bucket_id)
+    except Exception:
+        logger.warning(
+            "Failed to subscribe to changes to bucket %s", bucket_id, exc_info=True
+        )
+        connection.release()
+        yield None
+        return
+
+    try:
+        yield subscription
+    finally:
+        subscription.close()
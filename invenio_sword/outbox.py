@@ -0,0 +1,82 @@
+"""Queues Celery tasks until the database transaction that prepared their work has been committed
+
+Tasks queued during a request would otherwise be able to start before the request's changes are visible to them. With
+:func:`delay_on_commit`, signatures are held on the session and sent once its outermost transaction commits. They are
+discarded if the transaction is rolled back, as are those queued within a savepoint that is rolled back.
+"""
+import logging
+from typing import Any
+from typing import Callable
+from typing import Hashable
+
+from celery.canvas import Signature
+from invenio_db import db
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+__all__ = ["call_on_commit", "delay_on_commit"]
+
+logger = logging.getLogger(__name__)
+
+#: Key in ``Session.info`` for the calls waiting for the session to commit
+PENDING_KEY = "invenio_sword.pendingTasks"
+#: Key in ``Session.info`` for the number of calls pending when each savepoint began
+SAVEPOINTS_KEY = "invenio_sword.pendingTaskSavepoints"
+
+
+def delay_on_commit(signature: Signature, session: Session = None) -> None:
+    """Sends ``signature`` to the broker once the current transaction commits"""
+    call_on_commit(signature.delay, session)
+
+
+def call_on_commit(
+    func: Callable[[], Any], session: Session = None, key: Hashable = None
+) -> None:
+    """Calls ``func`` once the current transaction commits, e.g. to revoke tasks
+
+    If ``key`` is given, ``func`` isn't added if a call with the same key is already pending.
+    """
+    session = session or db.session()
+    pending = session.info.setdefault(PENDING_KEY, [])
+    if key is not None and any(key == pending_key for pending_key, _ in pending):
+        return
+    pending.append((key, func))
+
+
+@event.listens_for(Session, "after_transaction_create")
+def _after_transaction_create(session, transaction):
+    if transaction.nested:
+        session.info.setdefault(SAVEPOINTS_KEY, {})[transaction] = len(
+            session.info.get(PENDING_KEY, ())
+        )
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _after_transaction_end(session, transaction):
+    session.info.get(SAVEPOINTS_KEY, {}).pop(transaction, None)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _after_soft_rollback(session, previous_transaction):
+    pending = session.info.get(PENDING_KEY)
+    if not pending:
+        return
+    if previous_transaction.nested:
+        # Only discard what was queued since the savepoint began
+        mark = session.info.get(SAVEPOINTS_KEY, {}).get(previous_transaction)
+        if mark is not None:
+            del pending[mark:]
+    else:
+        pending.clear()
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    # Only called when the outermost transaction commits, not for savepoints
+    pending = session.info.pop(PENDING_KEY, [])
+    for _, func in pending:
+        try:
+            func()
+        except Exception:
+            # The changes are committed either way, so carry on with the others
+            logger.exception("Failed to call %r after commit", func)
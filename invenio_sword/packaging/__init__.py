@@ -1,11 +1,13 @@
 from .bagit import SWORDBagItPackaging
 from .base import Packaging
 from .binary import BinaryPackaging
+from .tar import SimpleTarPackaging
 from .zip import SimpleZipPackaging
 
 __all__ = [
     "BinaryPackaging",
     "Packaging",
     "SWORDBagItPackaging",
+    "SimpleTarPackaging",
     "SimpleZipPackaging",
 ]
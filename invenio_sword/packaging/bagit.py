@@ -1,29 +1,277 @@
 from __future__ import annotations
 
+import concurrent.futures
+import hashlib
+import io
+import logging
 import mimetypes
 import os
-import shutil
-import tempfile
+import posixpath
+import re
 import uuid
 import zipfile
+from typing import Collection
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Set
+from typing import Tuple
+from typing import Union
 
-import bagit
+from flask import current_app
 from invenio_files_rest.models import ObjectVersion
 from sword3common.constants import PackagingFormat
 from sword3common.exceptions import ContentMalformed
 from sword3common.exceptions import ContentTypeNotAcceptable
 from sword3common.exceptions import ValidationFailed
 
+from ..enum import FileState
 from ..enum import ObjectTagKey
 from ..metadata import SWORDMetadata
+from ..streams import digest_stream
 from ..utils import TagManager
 from .base import Packaging
+from .zip import store_zip_members
 
-__all__ = ["SWORDBagItPackaging"]
+__all__ = [
+    "SWORDBagItPackaging",
+    "ZipBag",
+    "format_failures",
+    "get_fixity_workers",
+]
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_RE = re.compile(r"^(tag)?manifest-([a-z0-9]+)\.txt$")
+# Manifests only percent-encode CR, LF and % in paths (RFC 8493 §2.1.3), so other sequences are left as they are
+PERCENT_ENCODED_RE = re.compile(r"%(0D|0A|25)", re.IGNORECASE)
+SUPPORTED_ALGORITHMS = {"md5", "sha1", "sha224", "sha256", "sha384", "sha512"}
+
+
+class ZipBag:
+    """A BagIt bag read directly from a zip archive
+
+    Only the tag files are read when the bag is opened. Payload files are left in the archive, so that they can be
+    hashed as they are streamed elsewhere, and checked afterwards using :meth:`verify_payload`.
+
+    :raises ContentMalformed: if the archive isn't recognisably a bag
+    """
+
+    def __init__(self, zip: zipfile.ZipFile):
+        self.zip = zip
+        self.members = {
+            info.filename: info for info in zip.infolist() if not info.is_dir()
+        }
+
+        if "bagit.txt" not in self.members:
+            raise ContentMalformed("Expected bagit.txt does not exist")
+        declaration = self._read_tag_file("bagit.txt", "utf-8-sig")
+        try:
+            self.version = declaration["BagIt-Version"]
+            encoding = declaration["Tag-File-Character-Encoding"]
+        except KeyError as e:
+            raise ContentMalformed(
+                "Missing required tag in bagit.txt: {}".format(e.args[0])
+            ) from e
+        if isinstance(encoding, list):
+            raise ContentMalformed(
+                "Tag-File-Character-Encoding is repeated in bagit.txt"
+            )
+        self.encoding: str = encoding
+
+        self.info = (
+            self._read_tag_file("bag-info.txt", self.encoding)
+            if "bag-info.txt" in self.members
+            else {}
+        )
+
+        #: Payload manifest entries, as {algorithm: {path: digest}}
+        self.manifests: Dict[str, Dict[str, str]] = {}
+        #: Tag manifest entries, as {algorithm: {path: digest}}
+        self.tag_manifests: Dict[str, Dict[str, str]] = {}
+        for name in self.members:
+            match = MANIFEST_RE.match(name)
+            if not match:
+                continue
+            algorithm = match.group(2)
+            if algorithm not in SUPPORTED_ALGORITHMS:
+                logger.warning("Ignoring manifest with unsupported algorithm: %s", name)
+                continue
+            manifests = self.tag_manifests if match.group(1) else self.manifests
+            manifests[algorithm] = dict(self._read_manifest(name))
+
+        self.fetch_entries = (
+            [line for line in self._read_text("fetch.txt").splitlines() if line.strip()]
+            if "fetch.txt" in self.members
+            else []
+        )
+
+    @property
+    def algorithms(self) -> List[str]:
+        return sorted(self.manifests)
+
+    @property
+    def payload_members(self) -> List[zipfile.ZipInfo]:
+        return [info for name, info in self.members.items() if name.startswith("data/")]
+
+    @property
+    def entries(self) -> Set[str]:
+        """All paths listed in any payload or tag manifest"""
+        return {
+            path
+            for manifests in (self.manifests, self.tag_manifests)
+            for entries in manifests.values()
+            for path in entries
+        }
+
+    def validate_structure(self) -> None:
+        """Validates everything about the bag except for payload checksums
+
+        This checks that the payload manifests are complete, the ``Payload-Oxum`` (if given) matches, and that the tag
+        manifests are correct. Bags with ``fetch.txt`` entries are rejected, as they're not supported in SWORD BagIt.
+
+        :raises ValidationFailed: if the bag is invalid
+        """
+        if not any(name.startswith("data/") for name in self.zip.namelist()):
+            raise ValidationFailed("Expected data directory does not exist")
+        if not self.manifests:
+            raise ValidationFailed("No manifest files found")
+        if self.fetch_entries:
+            raise ValidationFailed("fetch.txt not supported in SWORD BagIt")
+
+        errors = []
+        payload = {info.filename for info in self.payload_members}
+        for algorithm, entries in sorted(self.manifests.items()):
+            for path in sorted(payload - set(entries)):
+                errors.append(
+                    "{} exists in the bag but is not in manifest-{}.txt".format(
+                        path, algorithm
+                    )
+                )
+            for path in sorted(set(entries) - payload):
+                errors.append(
+                    "{} is in manifest-{}.txt but does not exist in the bag".format(
+                        path, algorithm
+                    )
+                )
+
+        oxum = self.info.get("Payload-Oxum")
+        if isinstance(oxum, str):
+            expected_size, _, expected_count = oxum.partition(".")
+            actual_size = sum(info.file_size for info in self.payload_members)
+            actual_count = len(self.payload_members)
+            if (expected_size, expected_count) != (str(actual_size), str(actual_count)):
+                errors.append(
+                    "Payload-Oxum validation failed. Expected {} files and {} bytes but found {} files and {} "
+                    "bytes".format(
+                        expected_count, expected_size, actual_count, actual_size
+                    )
+                )
+
+        for algorithm, entries in sorted(self.tag_manifests.items()):
+            for path, expected in sorted(entries.items()):
+                if path not in self.members:
+                    errors.append(
+                        "{} is in tagmanifest-{}.txt but does not exist in the bag".format(
+                            path, algorithm
+                        )
+                    )
+                    continue
+                actual = hashlib.new(algorithm, self.zip.read(path)).hexdigest()
+                if actual != expected.lower():
+                    errors.append(
+                        "{} {} validation failed: expected={} found={}".format(
+                            path, algorithm, expected, actual
+                        )
+                    )
+
+        if errors:
+            raise ValidationFailed("; ".join(errors))
+
+    def verify_payload(
+        self, digests: Dict[str, Dict[str, str]], paths: Collection[str] = None
+    ) -> Dict[str, List[str]]:
+        """Checks payload digests against the manifests
+
+        :param digests: Digests for each payload path, as ``{path: {algorithm: hexdigest}}``
+        :param paths: The payload paths to check, if not all of those in the manifests
+        :return: A description of each failure, keyed by path. This is empty if all digests match.
+        """
+        failures: Dict[str, List[str]] = {}
+        for algorithm, entries in sorted(self.manifests.items()):
+            for path, expected in sorted(entries.items()):
+                if paths is not None and path not in paths:
+                    continue
+                actual = digests.get(path, {}).get(algorithm)
+                if actual != expected.lower():
+                    failures.setdefault(path, []).append(
+                        "{} {} validation failed: expected={} found={}".format(
+                            path, algorithm, expected, actual
+                        )
+                    )
+        return failures
+
+    def _read_text(self, name: str, encoding: str = None) -> str:
+        try:
+            return self.zip.read(name).decode(encoding or self.encoding)
+        except (UnicodeDecodeError, LookupError) as e:
+            raise ContentMalformed("Unable to decode {}".format(name)) from e
+
+    def _read_tag_file(
+        self, name: str, encoding: str = None
+    ) -> Dict[str, Union[str, List[str]]]:
+        tags: Dict[str, Union[str, List[str]]] = {}
+        for tag_name, tag_value in self._parse_tags(name, encoding):
+            existing = tags.get(tag_name)
+            if existing is None:
+                tags[tag_name] = tag_value
+            elif isinstance(existing, list):
+                existing.append(tag_value)
+            else:
+                tags[tag_name] = [existing, tag_value]
+        return tags
+
+    def _parse_tags(self, name: str, encoding: str = None) -> Iterator[Tuple[str, str]]:
+        tag_name, tag_value = None, None
+        for line in self._read_text(name, encoding).splitlines():
+            if not line.strip():
+                continue
+            elif line[0].isspace() and tag_value is not None:
+                # A continuation line
+                tag_value += line
+            else:
+                if tag_name:
+                    yield tag_name, tag_value.strip()
+                if ":" not in line:
+                    raise ContentMalformed(
+                        "Invalid line in {}: {!r}".format(name, line)
+                    )
+                tag_name, tag_value = line.strip().split(":", 1)
+                tag_name = tag_name.strip()
+        if tag_name:
+            yield tag_name, tag_value.strip()
+
+    def _read_manifest(self, name: str) -> Iterator[Tuple[str, str]]:
+        for line in self._read_text(name).splitlines():
+            if not line.strip():
+                continue
+            try:
+                digest, path = line.strip().split(None, 1)
+            except ValueError as e:
+                raise ContentMalformed(
+                    "Invalid line in {}: {!r}".format(name, line)
+                ) from e
+            path = posixpath.normpath(
+                PERCENT_ENCODED_RE.sub(
+                    lambda match: chr(int(match.group(1), 16)), path.lstrip("*")
+                )
+            )
+            yield path, digest
 
 
 class SWORDBagItPackaging(Packaging):
     content_type = "application/zip"
+    archive_formats = ("application/zip",)
     packaging_name = PackagingFormat.SwordBagIt
 
     def get_original_deposit_filename(
@@ -33,68 +281,156 @@ class SWORDBagItPackaging(Packaging):
             uuid.uuid4()
         )
 
+    @property
+    def deferred_fixity(self) -> bool:
+        """Whether payload checksums are verified in a separate task after ingest
+
+        See the ``bagit_deferred_fixity`` endpoint option.
+        """
+        return self.endpoint_options["bagit_deferred_fixity"]
+
     def unpack(self, object_version: ObjectVersion):
+        from .. import tasks
+
         if object_version.mimetype != self.content_type:
             raise ContentTypeNotAcceptable(
                 "Content-Type must be {}".format(self.content_type)
             )
 
-        with tempfile.TemporaryDirectory() as path:
-            try:
-                with tempfile.TemporaryFile() as f:
-                    with object_version.file.storage().open() as stream:
-                        shutil.copyfileobj(stream, f)
-                    f.seek(0)
-                    zip = zipfile.ZipFile(f)
-                    zip.extractall(path)
-                    zip.close()
-                    f.seek(0)
-
-                bag = bagit.Bag(path)
-                bag.validate()
-
-                if next(bag.files_to_be_fetched(), None):
-                    raise ValidationFailed("fetch.txt not supported in SWORD BagIt")
-
-                self.record["bagitInfo"] = bag.info
-
-                # Ingest any SWORD metadata
-                metadata_path = os.path.join(path, "metadata/sword.json")
-                if (
-                    os.path.exists(metadata_path)
-                    and "metadata/sword.json" in bag.entries
-                ):
-                    with open(metadata_path, "rb") as metadata_f:
-                        self.record.set_metadata(
-                            metadata_f,
-                            metadata_class=SWORDMetadata,
-                            content_type="application/ld+json",
-                            derived_from=object_version.key,
-                            replace=True,
-                        )
-                        self.record.commit()
-
-                # Ingest payload files
-                for name in bag.payload_entries():
-                    with open(os.path.join(path, name), "rb") as payload_f:
-                        archive_object_version = ObjectVersion.create(
-                            self.record.bucket,
-                            name.split(os.path.sep, 1)[-1],
-                            mimetype=mimetypes.guess_type(name)[0],
-                            stream=payload_f,
-                        )
+        try:
+            with self.seekable_opener(object_version) as opener:
+                with opener() as f, zipfile.ZipFile(f) as zip:
+                    bag = ZipBag(zip)
+                    bag.validate_structure()
+                    metadata = (
+                        zip.read("metadata/sword.json")
+                        if "metadata/sword.json" in bag.members
+                        and "metadata/sword.json" in bag.entries
+                        else None
+                    )
 
-                        tags = TagManager(archive_object_version)
-                        tags.update(
-                            {
-                                ObjectTagKey.FileSetFile: "true",
-                                ObjectTagKey.DerivedFrom: object_version.key,
-                            }
-                        )
-                return set(bag.payload_entries())
-            except bagit.BagValidationError as e:
-                raise ValidationFailed(e.message) from e
-            except bagit.BagError as e:
-                raise ContentMalformed(*e.args) from e
-            except zipfile.BadZipFile as e:
-                raise ContentMalformed("Bad ZIP file") from e
+                # Payload files are hashed as they are written to storage, so each byte is only read once. With
+                # deferred fixity we've checked the Payload-Oxum and manifest completeness, and hashing is left to
+                # verify_fixity().
+                payload_members = bag.payload_members
+                stored_members = store_zip_members(
+                    self.record.bucket,
+                    opener,
+                    payload_members,
+                    workers=current_app.config["SWORD_UNPACK_WORKERS"]
+                    if self.deferred_fixity
+                    else get_fixity_workers(),
+                    algorithms=() if self.deferred_fixity else bag.algorithms,
+                )
+        except zipfile.BadZipFile as e:
+            raise ContentMalformed("Bad ZIP file") from e
+
+        if self.deferred_fixity:
+            self.record["bagitFixity"] = {"status": "pending"}
+            self.deferred_tasks.append(
+                tasks.verify_fixity.si(
+                    str(self.record.id), str(object_version.version_id)
+                ).set(**current_app.config["SWORD_FIXITY_TASK_OPTIONS"])
+            )
+        else:
+            failures = bag.verify_payload(
+                {name: stored.digests for name, stored in stored_members.items()}
+            )
+            if failures:
+                for stored in stored_members.values():
+                    stored.storage.delete()
+                raise ValidationFailed(format_failures(failures))
+
+        self.record["bagitInfo"] = bag.info
+
+        # Ingest any SWORD metadata
+        if metadata is not None:
+            self.record.set_metadata(
+                io.BytesIO(metadata),
+                metadata_class=SWORDMetadata,
+                content_type="application/ld+json",
+                derived_from=object_version.key,
+                replace=True,
+            )
+        self.record.commit()
+
+        # Ingest payload files
+        keys = set()
+        with self.bulk_ingest(object_version) as writer:
+            for info in payload_members:
+                key = info.filename.split("/", 1)[-1]
+                writer.add(
+                    key,
+                    stored_members[info.filename].file_instance,
+                    mimetype=mimetypes.guess_type(key)[0],
+                )
+                keys.add(key)
+        return keys
+
+    def verify_fixity(self, object_version: ObjectVersion) -> bool:
+        """Checks ingested payload files against the bag's manifests
+
+        This is run by :func:`invenio_sword.tasks.verify_fixity` after a deferred-fixity unpack. Payload files that
+        fail are given an error state, as is the original deposit, and the failures are recorded on the deposit
+        record. Payload files that have since been replaced by another deposit are skipped.
+
+        :return: whether all checked files matched the manifests
+        """
+        with self.open_seekable(object_version) as f, zipfile.ZipFile(f) as zip:
+            bag = ZipBag(zip)
+
+        payload_object_versions = {}
+        for info in bag.payload_members:
+            payload_object_version = ObjectVersion.get(
+                self.record.bucket, info.filename.split("/", 1)[-1]
+            )
+            if (
+                payload_object_version
+                and TagManager(payload_object_version).get(ObjectTagKey.DerivedFrom)
+                == object_version.key
+            ):
+                payload_object_versions[info.filename] = payload_object_version
+
+        app = current_app._get_current_object()
+
+        def digest(storage):
+            with app.app_context(), storage.open() as stream:
+                return digest_stream(stream, bag.algorithms)
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=get_fixity_workers()
+        ) as executor:
+            futures = {
+                path: executor.submit(digest, payload_object_version.file.storage())
+                for path, payload_object_version in payload_object_versions.items()
+            }
+            digests = {path: future.result() for path, future in futures.items()}
+
+        failures = bag.verify_payload(digests, paths=digests)
+        for path in failures:
+            TagManager(payload_object_versions[path])[
+                ObjectTagKey.FileState
+            ] = FileState.Error
+
+        if failures:
+            TagManager(object_version)[ObjectTagKey.FileState] = FileState.Error
+            self.record["bagitFixity"] = {
+                "status": "failed",
+                "errors": [
+                    failure for path in sorted(failures) for failure in failures[path]
+                ],
+            }
+        else:
+            self.record["bagitFixity"] = {"status": "verified"}
+        self.record.commit()
+
+        return not failures
+
+
+def format_failures(failures: Dict[str, List[str]]) -> str:
+    return "; ".join(failure for path in sorted(failures) for failure in failures[path])
+
+
+def get_fixity_workers() -> int:
+    """The number of threads to use for hashing BagIt payload files, per ``SWORD_FIXITY_WORKERS``"""
+    return current_app.config["SWORD_FIXITY_WORKERS"] or os.cpu_count() or 1
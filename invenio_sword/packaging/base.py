@@ -1,24 +1,77 @@
 from __future__ import annotations
 
+import contextlib
+import datetime
 import mimetypes
+import shutil
+import tempfile
+import threading
 import typing
 import uuid
 from typing import Any
+from typing import BinaryIO
+from typing import Callable
 from typing import Collection
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Mapping
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import TypeVar
 from typing import Union
 
 from flask import current_app
+from invenio_db import db
+from invenio_files_rest.errors import BucketLockedError
+from invenio_files_rest.models import Bucket
+from invenio_files_rest.models import FileInstance
 from invenio_files_rest.models import ObjectVersion
+from invenio_files_rest.models import ObjectVersionTag
+from invenio_files_rest.models import validate_key
+
+from ..enum import ObjectTagKey
+from ..progress import ProgressReporter
+from ..streams import DEFAULT_CHUNK_SIZE
+from ..streams import Pipe
+from ..streams import TeeReader
+from ..typing import BytesReader
+from ..utils import TagManager
+from ..utils import check_superseded
 
 if typing.TYPE_CHECKING:  # pragma: nocover
+    from celery.canvas import Signature
     from ..api import SWORDDeposit
+    from ..typing import SwordEndpointDefinition
+
+T = TypeVar("T")
 
 
 class Packaging:
     packaging_name: str
+    #: Archive media types accepted by this packaging format, for the service document's ``acceptArchiveFormat``
+    archive_formats: Collection[str] = ()
+    #: Whether :meth:`unpack_stream` can unpack deposits in one forward pass, without them being stored first
+    streamable = False
 
     def __init__(self, record: SWORDDeposit):
         self.record = record
+        #: Task signatures to queue once the results of unpacking have been committed
+        self.deferred_tasks: List[Signature] = []
+        #: Whether unpacking may commit its progress as it goes, so that a retried task can resume where it left off
+        self.resumable = False
+        #: Whether unpacking may commit after each batch, and stop if the object has been superseded, without recording
+        #: where it got to. :attr:`resumable` implies this.
+        self.interruptible = False
+        #: Set by tasks to report how many members have been unpacked
+        self.progress: Optional[ProgressReporter] = None
+
+    @property
+    def endpoint_options(self) -> SwordEndpointDefinition:
+        """Configuration for the record's SWORD endpoint"""
+        return current_app.config["SWORD_ENDPOINTS"][self.record.pid.pid_type]
 
     def get_original_deposit_filename(
         self, filename: str = None, media_type: str = None
@@ -37,11 +90,333 @@ class Packaging:
         ][packaging_name]
         return packaging_class(record)
 
+    @contextlib.contextmanager
+    def open_seekable(self, object_version: ObjectVersion) -> Iterator[BinaryIO]:
+        """Opens the contents of an object version for random access
+
+        If ``SWORD_UNPACK_FROM_STORAGE`` is set and the storage backend returns a seekable stream, that stream is used
+        directly. Otherwise the contents are copied to a temporary file first.
+        """
+        with object_version.file.storage().open() as stream:
+            if current_app.config["SWORD_UNPACK_FROM_STORAGE"] and _is_seekable(stream):
+                yield stream
+            else:
+                with tempfile.TemporaryFile() as f:
+                    shutil.copyfileobj(stream, f)
+                    f.seek(0)
+                    yield f
+
+    def can_read_from_storage(self, object_version: ObjectVersion) -> bool:
+        """Whether :meth:`open_seekable` and :meth:`seekable_opener` read from storage, without copying the contents"""
+        if not current_app.config["SWORD_UNPACK_FROM_STORAGE"]:
+            return False
+        with object_version.file.storage().open() as stream:
+            return _is_seekable(stream)
+
+    @contextlib.contextmanager
+    def seekable_opener(
+        self, object_version: ObjectVersion
+    ) -> Iterator[Callable[[], BinaryIO]]:
+        """Like :meth:`open_seekable`, but yields a callable that opens independent handles
+
+        This is for when the contents need to be read from several threads at once.
+        """
+        storage = object_version.file.storage()
+        if self.can_read_from_storage(object_version):
+            yield storage.open
+        else:
+            with tempfile.NamedTemporaryFile() as f:
+                with storage.open() as stream:
+                    shutil.copyfileobj(stream, f)
+                f.flush()
+
+                def open_copy() -> BinaryIO:
+                    return open(f.name, "rb")
+
+                yield open_copy
+
+    def store_stream(self, stream: BytesReader) -> FileInstance:
+        """Writes a stream to storage as a new file instance, for use with :meth:`bulk_ingest`
+
+        The file instance isn't added to the database session; :class:`BulkObjectWriter` does this.
+        """
+        bucket = self.record.bucket
+        file_instance = FileInstance(
+            id=uuid.uuid4(), writable=True, readable=False, size=0
+        )
+        storage = file_instance.storage(
+            default_location=bucket.location.uri,
+            default_storage_class=bucket.default_storage_class,
+        )
+        uri, size, checksum = storage.save(stream, size_limit=bucket.size_limit)
+        file_instance.set_uri(
+            uri, size, checksum, storage_class=bucket.default_storage_class
+        )
+        return file_instance
+
+    @contextlib.contextmanager
+    def bulk_ingest(self, object_version: ObjectVersion) -> Iterator[BulkObjectWriter]:
+        """Yields a writer for adding the files unpacked from ``object_version`` to the record's bucket
+
+        The new object versions are tagged as file set files derived from ``object_version``, and share its generation.
+        They are written in batches of ``SWORD_BULK_INSERT_BATCH_SIZE``, and any remainder is written on leaving the
+        context without an exception.
+        """
+        tags = {
+            ObjectTagKey.FileSetFile: "true",
+            ObjectTagKey.DerivedFrom: object_version.key,
+        }
+        generation = TagManager(object_version).get(ObjectTagKey.Generation)
+        if generation:
+            tags[ObjectTagKey.Generation] = generation
+        writer = BulkObjectWriter(
+            self.record.bucket,
+            tags=tags,
+            batch_size=current_app.config["SWORD_BULK_INSERT_BATCH_SIZE"],
+            progress=self.progress,
+        )
+        yield writer
+        writer.flush()
+
+    def checkpointed_batches(
+        self, object_version: ObjectVersion, items: Sequence[T]
+    ) -> Iterator[Sequence[T]]:
+        """Yields the items to unpack from ``object_version``, in batches that are committed as they complete
+
+        If :attr:`resumable` is set, the number of items unpacked so far is recorded on ``object_version`` and
+        committed after each batch of ``SWORD_UNPACK_CHECKPOINT_INTERVAL`` items. Items before an existing checkpoint
+        are skipped. If only :attr:`interruptible` is set, each batch is committed without recording a checkpoint.
+        Otherwise all items are yielded in a single batch, and nothing is committed. :class:`Superseded` is raised after
+        a commit if a later deposit has replaced ``object_version``.
+
+        ``items`` must be in the same order each time an object version is unpacked.
+        """
+        if not (self.resumable or self.interruptible):
+            if self.progress:
+                self.progress.update(totalMembers=len(items), membersProcessed=0)
+            yield items
+            return
+
+        tags = TagManager(object_version)
+        start = (
+            int(str(tags.get(ObjectTagKey.UnpackCheckpoint, 0)))
+            if self.resumable
+            else 0
+        )
+        if self.progress:
+            self.progress.update(totalMembers=len(items), membersProcessed=start)
+        interval = current_app.config["SWORD_UNPACK_CHECKPOINT_INTERVAL"]
+        for batch_start in range(start, len(items), interval):
+            yield items[batch_start : batch_start + interval]
+            if self.resumable:
+                tags[ObjectTagKey.UnpackCheckpoint] = str(
+                    min(batch_start + interval, len(items))
+                )
+            db.session.commit()
+            check_superseded(object_version)
+        if self.resumable:
+            # Left for the caller to commit along with the final file state
+            del tags[ObjectTagKey.UnpackCheckpoint]
+
     def shortcut_unpack(
         self, object_version: ObjectVersion
     ) -> Union[Any, Collection[str]]:
-        """Override this to shortcut task-based unpacking"""
+        """Override this to shortcut task-based unpacking
+
+        This is called during the request for deposits no larger than ``SWORD_SHORTCUT_UNPACK_MAX_SIZE``. Return
+        ``NotImplemented`` to unpack in a task instead.
+        """
         return NotImplemented
 
     def unpack(self, object_version: ObjectVersion) -> Collection[str]:
         raise NotImplementedError  # pragma: nocover
+
+    def unpack_stream(
+        self, object_version: ObjectVersion, stream: BytesReader
+    ) -> Collection[str]:
+        raise NotImplementedError  # pragma: nocover
+
+    def ingest_stream(
+        self, object_version: ObjectVersion, stream: BytesReader
+    ) -> Collection[str]:
+        """Stores ``stream`` as the contents of ``object_version`` while unpacking it, in a single pass
+
+        Everything :meth:`unpack_stream` reads is also piped to a background thread that writes it to storage, so the
+        deposit never has to be read back. This is only for :attr:`streamable` packagings.
+        """
+        app = current_app._get_current_object()
+        bucket = object_version.bucket
+        file_instance = FileInstance(
+            id=uuid.uuid4(), writable=True, readable=False, size=0
+        )
+        storage = file_instance.storage(
+            default_location=bucket.location.uri,
+            default_storage_class=bucket.default_storage_class,
+        )
+        size_limit = bucket.size_limit
+        pipe = Pipe()
+        outcome: Dict[str, Any] = {}
+
+        def save():
+            try:
+                with app.app_context():
+                    outcome["result"] = storage.save(pipe, size_limit=size_limit)
+            except BaseException as e:
+                outcome["error"] = e
+            finally:
+                # Stop the unpacker if we've stopped reading
+                pipe.abort()
+
+        thread = threading.Thread(target=save, name="sword-ingest-stream")
+        thread.start()
+
+        tee = TeeReader(stream, pipe)
+        try:
+            keys = self.unpack_stream(object_version, tee)
+            # Unpacking needn't have read to the end, e.g. tar padding
+            while tee.read(DEFAULT_CHUNK_SIZE):
+                pass
+        except BaseException as e:
+            pipe.abort()
+            thread.join()
+            if isinstance(e, BrokenPipeError) and "error" in outcome:
+                raise outcome["error"] from e
+            raise
+        pipe.close()
+        thread.join()
+        if "error" in outcome:
+            raise outcome["error"]
+
+        uri, size, checksum = outcome["result"]
+        file_instance.set_uri(
+            uri, size, checksum, storage_class=bucket.default_storage_class
+        )
+        db.session.add(file_instance)
+        object_version.set_file(file_instance)
+        return keys
+
+    def get_unpack_chunks(self, object_version: ObjectVersion) -> List[Tuple[int, int]]:
+        """Override this to split unpacking of large deposits into ranges of members
+
+        Each ``(start, end)`` range is unpacked by :meth:`unpack_chunk` in its own task. An empty list means the
+        deposit is unpacked in one go by :meth:`unpack`.
+        """
+        return []
+
+    def unpack_chunk(
+        self, object_version: ObjectVersion, start: int, end: int
+    ) -> Collection[str]:
+        raise NotImplementedError  # pragma: nocover
+
+
+class PendingObject(NamedTuple):
+    file_instance: FileInstance
+    mimetype: Optional[str]
+    tags: Mapping[ObjectTagKey, str]
+
+
+class BulkObjectWriter:
+    """Creates object versions in a bucket with multi-row statements
+
+    This has the same effect as calling :meth:`ObjectVersion.create` and then setting tags for each object, but takes
+    a fixed handful of queries per batch, instead of several per object. Object versions are written straight to the
+    database, so should be queried afresh after a flush.
+    """
+
+    def __init__(
+        self,
+        bucket: Bucket,
+        tags: Mapping[ObjectTagKey, str] = None,
+        batch_size: int = 1000,
+        progress: ProgressReporter = None,
+    ):
+        self.bucket = bucket
+        #: Tags to set on every object version
+        self.tags = dict(tags or {})
+        self.batch_size = batch_size
+        #: Counts the object versions added, as ``membersProcessed``
+        self.progress = progress
+        self.pending: Dict[str, PendingObject] = {}
+
+    def add(
+        self,
+        key: str,
+        file_instance: FileInstance,
+        mimetype: str = None,
+        tags: Mapping[ObjectTagKey, str] = None,
+    ) -> None:
+        """Buffers a new head version of ``key``, flushing the buffer if it is full"""
+        self.pending[validate_key(key)] = PendingObject(
+            file_instance, mimetype, {**self.tags, **(tags or {})}
+        )
+        if self.progress:
+            self.progress.advance("membersProcessed")
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes all buffered object versions, their tags and the new bucket size to the database session"""
+        if not self.pending:
+            return
+        if self.bucket.locked:
+            raise BucketLockedError()
+
+        pending, self.pending = self.pending, {}
+
+        # Object versions refer to their file instances, so these need inserting first
+        db.session.add_all(
+            pending_object.file_instance for pending_object in pending.values()
+        )
+        db.session.flush()
+
+        ObjectVersion.query.filter(
+            ObjectVersion.bucket_id == self.bucket.id,
+            ObjectVersion.key.in_(list(pending)),
+            ObjectVersion.is_head.is_(True),
+        ).update({ObjectVersion.is_head: False}, synchronize_session="fetch")
+
+        now = datetime.datetime.utcnow()
+        object_rows: List[Dict[str, Any]] = []
+        tag_rows: List[Dict[str, Any]] = []
+        for key, pending_object in pending.items():
+            version_id = uuid.uuid4()
+            object_rows.append(
+                {
+                    "version_id": version_id,
+                    "key": key,
+                    "bucket_id": self.bucket.id,
+                    "file_id": pending_object.file_instance.id,
+                    "_mimetype": pending_object.mimetype,
+                    "is_head": True,
+                    "created": now,
+                    "updated": now,
+                }
+            )
+            tag_rows.extend(
+                {"version_id": version_id, "key": tag_key.value, "value": value}
+                for tag_key, value in pending_object.tags.items()
+            )
+
+        db.session.execute(ObjectVersion.__table__.insert().values(object_rows))
+        if tag_rows:
+            db.session.execute(ObjectVersionTag.__table__.insert().values(tag_rows))
+
+        # Incremented in SQL, as chunks of the same archive are unpacked into the bucket concurrently
+        Bucket.query.filter_by(id=self.bucket.id).update(
+            {
+                Bucket.size: Bucket.size
+                + sum(
+                    pending_object.file_instance.size
+                    for pending_object in pending.values()
+                )
+            },
+            synchronize_session=False,
+        )
+        db.session.expire(self.bucket, ["size"])
+
+
+def _is_seekable(stream: BinaryIO) -> bool:
+    try:
+        return stream.seekable()
+    except (AttributeError, ValueError):
+        return False
@@ -12,6 +12,7 @@ __all__ = ["BinaryPackaging"]
 
 class BinaryPackaging(Packaging):
     packaging_name = PackagingFormat.Binary
+    streamable = True
 
     def shortcut_unpack(self, object_version: ObjectVersion):
         tags = TagManager(object_version)
@@ -20,3 +21,7 @@ class BinaryPackaging(Packaging):
 
     def unpack(self, object_version: ObjectVersion):
         return self.shortcut_unpack(object_version)
+
+    def unpack_stream(self, object_version: ObjectVersion, stream):
+        # There's nothing to unpack, so ingest_stream() only needs to store the stream
+        return self.shortcut_unpack(object_version)
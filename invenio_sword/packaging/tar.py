@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import lzma
+import mimetypes
+import posixpath
+import tarfile
+import typing
+import uuid
+import zlib
+from typing import Set
+
+from invenio_files_rest.models import ObjectVersion
+from sword3common.exceptions import ContentMalformed
+from sword3common.exceptions import ContentTypeNotAcceptable
+
+from ..streams import PrefixedReader
+from ..typing import BytesReader
+from .base import Packaging
+
+try:
+    import zstandard
+except ImportError:  # pragma: nocover
+    zstandard = None
+
+__all__ = ["SimpleTarPackaging", "open_tar_stream"]
+
+ZSTANDARD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+#: Exceptions raised when reading a corrupt archive
+ARCHIVE_ERRORS = (tarfile.TarError, EOFError, zlib.error, lzma.LZMAError) + (
+    (zstandard.ZstdError,) if zstandard else ()
+)
+
+#: Extensions for original deposits, by media type
+EXTENSIONS = {
+    "application/x-tar": ".tar",
+    "application/gzip": ".tar.gz",
+    "application/x-gzip": ".tar.gz",
+    "application/x-bzip2": ".tar.bz2",
+    "application/x-xz": ".tar.xz",
+    "application/zstd": ".tar.zst",
+}
+
+
+class SimpleTarPackaging(Packaging):
+    """Tar archives, optionally compressed with gzip, bzip2, xz or (with the zstandard package) Zstandard
+
+    Like SimpleZip, every regular file in the archive becomes a file in the deposit. Archives are unpacked in one
+    forward pass, so they're never copied to a temporary file, and can be unpacked as they arrive.
+    """
+
+    packaging_name = "https://swordapp.github.io/invenio-sword/package/SimpleTar"
+    streamable = True
+    archive_formats = tuple(
+        media_type
+        for media_type in EXTENSIONS
+        if zstandard or media_type != "application/zstd"
+    )
+
+    def get_original_deposit_filename(
+        self, filename: str = None, media_type: str = None
+    ) -> str:
+        if media_type not in self.archive_formats:
+            raise ContentTypeNotAcceptable(
+                "Content-Type must be one of {}".format(", ".join(self.archive_formats))
+            )
+        return self.record.original_deposit_key_prefix + "simple-tar-{}{}".format(
+            uuid.uuid4(), EXTENSIONS[media_type]
+        )
+
+    def unpack(self, object_version: ObjectVersion):
+        with object_version.file.storage().open() as stream:
+            return self.unpack_stream(object_version, stream)
+
+    def unpack_stream(self, object_version: ObjectVersion, stream: BytesReader):
+        """Unpacks an archive in a single pass over ``stream``, which needn't be seekable
+
+        The unpacked files are recorded as derived from ``object_version``, which needn't have its contents stored
+        yet.
+        """
+        keys: Set[str] = set()
+        try:
+            with open_tar_stream(stream) as tar, self.bulk_ingest(
+                object_version
+            ) as writer:
+                for member in tar:
+                    # Directories, links and devices have no content of their own
+                    if not member.isfile():
+                        continue
+                    key = posixpath.normpath(member.name).lstrip("/")
+                    with tar.extractfile(member) as f:
+                        file_instance = self.store_stream(f)
+                    writer.add(
+                        key, file_instance, mimetype=mimetypes.guess_type(key)[0]
+                    )
+                    keys.add(key)
+        except ARCHIVE_ERRORS as e:
+            raise ContentMalformed("Bad tar file") from e
+        return keys
+
+
+def open_tar_stream(stream: BytesReader) -> tarfile.TarFile:
+    """Opens a possibly-compressed tar archive for reading in a single forward pass
+
+    Compression is detected from the content. gzip, bzip2 and xz are handled by :mod:`tarfile`, and Zstandard by the
+    optional zstandard package.
+    """
+    magic = stream.read(len(ZSTANDARD_MAGIC))
+    stream = PrefixedReader(magic, stream)
+    if magic == ZSTANDARD_MAGIC:
+        if zstandard is None:
+            raise ContentTypeNotAcceptable(
+                "Zstandard-compressed archives are not supported"
+            )
+        stream = zstandard.ZstdDecompressor().stream_reader(stream)
+    # tarfile only needs read() to stream an archive
+    return tarfile.open(fileobj=typing.cast(typing.IO[bytes], stream), mode="r|*")
@@ -1,26 +1,51 @@
 from __future__ import annotations
 
+import concurrent.futures
 import mimetypes
-import shutil
-import tempfile
+import threading
 import uuid
 import zipfile
+from typing import Any
+from typing import BinaryIO
+from typing import Callable
+from typing import Collection
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Sequence
+from typing import Set
+from typing import TypeVar
 
+from flask import current_app
+from invenio_db import db
+from invenio_files_rest.models import Bucket
+from invenio_files_rest.models import FileInstance
 from invenio_files_rest.models import ObjectVersion
+from invenio_files_rest.models import ObjectVersionTag
+from sqlalchemy.orm import joinedload
 from sword3common.constants import PackagingFormat
 from sword3common.exceptions import ContentMalformed
 from sword3common.exceptions import ContentTypeNotAcceptable
 
 from ..enum import ObjectTagKey
-from ..utils import TagManager
+from ..streams import digest_stream
+from ..streams import HashingReader
 from .base import Packaging
 
 
-__all__ = ["SimpleZipPackaging"]
+__all__ = [
+    "SimpleZipPackaging",
+    "StoredMember",
+    "map_zip_members",
+    "store_zip_members",
+]
+
+T = TypeVar("T")
 
 
 class SimpleZipPackaging(Packaging):
     content_type = "application/zip"
+    archive_formats = ("application/zip",)
     packaging_name = PackagingFormat.SimpleZip
 
     def get_original_deposit_filename(
@@ -30,6 +55,22 @@ class SimpleZipPackaging(Packaging):
             uuid.uuid4()
         )
 
+    def shortcut_unpack(self, object_version: ObjectVersion):
+        # We're only asked to shortcut archives up to SWORD_SHORTCUT_UNPACK_MAX_SIZE, but a small archive can expand to
+        # far more than that, so the limit applies to the unpacked size too. The central directory records each
+        # member's size, so this doesn't need to decompress anything.
+        if object_version.mimetype == self.content_type:
+            try:
+                with self.open_seekable(object_version) as f:
+                    with zipfile.ZipFile(f) as zip:
+                        size = sum(info.file_size for info in distinct_members(zip))
+            except zipfile.BadZipFile:
+                # Leave unpack() to report this
+                size = 0
+            if size > current_app.config["SWORD_SHORTCUT_UNPACK_MAX_SIZE"]:
+                return NotImplemented
+        return self.unpack(object_version)
+
     def unpack(self, object_version: ObjectVersion):
         if object_version.mimetype != self.content_type:
             raise ContentTypeNotAcceptable(
@@ -37,29 +78,272 @@ class SimpleZipPackaging(Packaging):
             )
 
         try:
-            with tempfile.TemporaryFile() as f:
-                with object_version.file.storage().open() as stream:
-                    shutil.copyfileobj(stream, f)
-                f.seek(0)
-
-                with zipfile.ZipFile(f) as zip:
-                    names = set(zip.namelist())
-
-                    for name in names:
-                        archive_object_version = ObjectVersion.create(
-                            self.record.bucket,
-                            name,
-                            mimetype=mimetypes.guess_type(name)[0],
-                            stream=zip.open(name),
-                        )
-
-                        tags = TagManager(archive_object_version)
-                        tags.update(
-                            {
-                                ObjectTagKey.FileSetFile: "true",
-                                ObjectTagKey.DerivedFrom: object_version.key,
-                            }
-                        )
-                return names
+            if current_app.config["SWORD_UNPACK_WORKERS"] > 1:
+                return self.unpack_concurrently(object_version)
+
+            with self.open_seekable(object_version) as f, zipfile.ZipFile(f) as zip:
+                infos = distinct_members(zip)
+                for batch in self.checkpointed_batches(object_version, infos):
+                    unchanged = self.find_unchanged_members(zip, batch)
+                    with self.bulk_ingest(object_version) as writer:
+                        for info in batch:
+                            if info.filename in unchanged:
+                                file_instance = unchanged[info.filename]
+                            else:
+                                with zip.open(info) as member:
+                                    file_instance = self.store_stream(member)
+                            writer.add(
+                                info.filename,
+                                file_instance,
+                                mimetype=mimetypes.guess_type(info.filename)[0],
+                                tags=member_tags(info),
+                            )
+            return {info.filename for info in infos}
         except zipfile.BadZipFile as e:
             raise ContentMalformed("Bad ZIP file") from e
+
+    def get_unpack_chunks(self, object_version: ObjectVersion):
+        chunk_size = current_app.config["SWORD_UNPACK_CHUNK_SIZE"]
+        if not chunk_size or object_version.mimetype != self.content_type:
+            return []
+        if not self.can_read_from_storage(object_version):
+            # Each chunk would have to copy the whole archive first
+            return []
+        try:
+            with self.open_seekable(object_version) as f, zipfile.ZipFile(f) as zip:
+                count = len(set(zip.namelist()))
+        except zipfile.BadZipFile:
+            # Leave unpack() to report this
+            return []
+        if count <= chunk_size:
+            return []
+        return [
+            (start, min(start + chunk_size, count))
+            for start in range(0, count, chunk_size)
+        ]
+
+    def unpack_chunk(self, object_version: ObjectVersion, start: int, end: int):
+        try:
+            return self.unpack_concurrently(object_version, slice(start, end))
+        except zipfile.BadZipFile as e:
+            raise ContentMalformed("Bad ZIP file") from e
+
+    def unpack_concurrently(
+        self, object_version: ObjectVersion, members: slice = slice(None)
+    ):
+        """Unpacks the archive using a pool of ``SWORD_UNPACK_WORKERS`` threads
+
+        Members are decompressed and written to storage concurrently. The object versions are then created afterwards
+        in this thread, as database sessions can't be shared between threads.
+
+        :param members: the range of members to unpack, indexing distinct filenames in central directory order
+        """
+        with self.seekable_opener(object_version) as opener:
+            with opener() as f, zipfile.ZipFile(f) as zip:
+                infos = distinct_members(zip)[members]
+                for batch in self.checkpointed_batches(object_version, infos):
+                    unchanged = self.find_unchanged_members(zip, batch)
+                    stored_members = store_zip_members(
+                        self.record.bucket,
+                        opener,
+                        [info for info in batch if info.filename not in unchanged],
+                        workers=current_app.config["SWORD_UNPACK_WORKERS"],
+                    )
+
+                    with self.bulk_ingest(object_version) as writer:
+                        for info in batch:
+                            if info.filename in unchanged:
+                                file_instance = unchanged[info.filename]
+                            else:
+                                file_instance = stored_members[
+                                    info.filename
+                                ].file_instance
+                            writer.add(
+                                info.filename,
+                                file_instance,
+                                mimetype=mimetypes.guess_type(info.filename)[0],
+                                tags=member_tags(info),
+                            )
+
+        return {info.filename for info in infos}
+
+    def find_unchanged_members(
+        self, zip: zipfile.ZipFile, infos: Sequence[zipfile.ZipInfo]
+    ) -> Dict[str, FileInstance]:
+        """Finds archive members whose contents are already stored in the record's bucket
+
+        If ``SWORD_INCREMENTAL_UNPACK`` is set, each member is compared with the head object version of the same key,
+        by the CRC-32 recorded when that was unpacked and by size. If ``SWORD_INCREMENTAL_UNPACK_VERIFY_CHECKSUM`` is
+        also set, the member is decompressed to compare its MD5 checksum too.
+
+        :return: the existing file instances for unchanged members, keyed by filename
+        """
+        if not current_app.config["SWORD_INCREMENTAL_UNPACK"]:
+            return {}
+
+        infos_by_name = {info.filename: info for info in infos}
+        unchanged: Dict[str, FileInstance] = {}
+        batch_size = current_app.config["SWORD_BULK_INSERT_BATCH_SIZE"]
+        names = list(infos_by_name)
+        for i in range(0, len(names), batch_size):
+            query = (
+                db.session.query(ObjectVersion, ObjectVersionTag.value)
+                .join(ObjectVersion.tags)
+                .filter(
+                    ObjectVersion.bucket == self.record.bucket,
+                    ObjectVersion.key.in_(names[i : i + batch_size]),
+                    ObjectVersion.is_head.is_(True),
+                    ObjectVersion.file_id.isnot(None),
+                    ObjectVersionTag.key == ObjectTagKey.ArchiveMemberCRC32.value,
+                )
+                .options(joinedload(ObjectVersion.file))
+            )
+            for head, crc in query:
+                info = infos_by_name[head.key]
+                if (
+                    head.file.readable
+                    and head.file.size == info.file_size
+                    and crc == format_crc(info)
+                ):
+                    unchanged[head.key] = head.file
+
+        if current_app.config["SWORD_INCREMENTAL_UNPACK_VERIFY_CHECKSUM"]:
+            for name, file_instance in list(unchanged.items()):
+                with zip.open(infos_by_name[name]) as member:
+                    checksum = "md5:" + digest_stream(member, ["md5"])["md5"]
+                if file_instance.checksum != checksum:
+                    del unchanged[name]
+
+        return unchanged
+
+
+def distinct_members(zip: zipfile.ZipFile) -> List[zipfile.ZipInfo]:
+    """Lists the members of an archive in central directory order, with one entry per filename
+
+    Later entries with the same name take precedence, as with ``ZipFile.open(name)``.
+    """
+    return list({info.filename: info for info in zip.infolist()}.values())
+
+
+def format_crc(info: zipfile.ZipInfo) -> str:
+    return "{:08x}".format(info.CRC)
+
+
+def member_tags(info: zipfile.ZipInfo) -> Dict[ObjectTagKey, str]:
+    """Tags recording where an object version was unpacked from, for incremental re-deposits"""
+    return {ObjectTagKey.ArchiveMemberCRC32: format_crc(info)}
+
+
+class StoredMember(NamedTuple):
+    file_instance: FileInstance
+    #: The storage the member was written to, e.g. for deleting it again
+    storage: Any
+    #: Hex digests of the member's contents, for each of the requested algorithms
+    digests: Dict[str, str]
+
+
+def map_zip_members(
+    opener: Callable[[], BinaryIO],
+    infos: Sequence[zipfile.ZipInfo],
+    func: Callable[[zipfile.ZipInfo, BinaryIO], T],
+    workers: int,
+) -> Dict[str, T]:
+    """Calls ``func`` with each of the given zip members, using a pool of threads
+
+    Each thread opens its own handle on the archive using ``opener``. Members are scheduled largest-first, so that a
+    big member picked up last doesn't leave the rest of the pool idle. Decompression and hashing both release the GIL,
+    so this scales across cores.
+
+    :return: the results of ``func``, keyed by member filename
+    """
+    app = current_app._get_current_object()
+    local = threading.local()
+    handles: List[BinaryIO] = []
+    handles_lock = threading.Lock()
+
+    def call(info: zipfile.ZipInfo) -> T:
+        if not hasattr(local, "zip"):
+            # Storage backends may need the app, e.g. for their configuration
+            with app.app_context():
+                handle = opener()
+            with handles_lock:
+                handles.append(handle)
+            local.zip = zipfile.ZipFile(handle)
+        with local.zip.open(info) as member:
+            return func(info, member)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    futures = {
+        executor.submit(call, info): info
+        for info in sorted(infos, key=lambda info: info.file_size, reverse=True)
+    }
+    results: Dict[str, T] = {}
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future].filename] = future.result()
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        for handle in handles:
+            handle.close()
+    return results
+
+
+def store_zip_members(
+    bucket: Bucket,
+    opener: Callable[[], BinaryIO],
+    infos: Sequence[zipfile.ZipInfo],
+    workers: int,
+    algorithms: Collection[str] = (),
+) -> Dict[str, StoredMember]:
+    """Decompresses zip archive members into storage using a pool of threads
+
+    Digests for each of ``algorithms`` are computed as members are streamed into storage. See
+    :func:`map_zip_members` for how work is spread across threads.
+
+    The returned file instances haven't been added to the database session; this is left to the caller. If storing
+    any member fails, those already stored are deleted before the exception is re-raised.
+    """
+    app = current_app._get_current_object()
+    size_limit = bucket.size_limit
+
+    file_instances: Dict[str, FileInstance] = {}
+    storages = {}
+    for info in infos:
+        file_instance = FileInstance(
+            id=uuid.uuid4(), writable=True, readable=False, size=0
+        )
+        file_instances[info.filename] = file_instance
+        storages[info.filename] = file_instance.storage(
+            default_location=bucket.location.uri,
+            default_storage_class=bucket.default_storage_class,
+        )
+
+    stored: Set[str] = set()
+
+    def store(info: zipfile.ZipInfo, member: BinaryIO):
+        reader = HashingReader(member, algorithms)
+        with app.app_context():
+            result = storages[info.filename].save(reader, size_limit=size_limit)
+        stored.add(info.filename)
+        return result, reader.digests
+
+    try:
+        results = map_zip_members(opener, infos, store, workers)
+    except BaseException:
+        for name in stored:
+            storages[name].delete()
+        raise
+
+    stored_members = {}
+    for name, ((uri, size, checksum), digests) in results.items():
+        file_instances[name].set_uri(
+            uri, size, checksum, storage_class=bucket.default_storage_class
+        )
+        stored_members[name] = StoredMember(
+            file_instances[name], storages[name], digests
+        )
+    return stored_members
@@ -0,0 +1,84 @@
+"""Reports how far tasks have got with downloading and unpacking files, for clients polling a deposit's status
+
+Progress is stored as the ``PROGRESS`` state of the running task in Celery's result backend, so that frequent updates
+don't need to be committed to the database mid-task. It's looked up using the task IDs recorded on each object version
+(see :meth:`invenio_sword.api.SWORDDeposit.track_tasks`), and needs a result backend to be configured.
+"""
+import logging
+import time
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+
+import celery
+from flask import current_app
+from invenio_files_rest.models import ObjectVersion
+
+__all__ = ["ProgressReporter", "get_progress"]
+
+logger = logging.getLogger(__name__)
+
+#: The Celery task state used for progress reports
+PROGRESS_STATE = "PROGRESS"
+
+
+class ProgressReporter:
+    """Records the progress of the current task on ``object_version``
+
+    Counts such as ``bytesTransferred``, ``totalBytes``, ``membersProcessed`` and ``totalMembers`` are sent to the
+    result backend at most every ``SWORD_PROGRESS_INTERVAL`` seconds. Nothing is sent outside of a Celery worker.
+    """
+
+    def __init__(self, object_version: ObjectVersion):
+        self.version_id = str(object_version.version_id)
+        self.progress: Dict[str, Optional[int]] = {}
+        self._last_report: Optional[float] = None
+
+    def update(self, **progress: Optional[int]) -> None:
+        self.progress.update(progress)
+        self.report()
+
+    def advance(self, key: str, amount: int = 1) -> None:
+        self.progress[key] = (self.progress.get(key) or 0) + amount
+        self.report()
+
+    def report(self, force: bool = False) -> None:
+        # Tasks called from within other tasks report as the task run by the worker, whose ID is the one recorded
+        task = celery.current_app.current_worker_task
+        if task is None or not task.request.id:
+            return
+        now = time.monotonic()
+        if (
+            not force
+            and self._last_report is not None
+            and now - self._last_report < current_app.config["SWORD_PROGRESS_INTERVAL"]
+        ):
+            return
+        self._last_report = now
+        meta: Dict[str, Any] = {"versionId": self.version_id, **self.progress}
+        try:
+            task.update_state(state=PROGRESS_STATE, meta=meta)
+        except Exception:
+            # Progress is only advisory, so shouldn't stop the task
+            logger.warning(
+                "Failed to report progress of %s", task.request.id, exc_info=True
+            )
+
+
+def get_progress(
+    object_version: ObjectVersion, task_ids: Iterable[str]
+) -> Optional[Dict[str, Any]]:
+    """Returns the last progress reported on ``object_version`` by any of ``task_ids``, if there is any"""
+    for task_id in task_ids:
+        try:
+            result = celery.current_app.AsyncResult(task_id)
+            if result.state != PROGRESS_STATE:
+                continue
+            info = dict(result.info or {})
+        except Exception:
+            logger.warning("Failed to get progress of %s", task_id, exc_info=True)
+            continue
+        if info.pop("versionId", None) == str(object_version.version_id):
+            return info
+    return None
@@ -0,0 +1,92 @@
+"""Routes the tasks queued for deposits to Celery queues, e.g. so that small deposits aren't held up by large ones
+
+``SWORD_TASK_ROUTER`` is called with a :class:`TaskRoute` describing each task that a deposit queues, and returns
+options for the task, such as ``{"queue": "bulk"}``, or ``None`` to use Celery's defaults. It may be given as a
+callable or an import path.
+"""
+from typing import Any
+from typing import Dict
+from typing import FrozenSet
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+
+from flask import current_app
+from invenio_files_rest.models import ObjectVersion
+from invenio_records_rest.utils import obj_or_import_string
+
+from .enum import ObjectTagKey
+from .utils import TagManager
+
+__all__ = ["SizeRouter", "TaskRoute", "get_task_options"]
+
+
+class TaskRoute(NamedTuple):
+    #: The name of the task, e.g. ``"invenio_sword.tasks.unpack_object"``
+    task_name: str
+    #: The PID type of the SWORD endpoint the deposit was made to
+    pid_type: str
+    #: The packaging formats of the objects the task will process
+    packaging: FrozenSet[str]
+    #: The total size of the objects in bytes, from their files or the content lengths declared for by-reference files,
+    #: or ``None`` if any aren't known
+    size: Optional[int]
+
+
+def get_route(
+    task_name: str, pid_type: str, object_versions: Sequence[ObjectVersion]
+) -> TaskRoute:
+    size: Optional[int] = 0
+    packaging = set()
+    for object_version in object_versions:
+        tags = TagManager(object_version)
+        packaging.add(str(tags[ObjectTagKey.Packaging]))
+        if object_version.file:
+            object_size = object_version.file.size
+        elif ObjectTagKey.ByReferenceContentLength in tags:
+            object_size = int(str(tags[ObjectTagKey.ByReferenceContentLength]))
+        else:
+            object_size = None
+        if size is not None and object_size is not None:
+            size += object_size
+        else:
+            size = None
+    return TaskRoute(
+        task_name=task_name,
+        pid_type=pid_type,
+        packaging=frozenset(packaging),
+        size=size,
+    )
+
+
+def get_task_options(
+    task_name: str, record, object_versions: Sequence[ObjectVersion]
+) -> Dict[str, Any]:
+    """Returns the options from ``SWORD_TASK_ROUTER`` for a task that will process ``object_versions`` of ``record``"""
+    router = current_app.config["SWORD_TASK_ROUTER"]
+    if router is None:
+        return {}
+    route = get_route(task_name, record.pid.pid_type, object_versions)
+    return obj_or_import_string(router)(route) or {}
+
+
+class SizeRouter:
+    """A ``SWORD_TASK_ROUTER`` that sends tasks for objects of up to ``max_small_size`` bytes to ``small_queue``
+
+    Tasks for larger objects, or those of unknown size, are sent to ``bulk_queue``.
+    """
+
+    def __init__(
+        self,
+        max_small_size: int,
+        small_queue: str = "sword-small",
+        bulk_queue: str = "sword-bulk",
+    ):
+        self.max_small_size = max_small_size
+        self.small_queue = small_queue
+        self.bulk_queue = bulk_queue
+
+    def __call__(self, route: TaskRoute) -> Dict[str, Any]:
+        if route.size is not None and route.size <= self.max_small_size:
+            return {"queue": self.small_queue}
+        return {"queue": self.bulk_queue}
@@ -0,0 +1,187 @@
+"""File-like wrappers used when moving content between HTTP, archives and storage"""
+import hashlib
+import queue
+import threading
+from typing import Callable
+from typing import Collection
+from typing import Dict
+from typing import Optional
+
+from .typing import BytesReader
+
+__all__ = [
+    "HashingReader",
+    "LimitedReader",
+    "Pipe",
+    "PrefixedReader",
+    "ProgressReader",
+    "TeeReader",
+    "digest_stream",
+]
+
+DEFAULT_CHUNK_SIZE = 1024 ** 2  # 1 MiB
+
+
+class HashingReader:
+    """Computes digests of everything read through it
+
+    Each chunk is passed to every hash as it's read, so that several digests can be computed from a single read of the
+    underlying stream.
+    """
+
+    def __init__(self, stream: BytesReader, algorithms: Collection[str]):
+        self._stream = stream
+        self._hashes = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+
+    def read(self, amount: int = -1) -> bytes:
+        data = self._stream.read(amount)
+        for hash in self._hashes.values():
+            hash.update(data)
+        return data
+
+    @property
+    def digests(self) -> Dict[str, str]:
+        return {algorithm: hash.hexdigest() for algorithm, hash in self._hashes.items()}
+
+
+class LimitedReader:
+    """Reads at most ``limit`` bytes from ``stream``, leaving the rest to be read later"""
+
+    def __init__(self, stream: BytesReader, limit: int):
+        self._stream = stream
+        self._remaining = limit
+
+    def read(self, amount: int = -1) -> bytes:
+        if amount is None or amount < 0 or amount > self._remaining:
+            amount = self._remaining
+        if not amount:
+            return b""
+        data = self._stream.read(amount)
+        self._remaining -= len(data)
+        return data
+
+
+class PrefixedReader:
+    """Reads ``prefix`` and then the rest of ``stream``
+
+    This puts back bytes that have already been read from a stream that can't seek, e.g. to sniff a file format.
+    """
+
+    def __init__(self, prefix: bytes, stream: BytesReader):
+        self._prefix = prefix
+        self._stream = stream
+
+    def read(self, amount: int = -1) -> bytes:
+        if not self._prefix:
+            return self._stream.read(amount)
+        if amount is None or amount < 0:
+            data, self._prefix = self._prefix + self._stream.read(), b""
+        else:
+            data, self._prefix = self._prefix[:amount], self._prefix[amount:]
+            if len(data) < amount:
+                data += self._stream.read(amount - len(data))
+        return data
+
+
+class Pipe:
+    """Passes chunks of bytes from a writing thread to a reading thread
+
+    At most ``max_chunks`` chunks are buffered, so a slow reader holds up the writer. Either side can :meth:`abort`,
+    after which the other side's reads or writes raise :class:`BrokenPipeError`.
+    """
+
+    def __init__(self, max_chunks: int = 16):
+        self._queue: "queue.Queue[Optional[bytes]]" = queue.Queue(max_chunks)
+        self._aborted = threading.Event()
+        self._buffer = b""
+        self._eof = False
+
+    def write(self, data: bytes) -> None:
+        if data:
+            self._put(data)
+
+    def close(self) -> None:
+        """Signals the end of the stream to the reader"""
+        try:
+            self._put(None)
+        except BrokenPipeError:
+            pass
+
+    def abort(self) -> None:
+        self._aborted.set()
+
+    def read(self, amount: int = -1) -> bytes:
+        if amount is None or amount < 0:
+            while not self._eof:
+                self._get()
+            amount = len(self._buffer)
+        elif not self._buffer and not self._eof:
+            self._get()
+        data, self._buffer = self._buffer[:amount], self._buffer[amount:]
+        return data
+
+    def _put(self, item: Optional[bytes]) -> None:
+        while not self._aborted.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise BrokenPipeError
+
+    def _get(self) -> None:
+        while not self._aborted.is_set():
+            try:
+                item = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is None:
+                self._eof = True
+            else:
+                self._buffer += item
+            return
+        raise BrokenPipeError
+
+
+class ProgressReader:
+    """Calls ``callback`` with the number of bytes read so far, each time another ``interval`` bytes have been read"""
+
+    def __init__(
+        self, stream: BytesReader, callback: Callable[[int], None], interval: int
+    ):
+        self._stream = stream
+        self._callback = callback
+        self._interval = interval
+        self._position = 0
+        self._next_callback = interval
+
+    def read(self, amount: int = -1) -> bytes:
+        data = self._stream.read(amount)
+        self._position += len(data)
+        if self._position >= self._next_callback:
+            self._next_callback = self._position + self._interval
+            self._callback(self._position)
+        return data
+
+
+class TeeReader:
+    """Writes everything read from ``stream`` to ``sink`` as well"""
+
+    def __init__(self, stream: BytesReader, sink: Pipe):
+        self._stream = stream
+        self._sink = sink
+
+    def read(self, amount: int = -1) -> bytes:
+        data = self._stream.read(amount)
+        self._sink.write(data)
+        return data
+
+
+def digest_stream(
+    stream: BytesReader, algorithms: Collection[str], chunk_size=DEFAULT_CHUNK_SIZE
+) -> Dict[str, str]:
+    """Reads a stream to the end, returning its digests for each of ``algorithms``"""
+    reader = HashingReader(stream, algorithms)
+    while reader.read(chunk_size):
+        pass
+    return reader.digests
@@ -1,41 +1,67 @@
+import datetime
 import logging
-import urllib.request
 import uuid
-from typing import Iterable
-from typing import Sequence
-from typing import Union
+from typing import Optional
 
 import celery
-from celery.result import AsyncResult
+from flask import current_app
 from invenio_db import db
+from sqlalchemy import and_
+from sqlalchemy import exists
+from sqlalchemy import or_
 from sqlalchemy import true
+from sqlalchemy.orm import aliased
 
+from invenio_files_rest.errors import BucketLockedError
+from invenio_files_rest.models import Bucket
 from invenio_files_rest.models import MultipartObject, ObjectVersion
 from invenio_files_rest.models import ObjectVersionTag
 from invenio_sword.api import SWORDDeposit, SegmentedUploadRecord
+from invenio_sword.cache import add_to_cache
+from invenio_sword.cache import get_cached_file
+from invenio_sword.download import Download
+from invenio_sword.download import download_to_object_version
+from invenio_sword.download import get_size_limit
+from invenio_sword.download import track_download
 from invenio_sword.enum import FileState
 from invenio_sword.enum import ObjectTagKey
+from invenio_sword.locking import acquire_bucket_lock
+from invenio_sword.locking import bucket_lock
+from invenio_sword.locking import release_bucket_lock
+from invenio_sword.notify import notify_on_commit
 from invenio_sword.packaging import Packaging
+from invenio_sword.progress import ProgressReporter
+from invenio_sword.routing import get_task_options
+from invenio_sword.streams import ProgressReader
+from invenio_sword.utils import Superseded
 from invenio_sword.utils import TagManager
+from invenio_sword.utils import check_superseded
+from invenio_sword.utils import is_superseded
 
 logger = logging.getLogger(__name__)
 
 
-@celery.shared_task
-def dereference_object(record_id, version_id):
+def get_declared_size(tags: TagManager) -> Optional[int]:
+    content_length = tags.get(ObjectTagKey.ByReferenceContentLength)
+    return int(str(content_length)) if content_length is not None else None
+
+
+# Acknowledged late so that the task is redelivered if its worker dies, resuming the download from the last checkpoint
+@celery.shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def dereference_object(self, record_id, version_id):
     object_version = ObjectVersion.query.filter(
         ObjectVersion.version_id == version_id
     ).one()
-    if not object_version.is_head:
+    if is_superseded(object_version):
         logger.info(
-            "Not fetching by-reference file (%s) because a newer version of the object now exists",
+            "Not fetching by-reference file (%s) because it has been superseded",
             object_version,
         )
-        return [object_version.key]
+        return
 
     if object_version.file_id:
         logger.warning("File has already been dereferenced (%s)", object_version)
-        return [object_version.key]
+        return
 
     tags = TagManager(object_version)
 
@@ -43,9 +69,20 @@ def dereference_object(record_id, version_id):
         if ObjectTagKey.ByReferenceURL in tags:
             tags[ObjectTagKey.FileState] = FileState.Downloading
             url = tags[ObjectTagKey.ByReferenceURL]
-            response = urllib.request.urlopen(url)
-            object_version.set_contents(response)
-            pass
+            file_instance = get_cached_file(url, size=get_declared_size(tags))
+            if file_instance:
+                logger.info("Using cached download of %s", url)
+                object_version.set_file(file_instance)
+            else:
+                download = download_to_object_version(
+                    object_version, url, progress=ProgressReporter(object_version)
+                )
+                add_to_cache(
+                    url,
+                    object_version.file,
+                    etag=download.etag,
+                    last_modified=download.last_modified,
+                )
         elif ObjectTagKey.ByReferenceTemporaryID in tags:
             tags[ObjectTagKey.FileState] = FileState.Downloading
             temporary_id = uuid.UUID(tags[ObjectTagKey.ByReferenceTemporaryID])
@@ -64,7 +101,12 @@ def dereference_object(record_id, version_id):
             )
         tags[ObjectTagKey.FileState] = FileState.Pending
         del tags[ObjectTagKey.ByReferenceNotDeleted]
-        return [object_version.key]
+        return
+    except Superseded:
+        logger.info(
+            "Stopped fetching %s because it has been superseded", object_version
+        )
+        return
     except Exception:
         logger.exception("Error retrieving by-reference file")
         tags[ObjectTagKey.FileState] = FileState.Error
@@ -74,61 +116,420 @@ def dereference_object(record_id, version_id):
 
 
 @celery.shared_task
-def unpack_object(record_id, version_id):
+def dereference_and_unpack_object(record_id, version_id):
+    """Downloads a by-reference file and unpacks it in a single pass
+
+    This is used in place of :func:`dereference_object` followed by :func:`unpack_object` for packagings that can
+    unpack streams. The response is written to storage as it's unpacked, so it's never read back.
+
+    This deliberately doesn't take the bucket lock, which would otherwise be held for the length of the download.
+    """
     record = SWORDDeposit.get_record(record_id)
 
     object_version: ObjectVersion = ObjectVersion.query.filter(
         ObjectVersion.version_id == version_id
     ).one()
-    if not object_version.is_head:
+    if is_superseded(object_version):
         logger.info(
-            "Not fetching by-reference file (%s) because a newer version of the object now exists",
+            "Not fetching by-reference file (%s) because it has been superseded",
             object_version,
         )
         return
 
+    if object_version.file_id:
+        logger.warning("File has already been dereferenced (%s)", object_version)
+        return
+
     tags = TagManager(object_version)
 
     try:
         packaging = Packaging.for_record_and_name(record, tags[ObjectTagKey.Packaging])
-        keys = packaging.unpack(object_version)
+        packaging.progress = ProgressReporter(object_version)
+        tags[ObjectTagKey.FileState] = FileState.Downloading
+        url = tags[ObjectTagKey.ByReferenceURL]
+        file_instance = get_cached_file(url, size=get_declared_size(tags))
+        if file_instance:
+            # There's no need to download it again, but it still needs unpacking
+            logger.info("Using cached download of %s", url)
+            object_version.set_file(file_instance)
+            tags[ObjectTagKey.FileState] = FileState.Unpacking
+            packaging.unpack(object_version)
+        else:
+            with Download(url, max_size=get_size_limit(object_version)) as download:
+                packaging.ingest_stream(
+                    object_version,
+                    ProgressReader(
+                        track_download(download, packaging.progress),
+                        lambda position: check_superseded(object_version),
+                        current_app.config["SWORD_DOWNLOAD_CHECKPOINT_INTERVAL"],
+                    ),
+                )
+            add_to_cache(
+                url,
+                object_version.file,
+                etag=download.etag,
+                last_modified=download.last_modified,
+            )
         tags[ObjectTagKey.FileState] = FileState.Ingested
-        return [object_version.key] + list(keys)
+        del tags[ObjectTagKey.ByReferenceNotDeleted]
+    except Superseded:
+        logger.info(
+            "Stopped fetching %s because it has been superseded", object_version
+        )
+        # Discard the files unpacked so far, rather than committing them below
+        db.session.rollback()
+        return
+    except Exception:
+        logger.exception("Error retrieving and unpacking by-reference file")
+        tags[ObjectTagKey.FileState] = FileState.Error
+        raise
+    finally:
+        db.session.commit()
+
+    for signature in packaging.deferred_tasks:
+        signature.delay()
+
+
+@celery.shared_task(bind=True)
+def dereference_objects(self, record_id, version_ids):
+    """Dereferences and unpacks several objects in turn, as queued by :meth:`SWORDDeposit.dereference_objects`
+
+    Archives large enough to be unpacked in chunks are left to their own :func:`unpack_object` tasks, which run once
+    all the downloads have finished. An error with one object doesn't stop the others from being processed, but is
+    raised at the end.
+    """
+    record = SWORDDeposit.get_record(record_id)
+
+    unpack_signatures, error = [], None
+    for version_id in version_ids:
+        object_version: ObjectVersion = ObjectVersion.query.filter(
+            ObjectVersion.version_id == version_id
+        ).one()
+        try:
+            if record.dereference_streams(object_version):
+                dereference_and_unpack_object(record_id, version_id)
+                continue
+            dereference_object(record_id, version_id)
+            packaging = Packaging.for_record_and_name(
+                record, TagManager(object_version)[ObjectTagKey.Packaging]
+            )
+            if object_version.file_id and packaging.get_unpack_chunks(object_version):
+                # Tracked so that it can be revoked if the deposit is superseded before it runs
+                unpack_signatures.append(
+                    record.track_tasks(
+                        [object_version],
+                        unpack_object.si(record_id, version_id),
+                        add=True,
+                    )
+                )
+            else:
+                unpack_object(record_id, version_id)
+        except Exception as e:
+            error = error or e
+
+    if error:
+        db.session.commit()
+        # Archives that were downloaded should still be unpacked, as they would be if they'd been queued individually
+        for signature in unpack_signatures:
+            signature.delay()
+        raise error
+
+    if unpack_signatures:
+        db.session.commit()
+        return self.replace(celery.group(unpack_signatures))
+
+
+# Acknowledged late so that the task is redelivered if its worker dies, resuming from the last checkpoint. Retried for as
+# long as another task holds the bucket lock.
+@celery.shared_task(
+    bind=True, acks_late=True, reject_on_worker_lost=True, max_retries=None
+)
+def unpack_object(self, record_id, version_id):
+    record = SWORDDeposit.get_record(record_id)
+
+    object_version: ObjectVersion = ObjectVersion.query.filter(
+        ObjectVersion.version_id == version_id
+    ).one()
+    if is_superseded(object_version):
+        logger.info(
+            "Not unpacking %s because it has been superseded", object_version,
+        )
+        return
+
+    tags = TagManager(object_version)
+
+    with bucket_lock(self, object_version.bucket_id) as lock:
+        try:
+            packaging = Packaging.for_record_and_name(
+                record, tags[ObjectTagKey.Packaging]
+            )
+            packaging.resumable = True
+            packaging.progress = ProgressReporter(object_version)
+            chunks = packaging.get_unpack_chunks(object_version)
+            if not chunks:
+                packaging.unpack(object_version)
+                tags[ObjectTagKey.FileState] = FileState.Ingested
+        except Superseded:
+            logger.info(
+                "Stopped unpacking %s because it has been superseded", object_version
+            )
+            return
+        except Exception:
+            logger.exception(
+                "Failed to unpack %s:%s", object_version.bucket_id, object_version.key
+            )
+            tags[ObjectTagKey.FileState] = FileState.Error
+            raise
+        finally:
+            db.session.commit()
+        if chunks:
+            # The chunks hold the lock in this task's name, and finish_unpack releases it
+            lock_owner = lock.hand_over()
+
+    if chunks:
+        # Spread the work across workers. Whatever follows this task in a chain will wait for finish_unpack.
+        header = [
+            unpack_chunk.si(record_id, version_id, start, end, lock_owner=lock_owner)
+            for start, end in chunks
+        ]
+        # The chunks are tracked alongside this task, whose ID finish_unpack takes over, so that a later deposit can
+        # revoke them. They don't report progress, so aren't looked up for it.
+        record.track_tasks([object_version], *header, add=True, reports_progress=False)
+        body = finish_unpack.s(record_id, version_id, lock_owner=lock_owner)
+        body.set(**get_task_options(body.task, record, [object_version]))
+        db.session.commit()
+        return self.replace(celery.chord(header, body))
+
+    # Only now that the unpacked files have been committed can follow-up tasks see them
+    for signature in packaging.deferred_tasks:
+        signature.delay()
+
+
+@celery.shared_task
+def unpack_chunk(record_id, version_id, start, end, lock_owner=None):
+    """Unpacks a range of members of a large archive, as planned by :meth:`Packaging.get_unpack_chunks`
+
+    Errors are recorded on the archive rather than raised, so that :func:`finish_unpack` still runs to release the
+    bucket lock.
+
+    :param lock_owner: the owner of the bucket lock handed over by :func:`unpack_object`
+    :return: whether the members were unpacked
+    """
+    record = SWORDDeposit.get_record(record_id)
+
+    object_version: ObjectVersion = ObjectVersion.query.filter(
+        ObjectVersion.version_id == version_id
+    ).one()
+    if is_superseded(object_version):
+        logger.info(
+            "Not unpacking %s because it has been superseded", object_version,
+        )
+        return False
+
+    tags = TagManager(object_version)
+
+    try:
+        # Also extends the lock's expiry
+        if lock_owner and not acquire_bucket_lock(object_version.bucket_id, lock_owner):
+            raise RuntimeError(
+                "Lost the lock on bucket {}".format(object_version.bucket_id)
+            )
+        packaging = Packaging.for_record_and_name(record, tags[ObjectTagKey.Packaging])
+        packaging.interruptible = True
+        packaging.unpack_chunk(object_version, start, end)
+    except Superseded:
+        logger.info(
+            "Stopped unpacking %s because it has been superseded", object_version
+        )
+        return False
     except Exception:
         logger.exception(
-            "Failed to unpack %s:%s", object_version.bucket_id, object_version.key
+            "Failed to unpack members %d to %d of %s:%s",
+            start,
+            end,
+            object_version.bucket_id,
+            object_version.key,
         )
         tags[ObjectTagKey.FileState] = FileState.Error
-        raise
+        return False
     finally:
         db.session.commit()
 
+    for signature in packaging.deferred_tasks:
+        signature.delay()
+    return True
+
+
+@celery.shared_task
+def finish_unpack(results, record_id, version_id, lock_owner=None):
+    """Marks an archive as ingested once all its :func:`unpack_chunk` tasks have succeeded, and releases the bucket lock
+
+    If any chunk failed this raises, so that whatever follows in a chain doesn't run, as if the archive had been
+    unpacked by a single task.
+
+    :param results: the results of the :func:`unpack_chunk` tasks
+    """
+    object_version: ObjectVersion = ObjectVersion.query.filter(
+        ObjectVersion.version_id == version_id
+    ).one()
+    try:
+        if is_superseded(object_version):
+            logger.info(
+                "Not marking %s as ingested because it has been superseded",
+                object_version,
+            )
+            return
+        if not all(results):
+            raise RuntimeError(
+                "Failed to unpack {}:{}".format(
+                    object_version.bucket_id, object_version.key
+                )
+            )
+        TagManager(object_version)[ObjectTagKey.FileState] = FileState.Ingested
+        db.session.commit()
+    finally:
+        if lock_owner:
+            release_bucket_lock(object_version.bucket_id, lock_owner)
+
 
 @celery.shared_task
-def delete_old_objects(
-    ignore_keys: Union[Sequence[AsyncResult], Iterable[str]] = (), *, bucket_id: str
-):
-    for object_version in ObjectVersion.query.join(ObjectVersionTag).filter(
-        ObjectVersion.bucket_id == bucket_id,
-        ObjectVersion.key.notin_(ignore_keys),
-        ObjectVersion.is_head == true(),
-        ObjectVersionTag.key.in_(
-            [
-                ObjectTagKey.FileSetFile.value,
-                ObjectTagKey.DerivedFrom.value,
-                ObjectTagKey.OriginalDeposit.value,
+def verify_fixity(record_id, version_id):
+    """Checks the unpacked payload of a BagIt deposit against its manifests
+
+    This is queued by :class:`invenio_sword.packaging.SWORDBagItPackaging` when the ``bagit_deferred_fixity`` endpoint
+    option is set.
+    """
+    record = SWORDDeposit.get_record(record_id)
+
+    object_version: ObjectVersion = ObjectVersion.query.filter(
+        ObjectVersion.version_id == version_id
+    ).one()
+    if not object_version.is_head:
+        logger.info(
+            "Not verifying fixity for %s because a newer version of the object now exists",
+            object_version,
+        )
+        return
+
+    try:
+        packaging = Packaging.for_record_and_name(
+            record, TagManager(object_version)[ObjectTagKey.Packaging]
+        )
+        if not packaging.verify_fixity(object_version):
+            logger.warning(
+                "Fixity check failed for %s:%s",
+                object_version.bucket_id,
+                object_version.key,
+            )
+    finally:
+        db.session.commit()
+
+
+@celery.shared_task(bind=True, max_retries=None)
+def delete_old_objects(self, *, bucket_id: str, generation: str = None):
+    """Deletes the files and by-reference placeholders from deposits made before ``generation``
+
+    Objects from ``generation`` or a later one are kept, as are objects that aren't part of the deposit, like metadata.
+    Without a ``generation``, every such object is deleted.
+    """
+
+    with bucket_lock(self, bucket_id):
+        old_objects = ObjectVersion.query.filter(
+            ObjectVersion.bucket_id == bucket_id,
+            ObjectVersion.is_head == true(),
+            ObjectVersion.version_id.in_(
+                db.session.query(ObjectVersionTag.version_id).filter(
+                    ObjectVersionTag.key.in_(
+                        [
+                            ObjectTagKey.FileSetFile.value,
+                            ObjectTagKey.DerivedFrom.value,
+                            ObjectTagKey.OriginalDeposit.value,
+                        ]
+                    )
+                )
+            ),
+        )
+        if generation:
+            current_generation_tag = aliased(ObjectVersionTag)
+            old_objects = old_objects.filter(
+                ~exists().where(
+                    and_(
+                        current_generation_tag.version_id == ObjectVersion.version_id,
+                        current_generation_tag.key == ObjectTagKey.Generation.value,
+                        current_generation_tag.value >= generation,
+                    )
+                )
+            )
+
+        not_deleted_tag = aliased(ObjectVersionTag)
+        old_objects = old_objects.filter(
+            or_(
+                ObjectVersion.file_id.isnot(None),
+                # By-reference placeholders are only deleted until their tag saying they're extant has gone
+                exists().where(
+                    and_(
+                        not_deleted_tag.version_id == ObjectVersion.version_id,
+                        not_deleted_tag.key == ObjectTagKey.ByReferenceNotDeleted.value,
+                        not_deleted_tag.value == "true",
+                    )
+                ),
+            )
+        )
+
+        # Each batch is committed, so that locks are held briefly. Deleted objects no longer match, so each query picks up
+        # where the last left off.
+        batch_size = current_app.config["SWORD_DELETE_BATCH_SIZE"]
+        while True:
+            batch = (
+                old_objects.with_entities(
+                    ObjectVersion.version_id, ObjectVersion.key, ObjectVersion.file_id
+                )
+                .limit(batch_size)
+                .all()
+            )
+            extant = [
+                (version_id, key) for version_id, key, file_id in batch if file_id
             ]
-        ),
-    ):
-        if object_version.file_id:
-            # Delete any extant files
-            ObjectVersion.delete(object_version.bucket, object_version.key)
-        else:
-            # Delete any tags that say that an ObjectVersion is a yet-to-be-dereferenced file
-            ObjectVersionTag.query.filter(
-                ObjectVersionTag.version_id == object_version.version_id,
-                ObjectVersionTag.key == ObjectTagKey.ByReferenceNotDeleted.value,
-                ObjectVersionTag.value == "true",
-            ).delete()
-
-    db.session.commit()
+            placeholders = [
+                version_id for version_id, _, file_id in batch if not file_id
+            ]
+            if not (extant or placeholders):
+                break
+
+            if extant:
+                # Delete any extant files, by replacing them with delete markers as ObjectVersion.delete() does
+                if Bucket.query.get(bucket_id).locked:
+                    raise BucketLockedError()
+                ObjectVersion.query.filter(
+                    ObjectVersion.version_id.in_(
+                        [version_id for version_id, _ in extant]
+                    )
+                ).update({ObjectVersion.is_head: False}, synchronize_session=False)
+                now = datetime.datetime.utcnow()
+                db.session.execute(
+                    ObjectVersion.__table__.insert().values(
+                        [
+                            {
+                                "version_id": uuid.uuid4(),
+                                "key": key,
+                                "bucket_id": bucket_id,
+                                "file_id": None,
+                                "_mimetype": None,
+                                "is_head": True,
+                                "created": now,
+                                "updated": now,
+                            }
+                            for _, key in extant
+                        ]
+                    )
+                )
+            if placeholders:
+                # Delete any tags that say that an ObjectVersion is a yet-to-be-dereferenced file
+                ObjectVersionTag.query.filter(
+                    ObjectVersionTag.version_id.in_(placeholders),
+                    ObjectVersionTag.key == ObjectTagKey.ByReferenceNotDeleted.value,
+                    ObjectVersionTag.value == "true",
+                ).delete(synchronize_session=False)
+
+            notify_on_commit(bucket_id)
+            db.session.commit()
@@ -61,3 +61,5 @@ class SwordEndpointDefinition(TypedDict):
     default_media_type: str
 
     dereference_policy: Callable[[ObjectVersion, ByReferenceFileDefinition], bool]
+
+    bagit_deferred_fixity: bool
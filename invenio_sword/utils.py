@@ -5,8 +5,10 @@ from typing import Union
 
 from invenio_files_rest.models import ObjectVersion
 from invenio_files_rest.models import ObjectVersionTag
+from sqlalchemy import true
 from invenio_sword.enum import FileState
 from invenio_sword.enum import ObjectTagKey
+from invenio_sword.notify import notify_on_commit
 
 
 class TagManager(Dict[ObjectTagKey, Union[str, Enum]]):
@@ -31,6 +33,9 @@ class TagManager(Dict[ObjectTagKey, Union[str, Enum]]):
         if isinstance(value, Enum):
             value = value.value
         ObjectVersionTag.create_or_update(self._object_version, key.value, value)
+        if key == ObjectTagKey.FileState:
+            # Wake any clients waiting for the deposit's status to change
+            notify_on_commit(self._object_version.bucket_id)
 
     def __delitem__(self, key: ObjectTagKey):  # type: ignore
         ObjectVersionTag.delete(self._object_version, key.value)
@@ -45,3 +50,34 @@ class TagManager(Dict[ObjectTagKey, Union[str, Enum]]):
             self[mapping_key] = value
         for kwargs_key, value in kwargs.items():
             self[ObjectTagKey(kwargs_key)] = value
+
+
+class Superseded(Exception):
+    """Raised to abandon work on an object version that is no longer wanted"""
+
+
+def is_superseded(object_version: ObjectVersion) -> bool:
+    """Whether ``object_version`` is no longer head, or has been replaced by a later deposit
+
+    This queries the database instead of trusting the session, so that long-running tasks see changes committed since
+    they started.
+    """
+    is_head = ObjectVersion.query.filter(
+        ObjectVersion.version_id == object_version.version_id,
+        ObjectVersion.is_head == true(),
+    ).count()
+    superseded_by = ObjectVersionTag.query.filter(
+        ObjectVersionTag.version_id == object_version.version_id,
+        ObjectVersionTag.key == ObjectTagKey.SupersededBy.value,
+    ).count()
+    return not is_head or bool(superseded_by)
+
+
+def check_superseded(object_version: ObjectVersion) -> None:
+    """Raises :class:`Superseded` if :func:`is_superseded`"""
+    if is_superseded(object_version):
+        raise Superseded(
+            "{}:{} has been superseded".format(
+                object_version.bucket_id, object_version.key
+            )
+        )
@@ -12,6 +12,7 @@ from werkzeug.utils import cached_property
 
 from ..api import SWORDDeposit
 from ..metadata import Metadata
+from ..notify import notify_on_commit
 from ..schemas import ByReferenceSchema
 from ..typing import BytesReader
 
@@ -161,6 +162,7 @@ class SWORDDepositView(ContentNegotiatedMethodView):
         self.update_deposit_status(record)
 
         record.commit()
+        notify_on_commit(record.bucket_id)
         db.session.commit()
 
     def ingest_file(
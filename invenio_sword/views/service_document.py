@@ -33,7 +33,15 @@ class ServiceDocumentView(SWORDDepositView):
             "maxUploadSize": current_app.config["SWORD_MAX_UPLOAD_SIZE"],
             "maxByReferenceSize": current_app.config["SWORD_MAX_BY_REFERENCE_SIZE"],
             # Accepted formats
-            "acceptArchiveFormat": ["application/zip"],
+            "acceptArchiveFormat": sorted(
+                {
+                    media_type
+                    for packaging_class in self.endpoint_options[
+                        "packaging_formats"
+                    ].values()
+                    for media_type in packaging_class.archive_formats
+                }
+            ),
             "acceptPackaging": sorted(self.endpoint_options["packaging_formats"]),
             "acceptMetadata": sorted(self.endpoint_options["metadata_formats"]),
             # Segmented uploads
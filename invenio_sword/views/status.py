@@ -1,12 +1,20 @@
+import hashlib
+import json
+import time
+import typing
 from http import HTTPStatus
 
+from flask import current_app
+from flask import request
 from flask import Response
 from invenio_db import db
 from invenio_records_rest.views import need_record_permission
 from invenio_records_rest.views import pass_record
+from invenio_rest.errors import SameContentException
 
 from . import SWORDDepositView
 from ..api import SWORDDeposit
+from ..notify import subscribe
 
 __all__ = ["DepositStatusView"]
 
@@ -19,9 +27,98 @@ class DepositStatusView(SWORDDepositView):
     def get(self, pid, record: SWORDDeposit):
         """Retrieve a SWORD status document for a deposit record
 
+        A client that sends the document's ETag in ``If-None-Match`` along with ``Prefer: wait=<seconds>`` isn't sent a
+        response until the deposit changes, or ``304 Not Modified`` once it has waited that long for it to do so. Changes
+        in the progress of downloads and unpacking alone don't end the wait.
+
         :see also: https://swordapp.github.io/swordv3/swordv3.html#9.6.
         """
-        return record.get_status_as_jsonld()
+        status = record.get_status_as_jsonld()
+        state_etag = self.get_state_etag(status)
+        wait = self.requested_wait
+        waited = False
+        if wait and state_etag in {
+            etag.partition("-")[0] for etag in request.if_none_match.as_set()
+        }:
+            latest_status = self.wait_for_change(record, status, wait)
+            if latest_status is not None:
+                status, waited = latest_status, True
+
+        etag = self.get_etag(status)
+        if waited and self.get_state_etag(status) == state_etag:
+            # Timed out, though the progress may have changed
+            raise SameContentException(etag)
+        self.check_etag(etag)
+        response = self.make_response(status)
+        response.set_etag(etag)
+        if waited:
+            response.headers["Preference-Applied"] = "wait={}".format(wait)
+        return response
+
+    @property
+    def requested_wait(self) -> typing.Optional[int]:
+        """The number of seconds the client would wait for the deposit to change, capped at ``SWORD_STATUS_MAX_WAIT``
+
+        :see also: https://tools.ietf.org/html/rfc7240#section-4.3
+        """
+        for preference in request.headers.get("Prefer", "").split(","):
+            name, _, value = preference.partition("=")
+            if name.strip().lower() == "wait":
+                try:
+                    wait = int(value.strip().strip('"'))
+                except ValueError:
+                    return None
+                wait = min(wait, current_app.config["SWORD_STATUS_MAX_WAIT"])
+                return wait if wait > 0 else None
+        return None
+
+    @classmethod
+    def get_etag(cls, status: typing.Dict[str, typing.Any]) -> str:
+        """An ETag for the whole status document, prefixed with its :meth:`get_state_etag`"""
+        return "{}-{}".format(cls.get_state_etag(status), _digest(status))
+
+    @staticmethod
+    def get_state_etag(status: typing.Dict[str, typing.Any]) -> str:
+        """An ETag for the status document without the progress of downloads and unpacking
+
+        This is what's compared when waiting, as progress changes too often to be worth waiting for.
+        """
+        return _digest(
+            dict(
+                status,
+                links=[
+                    {key: value for key, value in link.items() if key != "progress"}
+                    for link in status.get("links", [])
+                ],
+            )
+        )
+
+    def wait_for_change(
+        self, record: SWORDDeposit, status: typing.Dict[str, typing.Any], wait: int
+    ) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        """Waits up to ``wait`` seconds for the state of a deposit to change, returning the latest status
+
+        This returns ``None`` straight away if changes can't be subscribed to, such as when the broker is down.
+        """
+        deadline = time.monotonic() + wait
+        etag = self.get_state_etag(status)
+        with subscribe(record.bucket_id) as subscription:
+            if subscription is None:
+                return None
+            while True:
+                # Check again once subscribed, in case of changes since the status was read, and then after each
+                # notification. Ending the transaction each time means that changes committed since are seen, and
+                # that no database connection is held while waiting.
+                db.session.commit()
+                status = SWORDDeposit.get_record(record.id).get_status_as_jsonld()
+                db.session.commit()
+                remaining = deadline - time.monotonic()
+                if (
+                    self.get_state_etag(status) != etag
+                    or remaining <= 0
+                    or not subscription.wait(remaining)
+                ):
+                    return status
 
     @pass_record
     @need_record_permission("update_permission_factory")
@@ -44,3 +141,7 @@ class DepositStatusView(SWORDDepositView):
         record.delete()
         db.session.commit()
         return Response(status=HTTPStatus.NO_CONTENT)
+
+
+def _digest(value: typing.Any) -> str:
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
@@ -33,7 +33,6 @@ readme = open("README.rst").read()
 history = open("CHANGES.rst").read()
 
 install_requires = [
-    "bagit",
     "marshmallow",
     "rdflib",
     "rdflib-jsonld",
@@ -46,6 +45,7 @@ install_requires = [
     "invenio-records-rest",
     "rfc6266-parser",
     "sword3common",
+    "urllib3",
     # We use typing.Protocol, which is Py3.8+, but is available in typing-extensions for backwards compatibility
     'typing-extensions;python_version<"3.8"',
 ]
@@ -81,6 +81,7 @@ setup(
             "http://purl.org/net/sword/3.0/package/Binary = invenio_sword.packaging:BinaryPackaging",
             "http://purl.org/net/sword/3.0/package/SimpleZip = invenio_sword.packaging:SimpleZipPackaging",
             "http://purl.org/net/sword/3.0/package/SWORDBagIt = invenio_sword.packaging:SWORDBagItPackaging",
+            "https://swordapp.github.io/invenio-sword/package/SimpleTar = invenio_sword.packaging:SimpleTarPackaging",
         ],
         "invenio_sword.metadata": [
             "http://purl.org/net/sword/3.0/types/Metadata = invenio_sword.metadata:SWORDMetadata",
@@ -88,7 +89,10 @@ setup(
         "invenio_celery.tasks": ["invenio_sword = invenio_sword.tasks",],
     },
     install_requires=install_requires,
-    extras_require={"test": ["pytest", "pytest-httpserver",]},
+    extras_require={
+        "test": ["pytest", "pytest-httpserver", "zstandard"],
+        "zstd": ["zstandard"],
+    },
     python_requires=">=3.7",
     classifiers=[
         "Environment :: Web Environment",
@@ -25,6 +25,7 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import contextlib
 import datetime
 import io
 import json
@@ -34,6 +35,7 @@ import tempfile
 import unittest.mock
 from time import sleep
 
+import kombu
 import pytest
 from celery.canvas import Signature
 from celery import Task
@@ -468,6 +470,21 @@ def task_delay():
         yield mock_obj
 
 
+@pytest.yield_fixture()
+def memory_broker():
+    """Sends change notifications through an in-memory broker"""
+
+    @contextlib.contextmanager
+    def get_producer():
+        with kombu.Connection("memory://") as connection:
+            yield connection.Producer()
+
+    with unittest.mock.patch(
+        "invenio_sword.notify.get_connection", lambda: kombu.Connection("memory://"),
+    ), unittest.mock.patch("invenio_sword.notify.get_producer", get_producer):
+        yield
+
+
 @pytest.fixture()
 def fixtures_path():
     return os.path.join(os.path.dirname(__file__), "fixtures")
@@ -22,7 +22,10 @@
 # waive the privileges and immunities granted to it by virtue of its status
 # as an Intergovernmental Organization or submit itself to any jurisdiction.
 """Test the BagIt implementation."""
+import io
 import os
+import unittest.mock
+import zipfile
 from http import HTTPStatus
 
 import pytest
@@ -30,14 +33,20 @@ from flask import url_for
 from flask_security import url_for_security
 from invenio_files_rest.models import Bucket
 from invenio_files_rest.models import ObjectVersion
+from invenio_db import db
 from invenio_records.models import RecordMetadata
 from sword3common.constants import PackagingFormat
 from sword3common.exceptions import ContentMalformed
 from sword3common.exceptions import ContentTypeNotAcceptable
 from sword3common.exceptions import ValidationFailed
 
+from invenio_sword import tasks
 from invenio_sword.api import SWORDDeposit
+from invenio_sword.enum import FileState
+from invenio_sword.enum import ObjectTagKey
 from invenio_sword.packaging import Packaging
+from invenio_sword.packaging.bagit import ZipBag
+from invenio_sword.utils import TagManager
 
 
 def test_post_service_document_with_bagit_bag(
@@ -145,3 +154,153 @@ def test_post_service_document_with_incorrect_content_type(
         packaging = Packaging.for_record_and_name(record, PackagingFormat.SwordBagIt)
         with pytest.raises(ContentTypeNotAcceptable):
             packaging.unpack(object_version)
+
+
+@pytest.fixture()
+def broken_payload_bag_path(fixtures_path, tmpdir):
+    # Rewrite a valid bag with payload files that don't match the manifests
+    path = os.path.join(str(tmpdir), "bagit-broken-payload.zip")
+    with zipfile.ZipFile(os.path.join(fixtures_path, "bagit.zip")) as source:
+        with zipfile.ZipFile(path, "w") as target:
+            for info in source.infolist():
+                data = source.read(info)
+                if info.filename.startswith("data/"):
+                    data = data.upper()
+                target.writestr(info, data)
+    return path
+
+
+def test_unpack_bag_with_broken_payload(api, location, broken_payload_bag_path):
+    path = broken_payload_bag_path
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        with open(path, "rb") as stream:
+            object_version = ObjectVersion.create(
+                bucket=record.bucket,
+                key="bagit.zip",
+                stream=stream,
+                mimetype="application/zip",
+            )
+
+        packaging = Packaging.for_record_and_name(record, PackagingFormat.SwordBagIt)
+        with pytest.raises(ValidationFailed) as exc_info:
+            packaging.unpack(object_version)
+        assert "data/hello.txt sha256 validation failed" in exc_info.value.message
+        assert "data/hello.txt sha512 validation failed" in exc_info.value.message
+
+        # Nothing was ingested
+        assert (
+            ObjectVersion.query.filter(ObjectVersion.bucket == record.bucket).count()
+            == 1
+        )
+
+
+def test_unpack_bag_without_extracting(api, location, fixtures_path):
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        with open(os.path.join(fixtures_path, "bagit.zip"), "rb") as stream:
+            object_version = ObjectVersion.create(
+                bucket=record.bucket,
+                key="bagit.zip",
+                stream=stream,
+                mimetype="application/zip",
+            )
+
+        packaging = Packaging.for_record_and_name(record, PackagingFormat.SwordBagIt)
+        with unittest.mock.patch.object(
+            zipfile.ZipFile, "extractall", side_effect=AssertionError
+        ):
+            keys = packaging.unpack(object_version)
+
+        assert keys == {"example.svg", "hello.txt"}
+        assert record["bagitInfo"]["Payload-Oxum"] == "473.2"
+
+
+@pytest.mark.parametrize(
+    "filename,fixity_status", [("bagit.zip", "verified"), (None, "failed")]
+)
+def test_deferred_fixity(
+    api,
+    location,
+    es,
+    monkeypatch,
+    fixtures_path,
+    broken_payload_bag_path,
+    filename,
+    fixity_status,
+):
+    monkeypatch.setitem(
+        api.config["SWORD_ENDPOINTS"]["depid"], "bagit_deferred_fixity", True
+    )
+    path = (
+        os.path.join(fixtures_path, filename) if filename else broken_payload_bag_path
+    )
+
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        with open(path, "rb") as stream:
+            object_version = ObjectVersion.create(
+                bucket=record.bucket,
+                key="bagit.zip",
+                stream=stream,
+                mimetype="application/zip",
+            )
+        TagManager(object_version)[ObjectTagKey.Packaging] = PackagingFormat.SwordBagIt
+
+        packaging = Packaging.for_record_and_name(record, PackagingFormat.SwordBagIt)
+
+        # Even a bag with broken checksums gets ingested straight away
+        assert packaging.unpack(object_version) == {"example.svg", "hello.txt"}
+        assert record["bagitFixity"] == {"status": "pending"}
+        assert packaging.deferred_tasks == [
+            tasks.verify_fixity.si(str(record.id), str(object_version.version_id))
+        ]
+        db.session.commit()
+
+        tasks.verify_fixity(str(record.id), str(object_version.version_id))
+
+        record = SWORDDeposit.get_record(record.id)
+        assert record["bagitFixity"]["status"] == fixity_status
+
+        expected_state = FileState.Error if fixity_status == "failed" else None
+        for key in ("bagit.zip", "example.svg", "hello.txt"):
+            tags = TagManager(ObjectVersion.get(record.bucket, key))
+            assert tags.get(ObjectTagKey.FileState) == expected_state
+
+
+def make_bag(declaration: str, manifest: str) -> zipfile.ZipFile:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip:
+        zip.writestr("bagit.txt", declaration)
+        zip.writestr("manifest-sha256.txt", manifest)
+    return zipfile.ZipFile(buffer)
+
+
+def test_manifest_paths_only_decode_cr_lf_and_percent():
+    bag = ZipBag(
+        make_bag(
+            "BagIt-Version: 1.0\nTag-File-Character-Encoding: UTF-8\n",
+            "0000  data/100%41.txt\n"
+            "1111  data/50%25.txt\n"
+            "2222  data/two%0Alines.txt\n"
+            "3333  data/two%0d%0alines.txt\n",
+        )
+    )
+    assert bag.manifests["sha256"] == {
+        "data/100%41.txt": "0000",
+        "data/50%.txt": "1111",
+        "data/two\nlines.txt": "2222",
+        "data/two\r\nlines.txt": "3333",
+    }
+
+
+def test_repeated_tag_file_encoding():
+    with pytest.raises(ContentMalformed):
+        ZipBag(
+            make_bag(
+                "BagIt-Version: 1.0\n"
+                "Tag-File-Character-Encoding: UTF-8\n"
+                "Tag-File-Character-Encoding: ISO-8859-1\n",
+                "",
+            )
+        )
@@ -1,29 +1,49 @@
+import hashlib
 import io
 import json
+import os
+import tarfile
 import unittest.mock
 import urllib.error
 import uuid
 from http import HTTPStatus
+from typing import Tuple
 
+import celery
 import pytest
 import pytest_httpserver
+import werkzeug
 from flask_security import url_for_security
 from invenio_db import db
 from invenio_files_rest.models import Bucket
+from invenio_files_rest.models import FileInstance
 from invenio_files_rest.models import ObjectVersion
 from invenio_records.models import RecordMetadata
+from invenio_sword.schemas import ByReferenceFileDefinition
 from invenio_sword.schemas import ByReferenceSchema
 from sword3common.constants import JSON_LD_CONTEXT
 from sword3common.constants import PackagingFormat
+from sword3common.exceptions import ByReferenceFileSizeExceeded
 from sword3common.exceptions import ContentTypeNotAcceptable
 
 from invenio_sword import tasks
 from invenio_sword.api import SWORDDeposit
+from invenio_sword.cache import get_cache_bucket
+from invenio_sword.download import Throttle
 from invenio_sword.enum import FileState
 from invenio_sword.enum import ObjectTagKey
 from invenio_sword.utils import TagManager
 
 
+def with_task_ids(object_version: ObjectVersion, *signatures: celery.Signature):
+    """Gives signatures the task IDs recorded for an object version, to compare them with those queued"""
+    task_ids = TagManager(object_version)[ObjectTagKey.TaskIDs].split()
+    assert len(task_ids) == len(signatures)
+    for signature, task_id in zip(signatures, task_ids):
+        signature.set(task_id=task_id)
+    return signatures[0]
+
+
 @pytest.mark.parametrize(
     "data,fields_with_errors, fields_without_errors",
     [
@@ -69,6 +89,7 @@ def test_by_reference_validation(
         assert not (set(response.json["errors"]) & set(fields_without_errors))
 
 
+@pytest.mark.parametrize("streaming_dereference", [True, False])
 def test_by_reference_deposit(
     api,
     users,
@@ -76,7 +97,12 @@ def test_by_reference_deposit(
     es,
     httpserver: pytest_httpserver.HTTPServer,
     task_delay: unittest.mock.Mock,
+    monkeypatch,
+    streaming_dereference,
 ):
+    monkeypatch.setitem(
+        api.config, "SWORD_STREAMING_DEREFERENCE", streaming_dereference
+    )
     with api.test_request_context(), api.test_client() as client:
         client.post(
             url_for_security("login"),
@@ -114,18 +140,24 @@ def test_by_reference_deposit(
 
         record_metadata = RecordMetadata.query.one()
 
-        assert task_delay.call_args_list == (
-            [
-                unittest.mock.call(
-                    tasks.dereference_object.s(
-                        str(record_metadata.id), str(object_version.version_id)
-                    )
-                    | tasks.unpack_object.si(
-                        str(record_metadata.id), str(object_version.version_id)
-                    )
-                )
-            ]
-        )
+        if streaming_dereference:
+            # Binary files can be downloaded and unpacked in one go
+            expected_task = with_task_ids(
+                object_version,
+                tasks.dereference_and_unpack_object.s(
+                    str(record_metadata.id), str(object_version.version_id)
+                ),
+            )
+        else:
+            dereference_task = tasks.dereference_object.s(
+                str(record_metadata.id), str(object_version.version_id)
+            )
+            unpack_task = tasks.unpack_object.si(
+                str(record_metadata.id), str(object_version.version_id)
+            )
+            with_task_ids(object_version, dereference_task, unpack_task)
+            expected_task = dereference_task | unpack_task
+        assert task_delay.call_args_list == [unittest.mock.call(expected_task)]
 
         # Ensure that no requests were made
         assert httpserver.log == []
@@ -187,14 +219,15 @@ def test_by_reference_and_metadata_deposit(
             "title_statement": {"title": "Some data"}
         }
 
+        # Binary files can be downloaded and unpacked in one go
         assert task_delay.call_args_list == (
             [
                 unittest.mock.call(
-                    tasks.dereference_object.s(
-                        str(record_metadata.id), str(object_version.version_id)
-                    )
-                    | tasks.unpack_object.si(
-                        str(record_metadata.id), str(object_version.version_id)
+                    with_task_ids(
+                        object_version,
+                        tasks.dereference_and_unpack_object.s(
+                            str(record_metadata.id), str(object_version.version_id)
+                        ),
                     )
                 )
             ]
@@ -224,7 +257,11 @@ def test_dereference_task(
         httpserver.expect_request("/some-file.txt").respond_with_data(file_contents)
 
         db.session.refresh(object_version)
-        tasks.dereference_object(record.id, object_version.version_id)
+        # The checksum is computed as the file is downloaded, without reading it back
+        with unittest.mock.patch.object(
+            FileInstance, "update_checksum", side_effect=AssertionError
+        ):
+            tasks.dereference_object(record.id, object_version.version_id)
 
         # Check requests
         assert len(httpserver.log) == 1
@@ -235,6 +272,10 @@ def test_dereference_task(
         assert object_version.file.storage().open().read() == file_contents.encode(
             "utf-8"
         )
+        assert (
+            object_version.file.checksum
+            == "md5:" + hashlib.md5(file_contents.encode("utf-8")).hexdigest()
+        )
 
         assert TagManager(object_version) == {
             ObjectTagKey.ByReferenceURL: httpserver.url_for("some-file.txt"),
@@ -243,6 +284,195 @@ def test_dereference_task(
         }
 
 
+@pytest.mark.parametrize(
+    "packaging,expected_keys",
+    [
+        (PackagingFormat.Binary, {"some-file.tar.gz"}),
+        (
+            "https://swordapp.github.io/invenio-sword/package/SimpleTar",
+            {"some-file.tar.gz", "hello.txt"},
+        ),
+    ],
+)
+def test_dereference_and_unpack_task(
+    api,
+    users,
+    location,
+    es,
+    httpserver: pytest_httpserver.HTTPServer,
+    packaging,
+    expected_keys,
+):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        tar_info = tarfile.TarInfo("hello.txt")
+        tar_info.size = len(b"Hello!\n")
+        tar.addfile(tar_info, io.BytesIO(b"Hello!\n"))
+
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        object_version = ObjectVersion.create(
+            bucket=record.bucket, key="some-file.tar.gz"
+        )
+        TagManager(object_version).update(
+            {
+                ObjectTagKey.ByReferenceURL: httpserver.url_for("some-file.tar.gz"),
+                ObjectTagKey.ByReferenceNotDeleted: "true",
+                ObjectTagKey.Packaging: packaging,
+            }
+        )
+
+        httpserver.expect_request("/some-file.tar.gz").respond_with_data(
+            buffer.getvalue()
+        )
+
+        db.session.refresh(object_version)
+        tasks.dereference_and_unpack_object(
+            str(record.id), str(object_version.version_id)
+        )
+        assert {
+            object_version.key
+            for object_version in ObjectVersion.get_by_bucket(record.bucket)
+        } == expected_keys
+        assert len(httpserver.log) == 1
+
+        object_version = ObjectVersion.get(record.bucket, "some-file.tar.gz")
+        assert object_version.file.storage().open().read() == buffer.getvalue()
+        assert TagManager(object_version)[ObjectTagKey.FileState] == FileState.Ingested
+        assert ObjectTagKey.ByReferenceNotDeleted not in TagManager(object_version)
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_by_reference_files_batched_by_origin(
+    api, users, location, es, task_delay: unittest.mock.Mock, monkeypatch, batch_size
+):
+    monkeypatch.setitem(api.config, "SWORD_DEREFERENCE_HOST_CONCURRENCY", 2)
+    monkeypatch.setitem(api.config, "SWORD_DEREFERENCE_BATCH_SIZE", batch_size)
+
+    with api.test_request_context():
+        record: SWORDDeposit = SWORDDeposit.create({})
+        record.set_by_reference_files(
+            [
+                ByReferenceFileDefinition(
+                    url=url,
+                    content_disposition="attachment; filename={}".format(filename),
+                    content_type="text/plain",
+                    packaging=PackagingFormat.Binary,
+                    dereference=True,
+                )
+                for filename, url in [
+                    ("one.txt", "http://example.com/one.txt"),
+                    ("two.txt", "http://example.com/two.txt"),
+                    ("three.txt", "http://example.com/three.txt"),
+                    ("other.txt", "http://example.org/other.txt"),
+                    ("another.txt", "http://example.net/another.txt"),
+                ]
+            ],
+            dereference_policy=lambda record, brf: brf.dereference,
+            request_url="http://localhost/something",
+            replace=False,
+        )
+        # Tasks are only sent once the deposit is committed
+        assert task_delay.call_count == 0
+        db.session.commit()
+
+        object_versions = {
+            object_version.key: object_version
+            for object_version in ObjectVersion.query.all()
+        }
+
+        def dereference_objects(*keys):
+            return with_task_ids(
+                object_versions[keys[0]],
+                tasks.dereference_objects.s(
+                    str(record.id),
+                    [str(object_versions[key].version_id) for key in keys],
+                ),
+            )
+
+        def dereference_object(key):
+            return with_task_ids(
+                object_versions[key],
+                tasks.dereference_and_unpack_object.s(
+                    str(record.id), str(object_versions[key].version_id)
+                ),
+            )
+
+        if batch_size == 1:
+            # Files from the same origin are split between HOST_CONCURRENCY tasks
+            expected_tasks = [
+                dereference_objects("one.txt", "two.txt"),
+                dereference_object("three.txt"),
+                dereference_object("other.txt"),
+                dereference_object("another.txt"),
+            ]
+        else:
+            # Files from smaller origins are batched together
+            expected_tasks = [
+                dereference_objects("one.txt", "two.txt", "three.txt"),
+                dereference_objects("other.txt", "another.txt"),
+            ]
+        assert task_delay.call_args_list == [
+            unittest.mock.call(celery.group(expected_tasks))
+        ]
+
+
+def test_dereference_objects_task(
+    api, users, location, es, fixtures_path, httpserver: pytest_httpserver.HTTPServer,
+):
+    with open(os.path.join(fixtures_path, "simple.zip"), "rb") as f:
+        zip_contents = f.read()
+
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        version_ids = []
+        for key, packaging, mimetype, contents in [
+            ("one.txt", PackagingFormat.Binary, "text/plain", b"one.txt"),
+            ("two.zip", PackagingFormat.SimpleZip, "application/zip", zip_contents),
+        ]:
+            object_version = ObjectVersion.create(
+                bucket=record.bucket, key=key, mimetype=mimetype
+            )
+            TagManager(object_version).update(
+                {
+                    ObjectTagKey.ByReferenceURL: httpserver.url_for(key),
+                    ObjectTagKey.ByReferenceNotDeleted: "true",
+                    ObjectTagKey.Packaging: packaging,
+                }
+            )
+            httpserver.expect_request("/" + key).respond_with_data(contents)
+            version_ids.append(str(object_version.version_id))
+        db.session.commit()
+
+        tasks.dereference_objects(str(record.id), version_ids)
+
+        # The zip was unpacked by the same task
+        assert {
+            object_version.key
+            for object_version in ObjectVersion.get_by_bucket(record.bucket)
+        } == {"one.txt", "two.zip", "example.svg", "hello.txt"}
+        assert len(httpserver.log) == 2
+        for key in ["one.txt", "two.zip"]:
+            object_version = ObjectVersion.get(record.bucket, key)
+            assert (
+                TagManager(object_version)[ObjectTagKey.FileState] == FileState.Ingested
+            )
+        assert (
+            ObjectVersion.get(record.bucket, "one.txt").file.storage().open().read()
+            == b"one.txt"
+        )
+
+
+def test_throttle():
+    throttle = Throttle(100)
+    with unittest.mock.patch("invenio_sword.download.time.sleep") as sleep:
+        # A second's worth can be read straight away
+        throttle.consume(100)
+        assert not sleep.called
+        throttle.consume(50)
+        assert sleep.call_args[0][0] == pytest.approx(0.5, abs=0.05)
+
+
 def test_dereference_without_url(api, location, es):
     with api.test_request_context():
         record = SWORDDeposit.create({})
@@ -272,8 +502,7 @@ def test_dereference_already_dereferenced(
 
         db.session.refresh(object_version)
 
-        result = tasks.dereference_object(record.id, object_version.version_id)
-        assert result == ["some-file.txt"]
+        tasks.dereference_object(record.id, object_version.version_id)
 
         assert httpserver.log == []
 
@@ -300,8 +529,7 @@ def test_dereference_when_not_head(
 
         db.session.refresh(object_version)
 
-        result = tasks.dereference_object(record.id, object_version.version_id)
-        assert result == ["some-file.txt"]
+        tasks.dereference_object(record.id, object_version.version_id)
         assert httpserver.log == []
 
 
@@ -335,6 +563,323 @@ def test_error_dereferencing(
         assert tags.get(ObjectTagKey.FileState) == FileState.Error
 
 
+def test_dereference_retries_transient_errors(
+    api, users, location, es, httpserver: pytest_httpserver.HTTPServer, monkeypatch
+):
+    monkeypatch.setitem(api.config, "SWORD_DOWNLOAD_BACKOFF", 0)
+
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        object_version = ObjectVersion.create(bucket=record.bucket, key="some-file.txt")
+        TagManager(object_version).update(
+            {
+                ObjectTagKey.ByReferenceURL: httpserver.url_for("some-file.txt"),
+                ObjectTagKey.ByReferenceNotDeleted: "true",
+                ObjectTagKey.Packaging: PackagingFormat.Binary,
+            }
+        )
+
+        httpserver.expect_oneshot_request("/some-file.txt").respond_with_data(
+            b"", status=HTTPStatus.SERVICE_UNAVAILABLE
+        )
+        httpserver.expect_request("/some-file.txt").respond_with_data(b"data")
+
+        db.session.refresh(object_version)
+        tasks.dereference_object(record.id, object_version.version_id)
+
+        assert len(httpserver.log) == 2
+
+        db.session.refresh(object_version)
+        assert object_version.file.storage().open().read() == b"data"
+
+
+def test_dereference_resumes_partial_download(
+    api, users, location, es, httpserver: pytest_httpserver.HTTPServer
+):
+    file_contents = b"File contents.\n"
+
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        object_version = ObjectVersion.create(bucket=record.bucket, key="some-file.txt")
+
+        # The state left behind by a task that failed after downloading the first five bytes
+        partial_file = FileInstance.create()
+        partial_file.init_contents(
+            default_location=record.bucket.location.uri,
+            default_storage_class=record.bucket.default_storage_class,
+        )
+        partial_file.update_contents(io.BytesIO(file_contents[:5]), seek=0)
+        TagManager(object_version).update(
+            {
+                ObjectTagKey.ByReferenceURL: httpserver.url_for("some-file.txt"),
+                ObjectTagKey.ByReferenceNotDeleted: "true",
+                ObjectTagKey.Packaging: PackagingFormat.Binary,
+                ObjectTagKey.ByReferencePartialFileID: str(partial_file.id),
+                ObjectTagKey.ByReferenceBytesDownloaded: "5",
+                ObjectTagKey.ByReferenceETag: '"v1"',
+            }
+        )
+
+        httpserver.expect_request(
+            "/some-file.txt", headers={"Range": "bytes=5-"}
+        ).respond_with_data(
+            file_contents[5:],
+            status=HTTPStatus.PARTIAL_CONTENT,
+            headers={
+                "Content-Range": "bytes 5-{}/{}".format(
+                    len(file_contents) - 1, len(file_contents)
+                ),
+                "ETag": '"v1"',
+            },
+        )
+
+        db.session.refresh(object_version)
+        tasks.dereference_object(record.id, object_version.version_id)
+
+        assert len(httpserver.log) == 1
+        assert httpserver.log[0][0].headers["If-Range"] == '"v1"'
+
+        db.session.refresh(object_version)
+        assert object_version.file_id == partial_file.id
+        assert object_version.file.size == len(file_contents)
+        assert object_version.file.storage().open().read() == file_contents
+        assert (
+            object_version.file.checksum
+            == "md5:" + hashlib.md5(file_contents).hexdigest()
+        )
+
+        assert TagManager(object_version) == {
+            ObjectTagKey.ByReferenceURL: httpserver.url_for("some-file.txt"),
+            ObjectTagKey.Packaging: PackagingFormat.Binary,
+            ObjectTagKey.FileState: FileState.Pending,
+        }
+
+
+def test_dereference_restarts_when_sent_in_full(
+    api, users, location, es, httpserver: pytest_httpserver.HTTPServer, monkeypatch
+):
+    monkeypatch.setitem(api.config, "SWORD_DOWNLOAD_BACKOFF", 0)
+    old_contents, new_contents = b"File contents.\n", b"Changed file contents.\n"
+
+    with api.test_request_context():
+        record, object_version = create_by_reference_object(
+            httpserver.url_for("some-file.txt")
+        )
+
+        # The connection drops after five bytes, and the file changes before the download is resumed
+        httpserver.expect_oneshot_request("/some-file.txt").respond_with_response(
+            werkzeug.Response(
+                iter([old_contents[:5]]),
+                headers={"Content-Length": str(len(old_contents)), "ETag": '"v1"'},
+            )
+        )
+        httpserver.expect_request(
+            "/some-file.txt", headers={"Range": "bytes=5-"}
+        ).respond_with_data(new_contents, headers={"ETag": '"v2"'})
+
+        tasks.dereference_object(record.id, object_version.version_id)
+
+        assert len(httpserver.log) == 2
+        assert httpserver.log[1][0].headers["If-Range"] == '"v1"'
+
+        db.session.refresh(object_version)
+        assert FileInstance.query.count() == 1
+        assert object_version.file.size == len(new_contents)
+        assert object_version.file.storage().open().read() == new_contents
+        assert (
+            object_version.file.checksum
+            == "md5:" + hashlib.md5(new_contents).hexdigest()
+        )
+        assert TagManager(object_version)[ObjectTagKey.FileState] == FileState.Pending
+
+
+def test_dereference_discards_partial_download_on_error(
+    api, users, location, es, httpserver: pytest_httpserver.HTTPServer
+):
+    with api.test_request_context():
+        record, object_version = create_by_reference_object(
+            httpserver.url_for("some-file.txt")
+        )
+
+        # The state left behind by a task whose worker died after downloading the first five bytes
+        partial_file = FileInstance.create()
+        partial_file.init_contents(
+            default_location=record.bucket.location.uri,
+            default_storage_class=record.bucket.default_storage_class,
+        )
+        partial_file.update_contents(io.BytesIO(b"File "), seek=0)
+        TagManager(object_version).update(
+            {
+                ObjectTagKey.ByReferencePartialFileID: str(partial_file.id),
+                ObjectTagKey.ByReferenceBytesDownloaded: "5",
+                ObjectTagKey.ByReferenceETag: '"v1"',
+            }
+        )
+
+        httpserver.expect_request("/some-file.txt").respond_with_data(
+            b"", status=HTTPStatus.GONE
+        )
+
+        db.session.refresh(object_version)
+        with pytest.raises(urllib.error.HTTPError):
+            tasks.dereference_object(record.id, object_version.version_id)
+
+        db.session.refresh(object_version)
+        assert object_version.file is None
+        assert FileInstance.query.count() == 0
+        assert TagManager(object_version) == {
+            ObjectTagKey.ByReferenceURL: httpserver.url_for("some-file.txt"),
+            ObjectTagKey.ByReferenceNotDeleted: "true",
+            ObjectTagKey.Packaging: PackagingFormat.Binary,
+            ObjectTagKey.FileState: FileState.Error,
+        }
+
+
+def test_dereference_rejects_declared_content_length(
+    api, users, location, es, httpserver: pytest_httpserver.HTTPServer
+):
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        object_version = ObjectVersion.create(bucket=record.bucket, key="some-file.txt")
+        TagManager(object_version).update(
+            {
+                ObjectTagKey.ByReferenceURL: httpserver.url_for("some-file.txt"),
+                ObjectTagKey.ByReferenceNotDeleted: "true",
+                ObjectTagKey.ByReferenceContentLength: "10",
+                ObjectTagKey.Packaging: PackagingFormat.SimpleZip,
+            }
+        )
+
+        httpserver.expect_request("/some-file.txt").respond_with_data(b"x" * 100)
+
+        db.session.refresh(object_version)
+
+        with pytest.raises(ByReferenceFileSizeExceeded):
+            tasks.dereference_object(record.id, object_version.version_id)
+
+        db.session.refresh(object_version)
+        assert object_version.file is None
+        assert FileInstance.query.count() == 0
+        assert TagManager(object_version)[ObjectTagKey.FileState] == FileState.Error
+
+
+@pytest.mark.parametrize("streaming_dereference", [True, False])
+def test_dereference_aborts_when_too_large(
+    api,
+    users,
+    location,
+    es,
+    httpserver: pytest_httpserver.HTTPServer,
+    monkeypatch,
+    streaming_dereference,
+):
+    monkeypatch.setitem(api.config, "SWORD_MAX_BY_REFERENCE_SIZE", 1000)
+
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        object_version = ObjectVersion.create(bucket=record.bucket, key="some-file.txt")
+        TagManager(object_version).update(
+            {
+                ObjectTagKey.ByReferenceURL: httpserver.url_for("some-file.txt"),
+                ObjectTagKey.ByReferenceNotDeleted: "true",
+                ObjectTagKey.Packaging: PackagingFormat.Binary,
+            }
+        )
+
+        # Without a Content-Length, the download can only be stopped once too much has been read
+        httpserver.expect_request("/some-file.txt").respond_with_response(
+            werkzeug.Response(iter([b"x" * 100] * 100))
+        )
+
+        db.session.refresh(object_version)
+
+        task = (
+            tasks.dereference_and_unpack_object
+            if streaming_dereference
+            else tasks.dereference_object
+        )
+        with pytest.raises(ByReferenceFileSizeExceeded):
+            task(record.id, object_version.version_id)
+
+        db.session.refresh(object_version)
+        assert object_version.file is None
+        assert FileInstance.query.count() == 0
+
+
+def create_by_reference_object(url: str) -> Tuple[SWORDDeposit, ObjectVersion]:
+    record = SWORDDeposit.create({})
+    object_version = ObjectVersion.create(bucket=record.bucket, key="some-file.txt")
+    TagManager(object_version).update(
+        {
+            ObjectTagKey.ByReferenceURL: url,
+            ObjectTagKey.ByReferenceNotDeleted: "true",
+            ObjectTagKey.Packaging: PackagingFormat.Binary,
+        }
+    )
+    db.session.refresh(object_version)
+    return record, object_version
+
+
+@pytest.mark.parametrize("streaming_dereference", [True, False])
+def test_dereference_cache(
+    api,
+    users,
+    location,
+    es,
+    httpserver: pytest_httpserver.HTTPServer,
+    monkeypatch,
+    streaming_dereference,
+):
+    monkeypatch.setitem(api.config, "SWORD_DEREFERENCE_CACHE_MAX_SIZE", 1000)
+    task = (
+        tasks.dereference_and_unpack_object
+        if streaming_dereference
+        else tasks.dereference_object
+    )
+
+    with api.test_request_context():
+        httpserver.expect_request(
+            "/some-file.txt", headers={"If-None-Match": '"v1"'}
+        ).respond_with_data(b"", status=HTTPStatus.NOT_MODIFIED)
+        httpserver.expect_request("/some-file.txt").respond_with_data(
+            b"data", headers={"ETag": '"v1"'}
+        )
+
+        record, first = create_by_reference_object(httpserver.url_for("some-file.txt"))
+        task(record.id, first.version_id)
+        record, second = create_by_reference_object(httpserver.url_for("some-file.txt"))
+        task(record.id, second.version_id)
+
+        # The second was revalidated instead of downloaded again
+        assert len(httpserver.log) == 2
+        assert httpserver.log[1][1].status_code == HTTPStatus.NOT_MODIFIED
+
+        db.session.refresh(first)
+        db.session.refresh(second)
+        assert second.file_id == first.file_id
+        assert second.file.storage().open().read() == b"data"
+
+
+def test_dereference_cache_eviction(
+    api, users, location, es, httpserver: pytest_httpserver.HTTPServer, monkeypatch
+):
+    monkeypatch.setitem(api.config, "SWORD_DEREFERENCE_CACHE_MAX_SIZE", 10)
+
+    with api.test_request_context():
+        for key in ["one.txt", "two.txt"]:
+            httpserver.expect_request("/" + key).respond_with_data(
+                b"x" * 8, headers={"ETag": '"v1"'}
+            )
+            record, object_version = create_by_reference_object(httpserver.url_for(key))
+            tasks.dereference_object(record.id, object_version.version_id)
+
+        # Only the most recently used fits
+        assert [
+            TagManager(object_version)[ObjectTagKey.ByReferenceURL]
+            for object_version in ObjectVersion.get_by_bucket(get_cache_bucket())
+        ] == [httpserver.url_for("two.txt")]
+
+
 def test_error_unpacking(api, users, location, es):
     with api.test_request_context():
         record = SWORDDeposit.create({})
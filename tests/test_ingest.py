@@ -89,6 +89,17 @@ ingest_test_parameters = [
 ]
 
 
+def expect_unpack_task(task_delay, packaging, shortcut_unpack):
+    # BagIt deposits are always unpacked in a task; others are unpacked during the request if they're small enough
+    if packaging.endswith("/SWORDBagIt") or not shortcut_unpack:
+        assert task_delay.call_count == 1
+        task_self = task_delay.call_args[0][0]
+        task_self.apply()
+    else:
+        assert task_delay.call_count == 0
+
+
+@pytest.mark.parametrize("shortcut_unpack", [True, False])
 @pytest.mark.parametrize(
     "filename,packaging,content_type,expected_links", ingest_test_parameters
 )
@@ -103,7 +114,12 @@ def test_ingest(
     packaging,
     content_type,
     expected_links,
+    shortcut_unpack,
+    monkeypatch,
 ):
+    if not shortcut_unpack:
+        monkeypatch.setitem(api.config, "SWORD_SHORTCUT_UNPACK_MAX_SIZE", -1)
+
     with api.test_request_context(), api.test_client() as client:
         client.post(
             url_for_security("login"),
@@ -122,9 +138,7 @@ def test_ingest(
             )
         assert response.status_code == HTTPStatus.CREATED
 
-        assert task_delay.call_count == 1
-        task_self = task_delay.call_args[0][0]
-        task_self.apply()
+        expect_unpack_task(task_delay, packaging, shortcut_unpack)
 
         response = client.get(response.headers["Location"])
 
@@ -199,9 +213,7 @@ def test_create_with_metadata_and_then_ingest(
                 },
             )
 
-        assert task_delay.call_count == 1
-        task_self = task_delay.call_args[0][0]
-        task_self.apply()
+        expect_unpack_task(task_delay, packaging, shortcut_unpack=True)
 
         response = client.get(response.headers["Location"])
 
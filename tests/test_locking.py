@@ -0,0 +1,130 @@
+import datetime
+import io
+import os
+import unittest.mock
+
+import celery.exceptions
+import pytest
+from invenio_db import db
+from invenio_files_rest.models import BucketTag
+from invenio_files_rest.models import ObjectVersion
+from sword3common.constants import PackagingFormat
+
+from invenio_sword import tasks
+from invenio_sword.api import SWORDDeposit
+from invenio_sword.enum import FileState
+from invenio_sword.enum import ObjectTagKey
+from invenio_sword.locking import LOCK_TAG
+from invenio_sword.locking import acquire_bucket_lock
+from invenio_sword.locking import release_bucket_lock
+from invenio_sword.utils import TagManager
+
+
+def test_bucket_lock(api, location, es):
+    with api.test_request_context():
+        record: SWORDDeposit = SWORDDeposit.create({})
+        other_record: SWORDDeposit = SWORDDeposit.create({})
+
+        assert acquire_bucket_lock(record.bucket_id, "one")
+        assert not acquire_bucket_lock(record.bucket_id, "two")
+        # Other buckets aren't affected
+        assert acquire_bucket_lock(other_record.bucket_id, "two")
+        # The holder can acquire it again
+        assert acquire_bucket_lock(record.bucket_id, "one")
+
+        # Only the holder can release it
+        release_bucket_lock(record.bucket_id, "two")
+        assert not acquire_bucket_lock(record.bucket_id, "two")
+        release_bucket_lock(record.bucket_id, "one")
+        assert acquire_bucket_lock(record.bucket_id, "two")
+
+
+def test_expired_bucket_lock_taken_over(api, location, es, monkeypatch):
+    with api.test_request_context():
+        record: SWORDDeposit = SWORDDeposit.create({})
+
+        monkeypatch.setitem(api.config, "SWORD_BUCKET_LOCK_TIMEOUT", -1)
+        assert acquire_bucket_lock(record.bucket_id, "one")
+        monkeypatch.setitem(api.config, "SWORD_BUCKET_LOCK_TIMEOUT", 60)
+        assert acquire_bucket_lock(record.bucket_id, "two")
+
+        holder, expiry = BucketTag.get_value(record.bucket_id, LOCK_TAG).split(" ")
+        assert holder == "two"
+        assert expiry > datetime.datetime.utcnow().isoformat()
+
+
+def test_task_retried_while_bucket_locked(api, location, es):
+    with api.test_request_context():
+        record: SWORDDeposit = SWORDDeposit.create({})
+        assert acquire_bucket_lock(record.bucket_id, "other-task")
+
+        # Retried eagerly, apply() would retry straight away, again and again
+        with unittest.mock.patch.object(
+            tasks.delete_old_objects, "retry", return_value=celery.exceptions.Retry()
+        ) as retry:
+            result = tasks.delete_old_objects.apply(
+                kwargs={"bucket_id": record.bucket_id}
+            )
+        retry.assert_called_once_with(
+            countdown=api.config["SWORD_BUCKET_LOCK_RETRY_DELAY"]
+        )
+        assert result.state == "RETRY"
+
+        release_bucket_lock(record.bucket_id, "other-task")
+        result = tasks.delete_old_objects.apply(kwargs={"bucket_id": record.bucket_id})
+        assert result.state == "SUCCESS"
+        # The task released the lock when it finished
+        assert BucketTag.get_value(record.bucket_id, LOCK_TAG) is None
+
+
+def test_chunked_unpack_holds_bucket_lock(
+    api, location, es, fixtures_path, monkeypatch
+):
+    monkeypatch.setitem(api.config, "SWORD_UNPACK_CHUNK_SIZE", 1)
+    with api.test_request_context():
+        record: SWORDDeposit = SWORDDeposit.create({})
+        with open(os.path.join(fixtures_path, "simple.zip"), "rb") as f:
+            object_version = ObjectVersion.create(
+                bucket=record.bucket,
+                key="deposit.zip",
+                stream=f,
+                mimetype="application/zip",
+            )
+        TagManager(object_version)[ObjectTagKey.Packaging] = PackagingFormat.SimpleZip
+        db.session.commit()
+
+        with unittest.mock.patch.object(tasks.unpack_object, "replace") as replace:
+            result = tasks.unpack_object.apply(
+                args=(str(record.id), str(object_version.version_id))
+            )
+        chord = replace.call_args[0][0]
+
+        # The lock is handed over to the chunks, and only released by finish_unpack
+        holder, _ = BucketTag.get_value(record.bucket_id, LOCK_TAG).split(" ")
+        assert holder == result.id
+        results = [
+            tasks.unpack_chunk(*task.args, **task.kwargs) for task in chord.tasks
+        ]
+        assert not acquire_bucket_lock(record.bucket_id, "other-task")
+        tasks.finish_unpack(results, *chord.body.args, **chord.body.kwargs)
+        assert BucketTag.get_value(record.bucket_id, LOCK_TAG) is None
+
+
+def test_failed_chunked_unpack_releases_bucket_lock(api, location, es):
+    with api.test_request_context():
+        record: SWORDDeposit = SWORDDeposit.create({})
+        object_version = ObjectVersion.create(
+            bucket=record.bucket, key="deposit.zip", stream=io.BytesIO(b"data")
+        )
+        TagManager(object_version)[ObjectTagKey.FileState] = FileState.Error
+        assert acquire_bucket_lock(record.bucket_id, "unpack-task")
+
+        with pytest.raises(RuntimeError):
+            tasks.finish_unpack(
+                [True, False],
+                str(record.id),
+                str(object_version.version_id),
+                lock_owner="unpack-task",
+            )
+        assert BucketTag.get_value(record.bucket_id, LOCK_TAG) is None
+        assert TagManager(object_version)[ObjectTagKey.FileState] == FileState.Error
@@ -0,0 +1,43 @@
+import unittest.mock
+
+from invenio_db import db
+
+from invenio_sword import notify
+from invenio_sword.api import SWORDDeposit
+
+
+def test_notify_wakes_subscribers(api, memory_broker):
+    with notify.subscribe("bucket-1") as subscription, notify.subscribe(
+        "bucket-2"
+    ) as other_subscription:
+        notify.notify("bucket-1")
+        assert subscription.wait(1)
+        # Subscribers to other buckets aren't woken
+        assert not other_subscription.wait(0.1)
+        # Nor are they woken again by notifications already received
+        assert not subscription.wait(0.1)
+
+
+def test_notify_on_commit(api, location, es, memory_broker):
+    with api.test_request_context():
+        record: SWORDDeposit = SWORDDeposit.create({})
+        with notify.subscribe(record.bucket_id) as subscription:
+            notify.notify_on_commit(record.bucket_id)
+            assert not subscription.wait(0.1)
+            db.session.commit()
+            assert subscription.wait(1)
+
+
+def test_broker_unavailable(api):
+    connection = unittest.mock.MagicMock(**{"connect.side_effect": ConnectionError()})
+    producer = unittest.mock.MagicMock()
+    producer.__enter__.return_value.connection = connection
+    with unittest.mock.patch.object(
+        notify, "get_connection", lambda: connection
+    ), unittest.mock.patch.object(notify, "get_producer", lambda: producer):
+        # Notifying is best-effort
+        notify.notify("bucket-1")
+        producer.__enter__.return_value.publish.assert_not_called()
+        with notify.subscribe("bucket-1") as subscription:
+            assert subscription is None
+    connection.release.assert_called()
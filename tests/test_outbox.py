@@ -0,0 +1,52 @@
+import unittest.mock
+
+from invenio_db import db
+
+from invenio_sword import tasks
+from invenio_sword.outbox import delay_on_commit
+
+
+def test_tasks_sent_on_commit(api, location, task_delay: unittest.mock.Mock):
+    with api.test_request_context():
+        signature = tasks.delete_old_objects.si(bucket_id="bucket")
+        delay_on_commit(signature)
+        assert task_delay.call_count == 0
+
+        db.session.commit()
+        assert task_delay.call_args_list == [unittest.mock.call(signature)]
+
+        # Nothing is sent twice
+        db.session.commit()
+        assert task_delay.call_count == 1
+
+
+def test_tasks_discarded_on_rollback(api, location, task_delay: unittest.mock.Mock):
+    with api.test_request_context():
+        delay_on_commit(tasks.delete_old_objects.si(bucket_id="bucket"))
+        db.session.rollback()
+        db.session.commit()
+        assert task_delay.call_count == 0
+
+
+def test_tasks_discarded_on_savepoint_rollback(
+    api, location, task_delay: unittest.mock.Mock
+):
+    with api.test_request_context():
+        kept = tasks.delete_old_objects.si(bucket_id="kept")
+        delay_on_commit(kept)
+
+        db.session.begin_nested()
+        delay_on_commit(tasks.delete_old_objects.si(bucket_id="discarded"))
+        db.session.rollback()
+
+        # Committing a savepoint doesn't send anything
+        db.session.begin_nested()
+        delay_on_commit(kept)
+        db.session.commit()
+        assert task_delay.call_count == 0
+
+        db.session.commit()
+        assert task_delay.call_args_list == [
+            unittest.mock.call(kept),
+            unittest.mock.call(kept),
+        ]
@@ -1,15 +1,21 @@
 import io
+import os
 import secrets
+import zipfile
 from typing import Type
 
 import pytest
+from invenio_db import db
 from invenio_files_rest.models import ObjectVersion
 
 from invenio_sword.api import SWORDDeposit
+from invenio_sword.enum import ObjectTagKey
 from invenio_sword.packaging import BinaryPackaging
 from invenio_sword.packaging import Packaging
+from invenio_sword.packaging import SimpleTarPackaging
 from invenio_sword.packaging import SimpleZipPackaging
 from invenio_sword.packaging import SWORDBagItPackaging
+from invenio_sword.utils import TagManager
 
 
 def test_get_original_deposit_filename(api, es, location):
@@ -30,7 +36,7 @@ def test_get_original_deposit_filename(api, es, location):
         assert packaging.get_original_deposit_filename().endswith(".bin")
 
 
-@pytest.mark.parametrize("packaging_cls", [SimpleZipPackaging, SWORDBagItPackaging])
+@pytest.mark.parametrize("packaging_cls", [SimpleTarPackaging, SWORDBagItPackaging])
 def test_non_binary_doesnt_shortcut_unpack(
     api, location, es, packaging_cls: Type[Packaging]
 ):
@@ -41,3 +47,78 @@ def test_non_binary_doesnt_shortcut_unpack(
         )
         packaging = packaging_cls(record)
         assert packaging.shortcut_unpack(object_version) == NotImplemented
+
+
+def test_simple_zip_shortcut_unpack(api, location, es, fixtures_path):
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        with open(os.path.join(fixtures_path, "simple.zip"), "rb") as f:
+            object_version = ObjectVersion.create(
+                bucket=record.bucket,
+                key="simple.zip",
+                stream=f,
+                mimetype="application/zip",
+            )
+        packaging = SimpleZipPackaging(record)
+        assert set(packaging.shortcut_unpack(object_version)) == {
+            "example.svg",
+            "hello.txt",
+        }
+
+
+def test_simple_zip_shortcut_unpack_limits_unpacked_size(
+    api, location, es, monkeypatch
+):
+    monkeypatch.setitem(api.config, "SWORD_SHORTCUT_UNPACK_MAX_SIZE", 1024 ** 2)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zip:
+        zip.writestr("zeros.bin", bytes(2 * 1024 ** 2))
+    assert archive.tell() < 1024 ** 2
+    archive.seek(0)
+
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        object_version = ObjectVersion.create(
+            bucket=record.bucket,
+            key="zeros.zip",
+            stream=archive,
+            mimetype="application/zip",
+        )
+        packaging = SimpleZipPackaging(record)
+        # It's left to a task, as it expands to more than the limit
+        assert packaging.shortcut_unpack(object_version) == NotImplemented
+        assert ObjectVersion.get(record.bucket, "zeros.bin") is None
+
+
+def test_bulk_ingest_replaces_existing_objects(api, location, es):
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        existing = ObjectVersion.create(
+            bucket=record.bucket, key="hello.txt", stream=io.BytesIO(b"old")
+        )
+        deposit = ObjectVersion.create(
+            bucket=record.bucket, key="deposit.bin", stream=io.BytesIO(b"data")
+        )
+        bucket_size = record.bucket.size
+
+        packaging = BinaryPackaging(record)
+        with packaging.bulk_ingest(deposit) as writer:
+            writer.batch_size = 2
+            for key in ["hello.txt", "a.txt", "b.txt"]:
+                writer.add(
+                    key,
+                    packaging.store_stream(io.BytesIO(key.encode())),
+                    mimetype="text/plain",
+                )
+
+        for key in ["hello.txt", "a.txt", "b.txt"]:
+            object_version = ObjectVersion.get(record.bucket, key)
+            assert object_version.file.storage().open().read() == key.encode()
+            assert TagManager(object_version) == {
+                ObjectTagKey.FileSetFile: "true",
+                ObjectTagKey.DerivedFrom: "deposit.bin",
+            }
+
+        db.session.refresh(existing)
+        assert not existing.is_head
+        assert record.bucket.size == bucket_size + len("hello.txta.txtb.txt")
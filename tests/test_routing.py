@@ -0,0 +1,122 @@
+import io
+import os
+import unittest.mock
+
+from invenio_db import db
+from invenio_files_rest.models import ObjectVersion
+from invenio_sword.schemas import ByReferenceFileDefinition
+from sword3common.constants import PackagingFormat
+
+from invenio_sword import tasks
+from invenio_sword.api import SWORDDeposit
+from invenio_sword.enum import ObjectTagKey
+from invenio_sword.routing import SizeRouter
+from invenio_sword.routing import TaskRoute
+from invenio_sword.utils import TagManager
+
+
+def test_tasks_routed_by_size(api, location, es, task_delay, monkeypatch):
+    monkeypatch.setitem(api.config, "SWORD_SHORTCUT_UNPACK_MAX_SIZE", -1)
+    monkeypatch.setitem(api.config, "SWORD_TASK_ROUTER", SizeRouter(10))
+    with api.test_request_context():
+        record: SWORDDeposit = SWORDDeposit.create({})
+        record.set_by_reference_files(
+            [
+                ByReferenceFileDefinition(
+                    url="http://example.com/{}".format(filename),
+                    content_disposition="attachment; filename={}".format(filename),
+                    content_type="text/plain",
+                    content_length=content_length,
+                    packaging=PackagingFormat.Binary,
+                    dereference=True,
+                )
+                for filename, content_length in [
+                    ("small.txt", 10),
+                    ("large.txt", 11),
+                    ("unknown.txt", None),
+                ]
+            ],
+            dereference_policy=lambda record, brf: brf.dereference,
+            request_url="http://localhost/something",
+            replace=False,
+        )
+        record.ingest_file(
+            io.BytesIO(b"more than ten bytes"),
+            packaging_name=PackagingFormat.Binary,
+            content_type="text/plain",
+            content_disposition="attachment; filename=direct.txt",
+            replace=False,
+        )
+        db.session.commit()
+
+        dereference_group, unpack_task = [
+            call[0][0] for call in task_delay.call_args_list
+        ]
+        assert [task.options["queue"] for task in dereference_group.tasks] == [
+            "sword-small",
+            "sword-bulk",
+            "sword-bulk",
+        ]
+        assert unpack_task.options["queue"] == "sword-bulk"
+
+
+routes = []
+
+
+def route_to_binary_queue(route: TaskRoute):
+    routes.append(route)
+    return {"queue": "binary", "priority": 9}
+
+
+def test_task_router_import_path(api, location, es, task_delay, monkeypatch):
+    monkeypatch.setitem(
+        api.config, "SWORD_TASK_ROUTER", "test_routing:route_to_binary_queue"
+    )
+    monkeypatch.setitem(api.config, "SWORD_SHORTCUT_UNPACK_MAX_SIZE", -1)
+    with api.test_request_context():
+        record: SWORDDeposit = SWORDDeposit.create({})
+        record.ingest_file(
+            io.BytesIO(b"data"),
+            packaging_name=PackagingFormat.Binary,
+            content_type="text/plain",
+            content_disposition="attachment; filename=direct.txt",
+            replace=False,
+        )
+        db.session.commit()
+
+        assert routes == [
+            TaskRoute(
+                task_name="invenio_sword.tasks.unpack_object",
+                pid_type="depid",
+                packaging=frozenset([PackagingFormat.Binary]),
+                size=4,
+            )
+        ]
+        (task,) = [call[0][0] for call in task_delay.call_args_list]
+        assert task.options["queue"] == "binary"
+        assert task.options["priority"] == 9
+
+
+def test_unpack_chunks_routed(api, location, es, fixtures_path, monkeypatch):
+    monkeypatch.setitem(api.config, "SWORD_UNPACK_CHUNK_SIZE", 1)
+    monkeypatch.setitem(api.config, "SWORD_TASK_ROUTER", SizeRouter(10))
+    with api.test_request_context():
+        record: SWORDDeposit = SWORDDeposit.create({})
+        with open(os.path.join(fixtures_path, "simple.zip"), "rb") as f:
+            object_version = ObjectVersion.create(
+                bucket=record.bucket,
+                key="deposit.zip",
+                stream=f,
+                mimetype="application/zip",
+            )
+        TagManager(object_version)[ObjectTagKey.Packaging] = PackagingFormat.SimpleZip
+
+        with unittest.mock.patch.object(tasks.unpack_object, "replace") as replace:
+            tasks.unpack_object(str(record.id), str(object_version.version_id))
+
+        chord = replace.call_args[0][0]
+        assert [task.options["queue"] for task in chord.tasks] == [
+            "sword-bulk",
+            "sword-bulk",
+        ]
+        assert chord.body.options["queue"] == "sword-bulk"
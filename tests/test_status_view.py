@@ -1,6 +1,8 @@
 import io
+import unittest.mock
 from http import HTTPStatus
 
+import celery
 from flask import url_for
 from flask_security import url_for_security
 from invenio_db import db
@@ -8,7 +10,12 @@ from invenio_files_rest.models import ObjectVersion
 from invenio_files_rest.models import ObjectVersionTag
 
 from invenio_sword.api import SWORDDeposit
+from invenio_sword.enum import FileState
 from invenio_sword.enum import ObjectTagKey
+from invenio_sword.notify import Subscription
+from invenio_sword.progress import PROGRESS_STATE
+from invenio_sword.progress import ProgressReporter
+from invenio_sword.utils import TagManager
 
 
 def test_get_status_document_not_found(api, location, es):
@@ -111,3 +118,214 @@ def test_delete_status_document(api, users, location, es):
 
         response = client.get("/sword/deposit/{}".format(record.pid.pid_value))
         assert response.status_code == HTTPStatus.GONE
+
+
+def test_status_document_shows_progress(api, users, location, es):
+    with api.test_request_context(), api.test_client() as client:
+        client.post(
+            url_for_security("login"),
+            data={"email": users[0]["email"], "password": "tester"},
+        )
+        record = SWORDDeposit.create({})
+        record.commit()
+
+        object_version = ObjectVersion.create(
+            record.bucket, "large.bin", mimetype="application/octet-stream"
+        )
+        TagManager(object_version).update(
+            {
+                ObjectTagKey.ByReferenceNotDeleted: "true",
+                ObjectTagKey.FileState: FileState.Downloading,
+                ObjectTagKey.TaskIDs: "task-1 task-2",
+                ObjectTagKey.ProgressTaskIDs: "task-1 task-2",
+            }
+        )
+        db.session.commit()
+
+        # Progress as reported by a worker running the second task
+        celery.current_app.backend.store_result(
+            "task-2",
+            {
+                "versionId": str(object_version.version_id),
+                "bytesTransferred": 1024,
+                "totalBytes": 4096,
+            },
+            PROGRESS_STATE,
+        )
+
+        response = client.get("/sword/deposit/{}".format(record.pid.pid_value))
+        assert response.status_code == HTTPStatus.OK
+        assert response.json["links"][0]["progress"] == {
+            "bytesTransferred": 1024,
+            "totalBytes": 4096,
+        }
+
+
+def test_progress_reports_throttled(api, monkeypatch):
+    monkeypatch.setitem(api.config, "SWORD_PROGRESS_INTERVAL", 60)
+    task = unittest.mock.Mock()
+    task.request.id = "task-1"
+    object_version = unittest.mock.Mock(version_id="version-1")
+    with unittest.mock.patch.object(
+        type(celery.current_app._get_current_object()),
+        "current_worker_task",
+        new_callable=unittest.mock.PropertyMock,
+        return_value=task,
+    ):
+        progress = ProgressReporter(object_version)
+        progress.update(totalMembers=3, membersProcessed=0)
+        progress.advance("membersProcessed")
+        progress.advance("membersProcessed")
+        progress.report(force=True)
+
+    assert task.update_state.call_args_list == [
+        unittest.mock.call(
+            state=PROGRESS_STATE,
+            meta={"versionId": "version-1", "totalMembers": 3, "membersProcessed": 0},
+        ),
+        unittest.mock.call(
+            state=PROGRESS_STATE,
+            meta={"versionId": "version-1", "totalMembers": 3, "membersProcessed": 2},
+        ),
+    ]
+
+
+def test_status_document_etag(api, users, location, es):
+    with api.test_request_context(), api.test_client() as client:
+        client.post(
+            url_for_security("login"),
+            data={"email": users[0]["email"], "password": "tester"},
+        )
+        record = SWORDDeposit.create({})
+        record.commit()
+        db.session.commit()
+
+        response = client.get("/sword/deposit/{}".format(record.pid.pid_value))
+        assert response.status_code == HTTPStatus.OK
+        etag = response.headers["ETag"]
+
+        response = client.get(
+            "/sword/deposit/{}".format(record.pid.pid_value),
+            headers={"If-None-Match": etag},
+        )
+        assert response.status_code == HTTPStatus.NOT_MODIFIED
+
+        # There's nothing to wait for without an ETag
+        response = client.get(
+            "/sword/deposit/{}".format(record.pid.pid_value),
+            headers={"Prefer": "wait=30"},
+        )
+        assert response.status_code == HTTPStatus.OK
+        assert "Preference-Applied" not in response.headers
+
+
+def test_status_document_long_poll_times_out(api, users, location, es, memory_broker):
+    with api.test_request_context(), api.test_client() as client:
+        client.post(
+            url_for_security("login"),
+            data={"email": users[0]["email"], "password": "tester"},
+        )
+        record = SWORDDeposit.create({})
+        record.commit()
+        db.session.commit()
+
+        response = client.get("/sword/deposit/{}".format(record.pid.pid_value))
+        response = client.get(
+            "/sword/deposit/{}".format(record.pid.pid_value),
+            headers={"If-None-Match": response.headers["ETag"], "Prefer": "wait=1"},
+        )
+        assert response.status_code == HTTPStatus.NOT_MODIFIED
+
+
+def test_status_document_long_poll_woken(api, users, location, es, memory_broker):
+    with api.test_request_context(), api.test_client() as client:
+        client.post(
+            url_for_security("login"),
+            data={"email": users[0]["email"], "password": "tester"},
+        )
+        record = SWORDDeposit.create({})
+        record.commit()
+        object_version = ObjectVersion.create(
+            record.bucket, "large.bin", mimetype="application/octet-stream"
+        )
+        TagManager(object_version).update(
+            {
+                ObjectTagKey.ByReferenceNotDeleted: "true",
+                ObjectTagKey.FileState: FileState.Downloading,
+            }
+        )
+        db.session.commit()
+
+        response = client.get("/sword/deposit/{}".format(record.pid.pid_value))
+        etag = response.headers["ETag"]
+
+        def wait(self, timeout):
+            # As if a task finished downloading while the request was waiting
+            TagManager(object_version)[ObjectTagKey.FileState] = FileState.Error
+            db.session.commit()
+            return True
+
+        with unittest.mock.patch.object(Subscription, "wait", wait):
+            response = client.get(
+                "/sword/deposit/{}".format(record.pid.pid_value),
+                headers={"If-None-Match": etag, "Prefer": "wait=30"},
+            )
+        assert response.status_code == HTTPStatus.OK
+        assert response.headers["ETag"] != etag
+        assert response.headers["Preference-Applied"] == "wait=30"
+
+
+def test_status_document_long_poll_ignores_progress(
+    api, users, location, es, memory_broker
+):
+    with api.test_request_context(), api.test_client() as client:
+        client.post(
+            url_for_security("login"),
+            data={"email": users[0]["email"], "password": "tester"},
+        )
+        record = SWORDDeposit.create({})
+        record.commit()
+        object_version = ObjectVersion.create(
+            record.bucket, "large.bin", mimetype="application/octet-stream"
+        )
+        TagManager(object_version).update(
+            {
+                ObjectTagKey.ByReferenceNotDeleted: "true",
+                ObjectTagKey.FileState: FileState.Downloading,
+                ObjectTagKey.TaskIDs: "task-1",
+                ObjectTagKey.ProgressTaskIDs: "task-1",
+            }
+        )
+        db.session.commit()
+
+        def report_progress(bytes_transferred):
+            celery.current_app.backend.store_result(
+                "task-1",
+                {
+                    "versionId": str(object_version.version_id),
+                    "bytesTransferred": bytes_transferred,
+                },
+                PROGRESS_STATE,
+            )
+
+        report_progress(1024)
+        response = client.get("/sword/deposit/{}".format(record.pid.pid_value))
+        etag = response.headers["ETag"]
+
+        # The download progresses before and while the request is waiting, but nothing else changes
+        report_progress(2048)
+        waits = []
+
+        def wait(self, timeout):
+            waits.append(timeout)
+            report_progress(4096)
+            return len(waits) < 2
+
+        with unittest.mock.patch.object(Subscription, "wait", wait):
+            response = client.get(
+                "/sword/deposit/{}".format(record.pid.pid_value),
+                headers={"If-None-Match": etag, "Prefer": "wait=30"},
+            )
+        assert len(waits) == 2
+        assert response.status_code == HTTPStatus.NOT_MODIFIED
+        assert response.headers["ETag"] != etag
@@ -0,0 +1,111 @@
+"""Test the SimpleTar implementation."""
+import io
+import os
+import tarfile
+
+import pytest
+from invenio_files_rest.models import ObjectVersion
+from sword3common.exceptions import ContentMalformed
+from sword3common.exceptions import ContentTypeNotAcceptable
+
+from invenio_sword.api import SWORDDeposit
+from invenio_sword.enum import ObjectTagKey
+from invenio_sword.packaging import SimpleTarPackaging
+from invenio_sword.utils import TagManager
+
+fixtures_path = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+class ForwardOnlyReader:
+    """Hides everything about a stream except read(), as for an HTTP response"""
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def read(self, amount=-1):
+        return self._stream.read(amount)
+
+
+def make_tar(compression=""):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:" + compression) as tar:
+        tar.add(os.path.join(fixtures_path, "binary.svg"), "example.svg")
+        tar.add(os.path.join(fixtures_path, "binary.svg"), "./images/copy.svg")
+        directory = tarfile.TarInfo("empty")
+        directory.type = tarfile.DIRTYPE
+        tar.addfile(directory)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize(
+    "media_type,data",
+    [
+        ("application/x-tar", make_tar()),
+        ("application/gzip", make_tar("gz")),
+        ("application/x-bzip2", make_tar("bz2")),
+        ("application/x-xz", make_tar("xz")),
+    ],
+)
+def test_simple_tar(api, users, location, media_type, data):
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        packaging = SimpleTarPackaging(record)
+        object_version = ObjectVersion.create(
+            bucket=record.bucket,
+            key=packaging.get_original_deposit_filename(media_type=media_type),
+            stream=io.BytesIO(data),
+        )
+
+        assert packaging.unpack(object_version) == {"example.svg", "images/copy.svg"}
+
+        with open(os.path.join(fixtures_path, "binary.svg"), "rb") as f:
+            expected = f.read()
+        for key in ["example.svg", "images/copy.svg"]:
+            obj = ObjectVersion.get(record.bucket, key)
+            assert obj.mimetype == "image/svg+xml"
+            assert obj.file.storage().open().read() == expected
+            assert TagManager(obj) == {
+                ObjectTagKey.FileSetFile: "true",
+                ObjectTagKey.DerivedFrom: object_version.key,
+            }
+
+
+def test_simple_tar_zstandard(api, users, location):
+    zstandard = pytest.importorskip("zstandard")
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        packaging = SimpleTarPackaging(record)
+        object_version = ObjectVersion.create(
+            bucket=record.bucket,
+            key=packaging.get_original_deposit_filename(media_type="application/zstd"),
+            stream=io.BytesIO(zstandard.ZstdCompressor().compress(make_tar())),
+        )
+        assert packaging.unpack(object_version) == {"example.svg", "images/copy.svg"}
+
+
+def test_simple_tar_from_forward_only_stream(api, users, location):
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        object_version = ObjectVersion.create(
+            bucket=record.bucket, key="deposit.tar.gz", stream=io.BytesIO(b"")
+        )
+        keys = SimpleTarPackaging(record).unpack_stream(
+            object_version, ForwardOnlyReader(io.BytesIO(make_tar("gz")))
+        )
+        assert keys == {"example.svg", "images/copy.svg"}
+
+
+def test_bad_tar(api, users, location):
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        packaging = SimpleTarPackaging(record)
+        with pytest.raises(ContentTypeNotAcceptable):
+            packaging.get_original_deposit_filename(media_type="application/zip")
+
+        object_version = ObjectVersion.create(
+            bucket=record.bucket,
+            key=packaging.get_original_deposit_filename(media_type="application/gzip"),
+            stream=io.BytesIO(b"This is not a tar file" * 100),
+        )
+        with pytest.raises(ContentMalformed):
+            packaging.unpack(object_version)
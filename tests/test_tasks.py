@@ -1,66 +1,314 @@
 import io
+import os
+import unittest.mock
 
+import celery
+from invenio_db import db
+from invenio_files_rest.models import BucketTag
+from invenio_files_rest.models import ObjectVersion
 from invenio_sword.schemas import ByReferenceFileDefinition
 from sword3common.constants import PackagingFormat
 
 from invenio_sword import tasks
 from invenio_sword.api import SWORDDeposit
+from invenio_sword.enum import FileState
+from invenio_sword.enum import ObjectTagKey
+from invenio_sword.locking import LOCK_TAG
+from invenio_sword.locking import acquire_bucket_lock
+from invenio_sword.utils import Superseded
+from invenio_sword.utils import TagManager
 
 
 def test_delete_old_files(api, location, es, task_delay):
+    with api.test_request_context():
+        old_deposit: SWORDDeposit = SWORDDeposit.create({})
+        # A later request, with a generation of its own
+        new_deposit: SWORDDeposit = SWORDDeposit.get_record(old_deposit.id)
+
+        for record, suffix in [(old_deposit, "no"), (new_deposit, "yes")]:
+            record.set_by_reference_files(
+                [
+                    ByReferenceFileDefinition(
+                        url="http://example.com/{}".format(suffix),
+                        content_disposition="attachment; filename=br-{}.html".format(
+                            suffix
+                        ),
+                        content_type="text/html",
+                        packaging=PackagingFormat.Binary,
+                        dereference=False,
+                    ),
+                ],
+                dereference_policy=lambda record, brf: brf.dereference,
+                request_url="http://localhost/something",
+                replace=False,
+            )
+            record.ingest_file(
+                io.BytesIO(b"data"),
+                packaging_name=PackagingFormat.Binary,
+                content_type="text/html",
+                content_disposition="attachment; filename=direct-{}.html".format(
+                    suffix
+                ),
+                replace=False,
+            )
+
+        assert sorted(file.key for file in new_deposit.files) == [
+            "br-no.html",
+            "br-yes.html",
+            "direct-no.html",
+            "direct-yes.html",
+        ]
+
+        tasks.delete_old_objects(
+            bucket_id=new_deposit.bucket_id, generation=new_deposit.generation
+        )
+
+        assert sorted(file.key for file in new_deposit.files) == [
+            "br-yes.html",
+            "direct-yes.html",
+        ]
+
+
+def test_delete_old_files_in_batches(api, location, es, task_delay, monkeypatch):
+    monkeypatch.setitem(api.config, "SWORD_DELETE_BATCH_SIZE", 2)
     with api.test_request_context():
         record: SWORDDeposit = SWORDDeposit.create({})
+        for i in range(5):
+            object_version = ObjectVersion.create(
+                bucket=record.bucket,
+                key="file-{}.txt".format(i),
+                stream=io.BytesIO(b"data"),
+            )
+            TagManager(object_version)[ObjectTagKey.FileSetFile] = "true"
+        metadata = ObjectVersion.create(
+            bucket=record.bucket, key="metadata.json", stream=io.BytesIO(b"{}")
+        )
+
+        tasks.delete_old_objects(bucket_id=record.bucket_id)
+
+        assert [file.key for file in record.files] == ["metadata.json"]
+        for i in range(5):
+            versions = ObjectVersion.get_versions(
+                record.bucket, "file-{}.txt".format(i)
+            ).all()
+            # The file is kept as an earlier version, behind a delete marker
+            assert [
+                (version.is_head, version.file_id is None) for version in versions
+            ] == [(True, True), (False, False),]
+        assert ObjectVersion.get(record.bucket, "metadata.json") == metadata
+
+
+def test_unpack_in_chunks(api, location, es, task_delay, fixtures_path, monkeypatch):
+    monkeypatch.setitem(api.config, "SWORD_UNPACK_CHUNK_SIZE", 1)
+    with api.test_request_context():
+        record: SWORDDeposit = SWORDDeposit.create({})
+        with open(os.path.join(fixtures_path, "simple.zip"), "rb") as f:
+            object_version = ObjectVersion.create(
+                bucket=record.bucket,
+                key="deposit.zip",
+                stream=f,
+                mimetype="application/zip",
+            )
+        TagManager(object_version)[ObjectTagKey.Packaging] = PackagingFormat.SimpleZip
+        record_id, version_id = str(record.id), str(object_version.version_id)
+
+        with unittest.mock.patch.object(tasks.unpack_object, "replace") as replace:
+            tasks.unpack_object(record_id, version_id)
+
+        chord = replace.call_args[0][0]
+        assert [task.args for task in chord.tasks] == [
+            (record_id, version_id, 0, 1),
+            (record_id, version_id, 1, 2),
+        ]
+        # Called outside a worker, so there's no lock to hand over
+        assert chord.body == tasks.finish_unpack.s(
+            record_id, version_id, lock_owner=None
+        )
+        # So that a later deposit can revoke them
+        assert TagManager(object_version)[ObjectTagKey.TaskIDs].split() == [
+            task.options["task_id"] for task in chord.tasks
+        ]
+        # But as they don't report progress, they aren't looked up for it
+        assert ObjectTagKey.ProgressTaskIDs not in TagManager(object_version)
+
+        results = [
+            tasks.unpack_chunk(*task.args, **task.kwargs) for task in chord.tasks
+        ]
+        assert results == [True, True]
+        assert (
+            TagManager(object_version).get(ObjectTagKey.FileState) != FileState.Ingested
+        )
+
+        tasks.finish_unpack(results, record_id, version_id)
+        assert sorted(file.key for file in record.files) == [
+            "deposit.zip",
+            "example.svg",
+            "hello.txt",
+        ]
+        object_version = ObjectVersion.get(record.bucket, "deposit.zip")
+        assert TagManager(object_version)[ObjectTagKey.FileState] == FileState.Ingested
+
+
+def test_unpack_not_chunked_without_reading_from_storage(
+    api, location, es, fixtures_path, monkeypatch
+):
+    monkeypatch.setitem(api.config, "SWORD_UNPACK_CHUNK_SIZE", 1)
+    monkeypatch.setitem(api.config, "SWORD_UNPACK_FROM_STORAGE", False)
+    with api.test_request_context():
+        record: SWORDDeposit = SWORDDeposit.create({})
+        with open(os.path.join(fixtures_path, "simple.zip"), "rb") as f:
+            object_version = ObjectVersion.create(
+                bucket=record.bucket,
+                key="deposit.zip",
+                stream=f,
+                mimetype="application/zip",
+            )
+        TagManager(object_version)[ObjectTagKey.Packaging] = PackagingFormat.SimpleZip
+
+        # Each chunk would otherwise copy the whole archive
+        with unittest.mock.patch.object(tasks.unpack_object, "replace") as replace:
+            tasks.unpack_object(str(record.id), str(object_version.version_id))
+        replace.assert_not_called()
+
+        object_version = ObjectVersion.get(record.bucket, "deposit.zip")
+        assert TagManager(object_version)[ObjectTagKey.FileState] == FileState.Ingested
+
+
+def test_unpack_chunk_stops_when_superseded(
+    api, location, es, fixtures_path, monkeypatch
+):
+    monkeypatch.setitem(api.config, "SWORD_UNPACK_CHECKPOINT_INTERVAL", 1)
+    with api.test_request_context():
+        record: SWORDDeposit = SWORDDeposit.create({})
+        with open(os.path.join(fixtures_path, "simple.zip"), "rb") as f:
+            object_version = ObjectVersion.create(
+                bucket=record.bucket,
+                key="deposit.zip",
+                stream=f,
+                mimetype="application/zip",
+            )
+        tags = TagManager(object_version)
+        tags[ObjectTagKey.Packaging] = PackagingFormat.SimpleZip
+        tags[ObjectTagKey.FileState] = FileState.Unpacking
+        db.session.commit()
+
+        # Superseded once the first member has been unpacked
+        with unittest.mock.patch(
+            "invenio_sword.packaging.base.check_superseded", side_effect=Superseded,
+        ):
+            result = tasks.unpack_chunk(
+                str(record.id), str(object_version.version_id), 0, 2
+            )
+
+        assert result is False
+        assert sorted(file.key for file in record.files) == [
+            "deposit.zip",
+            "example.svg",
+        ]
+        assert TagManager(object_version)[ObjectTagKey.FileState] == FileState.Unpacking
+
 
+def test_finish_unpack_superseded(api, location, es):
+    with api.test_request_context():
+        record: SWORDDeposit = SWORDDeposit.create({})
+        object_version = ObjectVersion.create(
+            bucket=record.bucket, key="deposit.zip", stream=io.BytesIO(b"data")
+        )
+        tags = TagManager(object_version)
+        tags[ObjectTagKey.FileState] = FileState.Unpacking
+        tags[ObjectTagKey.SupersededBy] = "later"
+        db.session.commit()
+
+        tasks.finish_unpack([True], str(record.id), str(object_version.version_id))
+        assert TagManager(object_version)[ObjectTagKey.FileState] == FileState.Unpacking
+
+
+def test_replace_deletes_earlier_generations(
+    api, location, es, task_delay, fixtures_path
+):
+    with api.test_request_context():
+        record: SWORDDeposit = SWORDDeposit.create({})
+        with open(os.path.join(fixtures_path, "simple.zip"), "rb") as f:
+            record.ingest_file(
+                f,
+                packaging_name=PackagingFormat.SimpleZip,
+                content_type="application/zip",
+                content_disposition="attachment; filename=deposit.zip",
+            )
+
+        # Unpacked files belong to the same generation as the deposit
+        assert {
+            TagManager(file.obj)[ObjectTagKey.Generation] for file in record.files
+        } == {record.generation}
+
+        record = SWORDDeposit.get_record(record.id)
+        record.ingest_file(
+            io.BytesIO(b"data"),
+            packaging_name=PackagingFormat.Binary,
+            content_type="text/plain",
+            content_disposition="attachment; filename=replacement.txt",
+        )
+
+        assert [file.key for file in record.files] == ["replacement.txt"]
+
+
+def test_generations_increase(api, location, es):
+    with api.test_request_context():
+        record: SWORDDeposit = SWORDDeposit.create({})
+        first = record.generation
+        # Generations come from a counter in the database, not the clock
+        second = SWORDDeposit.get_record(record.id).generation
+        db.session.commit()
+        third = SWORDDeposit.get_record(record.id).generation
+
+        assert first < second < third
+
+
+def test_replace_supersedes_in_flight_tasks(api, location, es, task_delay):
+    with api.test_request_context():
+        record: SWORDDeposit = SWORDDeposit.create({})
         record.set_by_reference_files(
             [
                 ByReferenceFileDefinition(
-                    url="http://example.com/one",
-                    content_disposition="attachment; filename=br-yes.html",
-                    content_type="text/html",
-                    content_length=100,
-                    packaging=PackagingFormat.Binary,
-                    dereference=False,
-                ),
-                ByReferenceFileDefinition(
-                    url="http://example.com/two",
-                    content_disposition="attachment; filename=br-no.html",
-                    content_type="text/html",
+                    url="http://example.com/large.bin",
+                    content_disposition="attachment; filename=large.bin",
+                    content_type="application/octet-stream",
                     packaging=PackagingFormat.Binary,
-                    dereference=False,
+                    dereference=True,
                 ),
             ],
             dereference_policy=lambda record, brf: brf.dereference,
             request_url="http://localhost/something",
             replace=False,
         )
+        db.session.commit()
+        object_version = ObjectVersion.get(record.bucket, "large.bin")
+        task_ids = TagManager(object_version)[ObjectTagKey.TaskIDs].split()
+        assert task_delay.call_args[0][0].id == task_ids[0]
 
-        record.ingest_file(
-            io.BytesIO(b"data"),
-            packaging_name=PackagingFormat.Binary,
-            content_type="text/html",
-            content_disposition="attachment; filename=direct-yes.html",
-            replace=False,
-        )
-        record.ingest_file(
-            io.BytesIO(b"data"),
-            packaging_name=PackagingFormat.Binary,
-            content_type="text/html",
-            content_disposition="attachment; filename=direct-no.html",
-            replace=False,
-        )
+        assert acquire_bucket_lock(record.bucket_id, task_ids[0])
 
-        assert sorted(file.key for file in record.files) == [
-            "br-no.html",
-            "br-yes.html",
-            "direct-no.html",
-            "direct-yes.html",
-        ]
+        record = SWORDDeposit.get_record(record.id)
+        with unittest.mock.patch.object(celery.current_app.control, "revoke") as revoke:
+            record.ingest_file(
+                io.BytesIO(b"data"),
+                packaging_name=PackagingFormat.Binary,
+                content_type="text/plain",
+                content_disposition="attachment; filename=replacement.txt",
+            )
+            db.session.commit()
+        revoke.assert_called_once_with(task_ids)
+        # Revoked tasks won't release the lock themselves
+        assert BucketTag.get_value(record.bucket_id, LOCK_TAG) is None
 
-        tasks.delete_old_objects(
-            ["br-yes.html", "direct-yes.html"], bucket_id=record.bucket_id
-        )
+        tags = TagManager(object_version)
+        assert tags[ObjectTagKey.SupersededBy] == record.generation
+        assert ObjectTagKey.TaskIDs not in tags
 
-        assert sorted(file.key for file in record.files) == [
-            "br-yes.html",
-            "direct-yes.html",
-        ]
+        # A task that was already running stops without fetching anything
+        tasks.dereference_and_unpack_object(
+            str(record.id), str(object_version.version_id)
+        )
+        object_version = ObjectVersion.query.get(object_version.version_id)
+        assert object_version.file_id is None
+        assert TagManager(object_version)[ObjectTagKey.FileState] == FileState.Pending
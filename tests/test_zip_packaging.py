@@ -22,17 +22,29 @@
 # waive the privileges and immunities granted to it by virtue of its status
 # as an Intergovernmental Organization or submit itself to any jurisdiction.
 """Test the BagIt implementation."""
+import io
 import os
+import tempfile
+import unittest.mock
+import zipfile
 
+import flask
+import pytest
+from invenio_db import db
 from invenio_files_rest.models import ObjectVersion
 
 from invenio_sword.api import SWORDDeposit
+from invenio_sword.enum import ObjectTagKey
 from invenio_sword.packaging import SimpleZipPackaging
+from invenio_sword.packaging.zip import map_zip_members
+from invenio_sword.utils import TagManager
 
 fixtures_path = os.path.join(os.path.dirname(__file__), "fixtures")
 
 
-def test_simple_zip(api, users, location):
+@pytest.mark.parametrize("unpack_from_storage", [True, False])
+def test_simple_zip(api, users, location, unpack_from_storage):
+    api.config["SWORD_UNPACK_FROM_STORAGE"] = unpack_from_storage
     with api.test_request_context():
         record = SWORDDeposit.create({})
         with open(os.path.join(fixtures_path, "simple.zip"), "rb") as stream:
@@ -43,7 +55,13 @@ def test_simple_zip(api, users, location):
                 mimetype="application/zip",
             )
 
-        SimpleZipPackaging(record).unpack(object_version)
+        with unittest.mock.patch.object(
+            tempfile, "TemporaryFile", wraps=tempfile.TemporaryFile
+        ) as temporary_file:
+            SimpleZipPackaging(record).unpack(object_version)
+
+        # The archive is only copied to a temporary file if we've asked for it
+        assert temporary_file.called is not unpack_from_storage
 
         obj_1 = ObjectVersion.query.filter_by(
             bucket=record.bucket, key="example.svg"
@@ -54,3 +72,149 @@ def test_simple_zip(api, users, location):
 
         assert obj_1.mimetype == "image/svg+xml"
         assert obj_2.mimetype == "text/plain"
+
+
+@pytest.mark.parametrize("unpack_from_storage", [True, False])
+def test_simple_zip_concurrently(api, users, location, unpack_from_storage):
+    api.config.update(
+        SWORD_UNPACK_FROM_STORAGE=unpack_from_storage, SWORD_UNPACK_WORKERS=4
+    )
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        with open(os.path.join(fixtures_path, "simple.zip"), "rb") as stream:
+            object_version = ObjectVersion.create(
+                bucket=record.bucket,
+                key="deposit.zip",
+                stream=stream,
+                mimetype="application/zip",
+            )
+
+        keys = SimpleZipPackaging(record).unpack(object_version)
+        assert keys == {"example.svg", "hello.txt"}
+
+        with zipfile.ZipFile(os.path.join(fixtures_path, "simple.zip")) as zip:
+            for key in keys:
+                obj = ObjectVersion.query.filter_by(bucket=record.bucket, key=key).one()
+                assert obj.file.storage().open().read() == zip.read(key)
+                assert TagManager(obj) == {
+                    ObjectTagKey.FileSetFile: "true",
+                    ObjectTagKey.DerivedFrom: "deposit.zip",
+                    ObjectTagKey.ArchiveMemberCRC32: "{:08x}".format(
+                        zip.getinfo(key).CRC
+                    ),
+                }
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+@pytest.mark.parametrize("verify_checksum", [True, False])
+def test_simple_zip_incremental(api, users, location, workers, verify_checksum):
+    api.config.update(
+        SWORD_INCREMENTAL_UNPACK=True,
+        SWORD_INCREMENTAL_UNPACK_VERIFY_CHECKSUM=verify_checksum,
+        SWORD_UNPACK_WORKERS=workers,
+    )
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+
+        def deposit(key, stream):
+            object_version = ObjectVersion.create(
+                bucket=record.bucket,
+                key=key,
+                stream=stream,
+                mimetype="application/zip",
+            )
+            SimpleZipPackaging(record).unpack(object_version)
+            return {
+                key: ObjectVersion.get(record.bucket, key).file_id
+                for key in ["example.svg", "hello.txt"]
+            }
+
+        with open(os.path.join(fixtures_path, "simple.zip"), "rb") as stream:
+            first_file_ids = deposit("first.zip", stream)
+
+        # Re-deposit with one member changed
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(
+            os.path.join(fixtures_path, "simple.zip")
+        ) as original, zipfile.ZipFile(buffer, "w") as changed:
+            changed.writestr("example.svg", original.read("example.svg"))
+            changed.writestr("hello.txt", b"goodbye")
+        buffer.seek(0)
+        second_file_ids = deposit("second.zip", buffer)
+
+        assert second_file_ids["example.svg"] == first_file_ids["example.svg"]
+        assert second_file_ids["hello.txt"] != first_file_ids["hello.txt"]
+        assert (
+            ObjectVersion.get(record.bucket, "hello.txt").file.storage().open().read()
+            == b"goodbye"
+        )
+        assert (
+            TagManager(ObjectVersion.get(record.bucket, "example.svg"))[
+                ObjectTagKey.DerivedFrom
+            ]
+            == "second.zip"
+        )
+
+
+def test_simple_zip_resumes_from_checkpoint(api, users, location, monkeypatch):
+    monkeypatch.setitem(api.config, "SWORD_UNPACK_CHECKPOINT_INTERVAL", 1)
+    with api.test_request_context():
+        record = SWORDDeposit.create({})
+        with open(os.path.join(fixtures_path, "simple.zip"), "rb") as stream:
+            object_version = ObjectVersion.create(
+                bucket=record.bucket,
+                key="deposit.zip",
+                stream=stream,
+                mimetype="application/zip",
+            )
+
+        packaging = SimpleZipPackaging(record)
+        packaging.resumable = True
+        store_stream = packaging.store_stream
+
+        # Fail while storing the second member, as if the worker had died
+        def store_one_stream(stream):
+            if mock_store_stream.call_count > 1:
+                raise RuntimeError
+            return store_stream(stream)
+
+        with unittest.mock.patch.object(
+            packaging, "store_stream", side_effect=store_one_stream
+        ) as mock_store_stream:
+            with pytest.raises(RuntimeError):
+                packaging.unpack(object_version)
+        db.session.rollback()
+
+        assert TagManager(object_version)[ObjectTagKey.UnpackCheckpoint] == "1"
+        unpacked = ObjectVersion.query.filter(
+            ObjectVersion.bucket == record.bucket, ObjectVersion.key != "deposit.zip",
+        ).one()
+
+        with unittest.mock.patch.object(
+            packaging, "store_stream", wraps=store_stream
+        ) as mock_store_stream:
+            keys = packaging.unpack(object_version)
+        db.session.commit()
+
+        # Only the remaining member was unpacked, but all are reported
+        assert mock_store_stream.call_count == 1
+        assert keys == {"example.svg", "hello.txt"}
+        assert (
+            ObjectVersion.get(record.bucket, unpacked.key).file_id == unpacked.file_id
+        )
+        assert ObjectTagKey.UnpackCheckpoint not in TagManager(object_version)
+
+
+def test_map_zip_members_opens_in_app_context(api):
+    def opener():
+        # As storage backends that read their configuration from the app do
+        assert flask.current_app.config["SWORD_UNPACK_WORKERS"]
+        return open(os.path.join(fixtures_path, "simple.zip"), "rb")
+
+    with api.app_context():
+        with zipfile.ZipFile(os.path.join(fixtures_path, "simple.zip")) as zip:
+            infos = zip.infolist()
+        sizes = map_zip_members(
+            opener, infos, lambda info, member: len(member.read()), workers=2
+        )
+    assert sizes == {"example.svg": 466, "hello.txt": 7}